@@ -5,6 +5,8 @@ Defines a series of symbolic name groups which allow us to represent a context
 in an HTML document as a number.
 """
 
+from array import array
+
 
 def state_of(context):
     """
@@ -259,6 +261,9 @@ URL_PART_UNKNOWN = 3 << 14
 # All of the URL part bits set.
 URL_PART_ALL = 3 << 14
 
+# Every context is less than this so contexts can index tables.
+CONTEXT_BOUND = 1 << 16
+
 
 _PARTIAL_CONTEXT_FOR_ATTR = {
     ATTR_NONE: STATE_ATTR,
@@ -281,6 +286,15 @@ def after_attr_delimiter(el_type, attr_type, delim):
     return _PARTIAL_CONTEXT_FOR_ATTR[attr_type] | el_type | delim
 
 
+# Marks entries of _EPSILON_TRANSITIONS that have not been computed.
+# This is not a valid context since 31 is not a valid state.
+_NOT_COMPUTED = CONTEXT_BOUND - 1
+
+# Maps contexts to the result of force_epsilon_transition.
+# Entries are filled in as they are first needed.
+_EPSILON_TRANSITIONS = array('H', [_NOT_COMPUTED]) * CONTEXT_BOUND
+
+
 def force_epsilon_transition(context):
     """
     Some epsilon transitions need to be delayed until we get into a branch.
@@ -309,6 +323,15 @@ def force_epsilon_transition(context):
     not as occuring before an attribute value.
     """
 
+    nudged = _EPSILON_TRANSITIONS[context]
+    if nudged == _NOT_COMPUTED:
+        nudged = _compute_epsilon_transition(context)
+        _EPSILON_TRANSITIONS[context] = nudged
+    return nudged
+
+
+def _compute_epsilon_transition(context):
+    """Computes force_epsilon_transition(context) without the table."""
     state = state_of(context)
     if state in (STATE_TAG, STATE_TAG_NAME):
         # In "<foo {{.}}", the hole should be filled with an attribute.
@@ -6,10 +6,17 @@ content.
 """
 
 from autoesc.context import *
-from autoesc import content, debug, escaping, html, js
-from functools32 import lru_cache
-from cStringIO import StringIO
+from autoesc import content, debug, escaping, html, js, lazy_regex, lru
+import bisect
+import copy
+import os
 import re
+import threading
+
+# Maps (context0 << 16) | context1 to context_union(context0, context1).
+# Entries are added as pairs are first joined.  Templates only reach a few
+# contexts so this stays small.
+_CONTEXT_UNIONS = {}
 
 def context_union(context0, context1):
     """
@@ -22,6 +29,16 @@ def context_union(context0, context1):
 
     if context0 == context1:
         return context0
+    key = (context0 << 16) | context1
+    union = _CONTEXT_UNIONS.get(key)
+    if union is None:
+        union = _compute_context_union(context0, context1)
+        _CONTEXT_UNIONS[key] = union
+    return union
+
+
+def _compute_context_union(context0, context1):
+    """Computes context_union(context0, context1) without the memo."""
 
     if context0 == ((context1 & ~JS_CTX_ALL) | js_ctx_of(context0)):
         # The contexts differ only by JS_CTX_*
@@ -49,20 +66,20 @@ def context_union(context0, context1):
 # regex charset.
 NLS = u"\n\r\u2028\u2029"
 
-def _end_of_attr_value(raw_text, delim):
+def _end_of_attr_value(raw_text, pos, delim):
     """
-    Returns the end of the attribute value of -1 if delim indicates we are
-    not in an attribute, or len(raw_text) if we are in an attribute but the
-    end does not appear in raw_text.
+    Returns the end of the attribute value that starts at pos of -1 if delim
+    indicates we are not in an attribute, or len(raw_text) if we are in an
+    attribute but the end does not appear in raw_text.
     """
     if delim == DELIM_NONE:
         return -1
     if delim == DELIM_SPACE_OR_TAG_END:
-        match = re.search(r'[\s>]', raw_text)
+        match = re.compile(r'[\s>]').search(raw_text, pos)
         if match:
             return match.start(0)
     else:
-        quote = raw_text.find(DELIM_TEXT[delim])
+        quote = raw_text.find(DELIM_TEXT[delim], pos)
         if quote >= 0:
             return quote
     return len(raw_text)
@@ -72,17 +89,22 @@ class _Transition(object):
     """
     Encapsulates a grammar production and the context after that
     production is seen in a chunk of HTML/CSS/JS input.
+
+    The matches passed to transitions are of the whole chunk; the token
+    consumes match.string[match.pos:match.end()] and the lexer searched no
+    further than match.endpos.
     """
     def __init__(self, pattern):
-        if type(pattern) is type(re.compile('')):
-            self.pattern = pattern
-        else:
-            self.pattern = re.compile(pattern)
+        if isinstance(pattern, basestring):
+            # Most patterns are only needed once the lexer reaches their
+            # state, so they are compiled on first use.
+            pattern = lazy_regex.compile(pattern)
+        self.pattern = pattern
 
     def is_applicable_to(self, prior, match):
         """
         True iff this transition can produce a context after the text in
-        raw_text[0:match.start(0) + match.end(0)].
+        match.string[match.pos:match.end(0)].
         This should not destructively modify the match.
 
         prior - The context prior to the token in match.
@@ -91,10 +113,23 @@ class _Transition(object):
         assert self and type(prior) is int and hasattr(match, 'group')
         return True
 
+    def specialize(self, prior):
+        """
+        A transition equivalent to this one for tokens after prior, or None
+        if this transition is not applicable to any token after prior.
+        Transitions whose applicability depends on prior alone should
+        return one that does not override is_applicable_to so that the
+        lexer need not vet its matches.
+
+        prior - The context prior to the token.
+        """
+        assert type(prior) is int
+        return self
+
     def compute_next_context(self, prior, match):
         """
         Computes the context that this production transitions to after
-        raw_text[0:match.start(0) + match.end(0)].
+        match.string[match.pos:match.end(0)].
 
         prior - The context prior to the token in match.
         match - The token matched by self.pattern.
@@ -105,10 +140,12 @@ class _Transition(object):
 
     def raw_text(self, match):
         """
-        Called to normalize the matched text.
+        Called to normalize the text consumed by the token,
+        match.string[match.pos:match.end()].
+        Returns None if the consumed text is not changed.
         """
-        assert self
-        return match.string[:match.end()]
+        assert self and hasattr(match, 'group')
+        return None
 
 
 class _ToTransition(_Transition):
@@ -149,6 +186,8 @@ class _NormalizeTransition(_Transition):
         self.transition = transition
         self.repl = repl
         self.replace_whole = replace_whole
+        # Maps specializations of transition to specializations of self.
+        self._specialized = {}
 
     def compute_next_context(self, prior, match):
         return self.transition.compute_next_context(prior, match)
@@ -156,11 +195,24 @@ class _NormalizeTransition(_Transition):
     def is_applicable_to(self, prior, match):
         return self.transition.is_applicable_to(prior, match)
 
+    def specialize(self, prior):
+        transition = self.transition.specialize(prior)
+        if transition is self.transition or transition is None:
+            return transition and self
+        specialized = self._specialized.get(transition)
+        if specialized is None:
+            specialized = copy.copy(self)
+            specialized.transition = transition
+            specialized._specialized = {}
+            self._specialized[transition] = specialized
+        return specialized
+
     def raw_text(self, match):
         if self.replace_whole:
             return self.repl
         else:
-            return ''.join((match.string[:match.start()], self.repl))
+            return ''.join(
+                (match.string[match.pos:match.start()], self.repl))
 
 
 class _NormalizeJsBlockCommentTransition(_NormalizeTransition):
@@ -192,8 +244,8 @@ class _NormalizeJsBlockCommentTransition(_NormalizeTransition):
         _NormalizeTransition.__init__(self, pattern, "", True)
 
     def raw_text(self, match):
-        text = match.string[:match.end()]
-        if re.search('[%s]' % NLS, text):
+        if re.compile('[%s]' % NLS).search(
+                match.string, match.pos, match.end()):
             return '\n'
         else:
             return ''
@@ -318,7 +370,7 @@ class _SlashTransition(_Transition):
             raise ContextUpdateFailure(
                 ("ambiguous / could start a division or a RegExp."
                  "  Please parenthesize near `%s`.")
-                % match.string[match.start():])
+                % match.string[match.start():match.endpos])
 
 
 class _JsPuncTransition(_Transition):
@@ -330,7 +382,8 @@ class _JsPuncTransition(_Transition):
         _Transition.__init__(self, regex)
 
     def compute_next_context(self, prior, match):
-        return js.next_js_ctx(match.group(0), prior)
+        return js.next_js_ctx(
+            match.string, prior, match.start(), match.end())
 
 
 class _TransitionToSelf(_Transition):
@@ -359,7 +412,7 @@ class _URLPartTransition(_Transition):
     def compute_next_context(self, prior, match):
         url_part = url_part_of(prior)
         if url_part == URL_PART_NONE:
-            text = match.string[:match.end()].strip()
+            text = match.string[match.pos:match.end()].strip()
             if text:
                 # There is a non-space character preceding.
                 url_part = URL_PART_PRE_QUERY
@@ -384,6 +437,8 @@ class _EndTagTransition(_Transition):
     def __init__(self, pattern):
         '''Matches the end of a special tag like "script".'''
         _Transition.__init__(self, pattern)
+        self._outside_attr = _ToTransition(
+            self.pattern, STATE_TAG | ELEMENT_NONE)
 
     # TODO: This transitions to an HTML_TAG state which accepts attributes.
     # So we allow nonsensical constructs like </br foo="bar">.
@@ -394,6 +449,11 @@ class _EndTagTransition(_Transition):
     def is_applicable_to(self, prior, match):
         return attr_type_of(prior) == ATTR_NONE
 
+    def specialize(self, prior):
+        if attr_type_of(prior) == ATTR_NONE:
+            return self._outside_attr
+        return None
+
 
 _SCRIPT_TAG_END = _EndTagTransition(r'(?i)<\/script\b')
 _STYLE_TAG_END = _EndTagTransition(r'(?i)<\/style\b')
@@ -414,6 +474,8 @@ class _RcdataEndTagTransition(_Transition):
 
     def __init__(self, regex):
         _Transition.__init__(self, regex)
+        # Maps element types to transitions for their end tags alone.
+        self._by_element = {}
 
     def compute_next_context(self, prior, match):
         return STATE_TAG | ELEMENT_NONE
@@ -423,6 +485,19 @@ class _RcdataEndTagTransition(_Transition):
             match.group(1).lower()
             == _ELEMENT_TO_TAG_NAME.get(element_type_of(prior)))
 
+    def specialize(self, prior):
+        element_type = element_type_of(prior)
+        tag_name = _ELEMENT_TO_TAG_NAME.get(element_type)
+        if tag_name is None:
+            return None
+        transition = self._by_element.get(element_type)
+        if transition is None:
+            # Match only the name of the element being closed.
+            transition = self._by_element[element_type] = _ToTransition(
+                r'(?i)</(%s)(?![a-z\-])' % tag_name,
+                STATE_TAG | ELEMENT_NONE)
+        return transition
+
 
 class _CssUriTransition(_Transition):
     """
@@ -621,7 +696,7 @@ _TRANSITIONS[STATE_JS] = (
     _SlashTransition(r'/'),
     # Shuffle words, punctuation (besides /), and numbers off to an
     # analyzer which uses is_regex_preceder to determine what '/' means.
-    _JsPuncTransition(r'(?i)(?:[^<\/\"\'\s\\]|<(?!\/script))+'),
+    _JsPuncTransition(r'(?i)(?:[^<\/\"\'\s\\]+|<(?!\/script))+'),
     _TransitionToSelf(r'\s+'),  # Space
     _SCRIPT_TAG_END,
     )
@@ -638,13 +713,19 @@ _TRANSITIONS[STATE_JSLINE_CMT] = (
     _NormalizeTransition(_SCRIPT_TAG_END, "</script", True),
     _NormalizeTransition(_TRANSITION_TO_SELF, "", True),
     )
+# The bodies of JS strings and regular expressions, and runs of JS
+# punctuation, can be very long, so their patterns consume runs of ordinary
+# characters with one repetition of a character set instead of one iteration
+# of the alternation per character.  The repetition ends the pattern so a
+# match never backtracks; it stops at the first character that no
+# alternative accepts.
 _TRANSITIONS[STATE_JSDQ_STR] = (
     _DivPreceder(r'["]'),
     _SCRIPT_TAG_END,
     _TransitionToSelf(
         r"(?i)" +                      # Case-insensitively
         r"\A(?:" +                     # from the start
-            r"[^\"\\" + NLS + r"<]" +  # match all but nls, quotes, \s, <;
+            r"[^\"\\" + NLS + r"<]+" + # match all but nls, quotes, \s, <;
             r"|\\(?:" +                # or backslash followed by a
                 r"\r\n?" +             # line continuation
                 r"|[^\r<]" +           # or an escape
@@ -659,7 +740,7 @@ _TRANSITIONS[STATE_JSSQ_STR] = (
     _TransitionToSelf(
         r"(?i)" +
         r"\A(?:" +                     # Case-insensitively, from start
-            r"[^\'\\" + NLS + "<]" +   # match all but nls, quotes, \s, <;
+            r"[^\'\\" + NLS + "<]+" +  # match all but nls, quotes, \s, <;
             r"|\\(?:" +                # or a backslash followed by a
                 r"\r\n?" +             # line continuation
                 r"|[^\r<]" +           # or an escape;
@@ -675,11 +756,11 @@ _TRANSITIONS[STATE_JSREGEXP] = (
         r"\A(?:" +
             # We have to handle [...] style character sets specially since
             # in /[/]/, the second solidus doesn't end the RegExp.
-            r"[^\[\\/<" + NLS + "]" +        # A non-charset, non-escape token;
+            r"[^\[\\/<" + NLS + "]+" +       # Non-charset, non-escape tokens;
             r"|\\[^" + NLS + "]" +           # an escape;
             r"|\\?<(?!/script)" +
             r"|\[" +                         # or a character set containing
-                r"(?:[^\]\\<" + NLS + "]" +  # normal characters,
+                r"(?:[^\]\\<" + NLS + "]+" + # normal characters,
                 r"|\\(?:[^" + NLS + "]))*" + # and escapes;
                 r"|\\?<(?!/script)" +        # or non-closing angle less-than.
             r"\]" +
@@ -694,59 +775,316 @@ _TRANSITIONS[STATE_URL] = (_URL_PART_TRANSITION,)
 _TRANSITIONS = tuple(_TRANSITIONS)
 
 
-def _process_next_token(text, context):
+def _is_always_applicable(transition):
+    """
+    True iff transition does not override is_applicable_to, so any match of
+    its pattern is a candidate token.
+    """
+    while isinstance(transition, _NormalizeTransition):
+        transition = transition.transition
+    return (type(transition).is_applicable_to.im_func
+            is _Transition.is_applicable_to.im_func)
+
+
+# Matches inline flags like the "(?i)" at the start of a pattern.
+_INLINE_FLAGS = lazy_regex.compile(r'\A\(\?[iLmsux]+\)')
+
+
+def _is_case_neutral(pattern):
+    """
+    True iff pattern contains no letters outside escapes like \\A or \\s,
+    so it matches the same strings with or without re.IGNORECASE.
     """
-    Consume a portion of text and compute the next context.
-    Output is stored in member variables.
-    text - Non empty.
+    source = _INLINE_FLAGS.sub('', re.sub(r'\\.', '', pattern.pattern))
+    return not re.search('[A-Za-z]', source)
 
-    Returns (n, context after text[:n], replacement for text[:n])
+
+def _split_anchor(pattern):
+    """
+    Returns (source, anchored) where source is the source of pattern without
+    inline flags or a leading \\A, and anchored is true iff it had a leading
+    \\A.
+
+    \\A only matches at the start of the string, not at the pos passed to
+    search, so anchored patterns are matched at pos without it instead.
+    """
+    source = _INLINE_FLAGS.sub('', pattern.pattern)
+    anchored = source.startswith(r'\A')
+    if anchored:
+        source = source[2:]
+    assert r'\A' not in source.replace(r'\\', ''), pattern.pattern
+    return source, anchored
+
+
+def _search(pattern, text, pos, end, searches):
+    """
+    pattern.search(text, pos, end), reusing an earlier search of text from
+    before pos if it found nothing or found a match that starts at or after
+    pos, since a search from pos would find the same.
+
+    searches - maps patterns to (pos, match) for earlier searches of
+        text[:end].
+    """
+    prior = searches.get(pattern)
+    if prior is not None:
+        searched_from, match = prior
+        if searched_from <= pos and (match is None or match.start() >= pos):
+            return match
+    match = pattern.search(text, pos, end)
+    searches[pattern] = (pos, match)
+    return match
+
+
+class _TokenFinder(object):
+    """
+    Finds the transition whose pattern matches earliest in a chunk of text
+    using a single alternation with one named group per transition, so the
+    text is scanned once per token instead of once per transition.
+
+    Patterns anchored with \\A all match at the start of the token or not at
+    all, so they are tried in their own alternation via match instead of
+    search.
+
+    Transitions that must be vetted against the match via is_applicable_to,
+    or whose patterns cannot share the flags of the alternation, are matched
+    separately as before.
+    """
+
+    def __init__(self, transitions):
+        self.transitions = transitions
+        # For each transition, its pattern without any leading \A.
+        self.token_patterns = []
+        anchored, unanchored = [], []
+        for index, transition in enumerate(transitions):
+            source, is_anchored = _split_anchor(transition.pattern)
+            self.token_patterns.append(
+                re.compile(source, transition.pattern.flags))
+            if is_anchored:
+                anchored.append(index)
+            else:
+                unanchored.append(index)
+        # Indices into transitions of those not covered by an alternation.
+        self.anchored, self.anchored_separate = self._merge(anchored)
+        self.unanchored, self.unanchored_separate = self._merge(unanchored)
+
+    def _merge(self, indices):
+        """
+        Returns (an alternation of the token patterns at indices or None,
+        the indices of the transitions that cannot be part of it).
+        """
+        transitions = self.transitions
+        always_applicable = [
+            index for index in indices
+            if _is_always_applicable(transitions[index])]
+        flags = 0
+        for index in always_applicable:
+            flags |= transitions[index].pattern.flags
+        merged = []
+        separate = []
+        for index in indices:
+            pattern = self.token_patterns[index]
+            if index in always_applicable and (
+                pattern.flags == flags or (
+                    pattern.flags | re.IGNORECASE == flags
+                    and _is_case_neutral(pattern))):
+                merged.append('(?P<t%d>%s)' % (index, pattern.pattern))
+            else:
+                separate.append(index)
+        if merged:
+            return re.compile('|'.join(merged), flags), separate
+        return None, separate
+
+    def find(self, text, pos, end, context, searches):
+        """
+        Returns (transition, match) for the transition that matches earliest
+        in text[pos:end] and is applicable in context, preferring earlier
+        transitions when two match at the same position; or (None, None).
+        The match has match.pos == pos.
+
+        searches - as for _search, so that a pattern is not searched again
+            until the lexer passes the match it found.
+        """
+        transitions = self.transitions
+        earliest_start = end + 1
+        earliest_index = None
+        earliest_match = None
+        if self.anchored is not None:
+            match = self.anchored.match(text, pos, end)
+            if match:
+                earliest_start = pos
+                earliest_index = int(match.lastgroup[1:])
+        for index in self.anchored_separate:
+            if earliest_index is not None and index > earliest_index:
+                break
+            transition = transitions[index]
+            match = self.token_patterns[index].match(text, pos, end)
+            if match and transition.is_applicable_to(context, match):
+                earliest_start = pos
+                earliest_index = index
+                earliest_match = match
+                break
+        if self.unanchored is not None:
+            match = _search(self.unanchored, text, pos, end, searches)
+            if match:
+                start = match.start()
+                index = int(match.lastgroup[1:])
+                if (start < earliest_start
+                    or (start == earliest_start and index < earliest_index)):
+                    earliest_start = start
+                    earliest_index = index
+                    earliest_match = None
+        for index in self.unanchored_separate:
+            transition = transitions[index]
+            match = _search(transition.pattern, text, pos, end, searches)
+            if not match:
+                continue
+            start = match.start()
+            if ((start < earliest_start
+                 or (start == earliest_start and index < earliest_index))
+                and transition.is_applicable_to(context, match)):
+                earliest_start = start
+                earliest_index = index
+                earliest_match = match
+        if earliest_index is None:
+            return None, None
+        transition = transitions[earliest_index]
+        if earliest_match is None or earliest_match.pos != pos:
+            # Rematch from pos so that groups are numbered as in
+            # transition.pattern and the match spans the whole token.
+            token_pattern = self.token_patterns[earliest_index]
+            if earliest_start == pos:
+                earliest_match = token_pattern.match(text, pos, end)
+            else:
+                earliest_match = token_pattern.search(text, pos, end)
+        return transition, earliest_match
+
+
+# Maps contexts to the _TokenFinder for the transitions specialized to them.
+# Built lazily since few of the possible contexts are reachable.
+_TOKEN_FINDERS = {}
+
+# Maps tuples of specialized transitions to their _TokenFinder so that
+# contexts which differ only in bits that no transition cares about share
+# one.
+_TOKEN_FINDERS_BY_TRANSITIONS = {}
+
+
+def _token_finder(context):
+    """
+    The _TokenFinder for tokens after context, whose transitions are those in
+    _TRANSITIONS for the state of context specialized to context.
+    """
+    finder = _TOKEN_FINDERS.get(context)
+    if finder is None:
+        transitions = []
+        for transition in _TRANSITIONS[state_of(context)] or ():
+            transition = transition.specialize(context)
+            if transition is not None:
+                transitions.append(transition)
+        transitions = tuple(transitions)
+        finder = _TOKEN_FINDERS_BY_TRANSITIONS.get(transitions)
+        if finder is None:
+            finder = _TokenFinder(transitions)
+            _TOKEN_FINDERS_BY_TRANSITIONS[transitions] = finder
+        _TOKEN_FINDERS[context] = finder
+    return finder
+
+
+def _process_next_token(text, pos, end, context, searches, limit=None):
+    """
+    Consume a portion of text[pos:end] and compute the next context.
+    pos < end.
+    searches - as for _search.
+    limit - None if text[:end] is all of the text, or a position such that
+        text after end cannot change how a token that ends at or before
+        limit is lexed.
+
+    Returns (the end of the consumed token, context after it,
+             replacement for the consumed text or None if it is unchanged)
+    or None if the token would end after limit.
     """
 
     if is_error_context(context):  # The ERROR state is infectious.
-        return (len(text), context, text)
+        return (end, context, None)
 
     # Find the transition whose pattern matches earliest
     # in the raw text.
-    earliest_start = len(text)+1
-    earliest_transition = None
-    earliest_match = None
+    earliest_transition, earliest_match = (
+        _token_finder(context).find(
+            text, pos, end, context, searches))
 
-    for transition in _TRANSITIONS[state_of(context)]:
-        match = transition.pattern.search(text)
-        if not match:
-            continue
-        start = match.start(0)
-        if (start < earliest_start
-            and transition.is_applicable_to(context, match)):
-            earliest_start = start
-            earliest_transition = transition
-            earliest_match = match
+    if limit is not None and (
+        earliest_transition is None or earliest_match.end(0) > limit):
+        return None
 
     if earliest_transition:
-        num_consumed = earliest_match.end(0)
+        token_end = earliest_match.end(0)
         next_context = earliest_transition.compute_next_context(
             context, earliest_match)
         normalized_text = earliest_transition.raw_text(earliest_match)
     else:
-        num_consumed = len(text)
+        token_end = end
         next_context = STATE_ERROR
-        normalized_text = text
+        normalized_text = None
 
-    if (not num_consumed
+    if (token_end == pos
         and state_of(next_context) == state_of(context)):  # pragma: no cover
         # Infinite loop.
         raise Exception('inf loop. for %r in %s'
-                        % (text, debug.context_to_string(context)))
+                        % (text[pos:end], debug.context_to_string(context)))
+
+    return (token_end, next_context, normalized_text)
+
+
+# Maps (type(raw_text), raw_text, context) to the outcome of processing
+# raw_text in context: (result, None) or (None, ContextUpdateFailure).
+# The same static chunks are processed many times by the escaper and by
+# File.write_safe, so this is consulted before lexing.
+# Use PROCESS_RAW_TEXT_CACHE.resize(n) to change the bound, or 0 to disable.
+PROCESS_RAW_TEXT_CACHE = lru.LruCache(4096)
+
+# process_raw_text lexes chunks at least this long in pieces in a pool of
+# processes, or never if None.  Starting processes is not always possible,
+# e.g. in daemonic processes, so this is opt-in: a few megabytes, 4 << 20,
+# is a reasonable threshold.  Measured on CPython 2.7, starting the pool
+# takes about 120ms and is done once; after that a call costs about 1.5ms
+# more than lexing, which runs at about 150K/s.  But speculative runs and
+# stitching about double the total work, so lexing in parallel pays off
+# only with at least three idle CPUs, and close_parallel_pool stops the
+# processes.
+PARALLEL_THRESHOLD = None
+# The number of processes to use, or None for one per CPU.
+PARALLEL_PROCESSES = None
+# The contexts in which pieces after the first are speculatively lexed.
+# A guess that is wrong only costs time since pieces are lexed sequentially
+# where no speculative run matches.
+PARALLEL_START_CONTEXTS = (
+    STATE_TEXT,
+    STATE_TAG,
+    STATE_HTMLCMT,
+    STATE_CSS | ELEMENT_STYLE,
+    STATE_CSSBLOCK_CMT | ELEMENT_STYLE,
+    STATE_JS | ELEMENT_SCRIPT | JS_CTX_REGEX,
+    STATE_JS | ELEMENT_SCRIPT | JS_CTX_DIV_OP,
+    STATE_JSBLOCK_CMT | ELEMENT_SCRIPT,
+    )
+
 
-    return (num_consumed, next_context, normalized_text)
+# Flags for process_raw_text and minify.
+# Collapses runs of whitespace in tags, CSS, and JS.
+MINIFY_CODE = 1
+# Collapses runs of whitespace in HTML text.  Unsafe for text that is
+# preformatted, as in a <pre> element, which the context does not track.
+MINIFY_TEXT = 2
+MINIFY_ALL = MINIFY_CODE | MINIFY_TEXT
 
 
-[lru_cache]
-def process_raw_text(raw_text, context):
+def process_raw_text(raw_text, context, minify=0):
     """
     raw_text - A chunk of HTML/CSS/JS.
     context - The context before raw_text.
+    minify - MINIFY_* flags that select whitespace to collapse in the
+        normalized text as by the function minify.
 
     Returns (
       the context after raw_text which may be an error context,
@@ -757,131 +1095,977 @@ def process_raw_text(raw_text, context):
     May raise ContextUpdateFailure which is equivalent to returning
     STATE_ERROR but with a more informative error message.
     """
+    # The type is part of the key since 'foo' == u'foo' but str and unicode
+    # inputs need not normalize the same way.
+    key = (type(raw_text), raw_text, context, minify)
+    outcome = PROCESS_RAW_TEXT_CACHE.get(key)
+    if outcome is None:
+        try:
+            result = _process_raw_text(raw_text, context)
+            if minify and result[1] is not None:
+                result = (result[0], _minify(result[1], context, minify),
+                          None, None)
+            outcome = (result, None)
+        except ContextUpdateFailure, failure:
+            outcome = (None, failure)
+        PROCESS_RAW_TEXT_CACHE.put(key, outcome)
+    result, failure = outcome
+    if failure is not None:
+        raise failure
+    return result
+
+
+def minify(normalized_text, context, flags=MINIFY_ALL):
+    """
+    Collapses runs of whitespace in normalized_text, text normalized by
+    process_raw_text that starts in context, where they are not significant.
+    Whitespace in strings, regular expressions, RCDATA and attribute values
+    other than JS and CSS is kept, and a run of JS whitespace that breaks a
+    line becomes a line break so semicolon insertion is unchanged.
+
+    flags - MINIFY_* flags that select which whitespace to collapse.
+
+    Returns the minified text.  Text from where normalized_text reaches an
+    error context, as it may when process_raw_text elided a comment at its
+    end, is kept as is.
+    """
+    if not flags:
+        return normalized_text
+    return _minify(normalized_text, context, flags)
+
+
+def _minify(normalized_text, context, flags):
+    """The implementation of minify for non-zero flags."""
+    normalized = []
+    try:
+        _, _, copied, _ = _lex(
+            normalized_text, 0, context, normalized, 0, {}, None, flags)
+    except ContextUpdateFailure:
+        return normalized_text
+    if not normalized:
+        return normalized_text
+    normalized.append(normalized_text[copied:])
+    return ''.join(normalized)
+
+
+def end_context(raw_text, context):
+    """
+    Like process_raw_text but computes only contexts and skips building the
+    normalized text, for callers that write raw_text as is.
 
-    normalized = StringIO()
+    Returns (
+      the context after raw_text which may be an error context,
+      None or the context immediately prior to the error,
+      None or the unprocessed suffix of raw_text when the error occurred)
+
+    May raise ContextUpdateFailure as process_raw_text does.
+    """
+    _, context, _, error = _lex(raw_text, 0, context, None, 0, {})
+    if error is not None:
+        prior_context, prior_pos = error
+        return (context, prior_context, raw_text[prior_pos:])
+    return (context, None, None)
+
+
+def _process_raw_text(raw_text, context):
+    """The uncached implementation of process_raw_text."""
+
+    if PARALLEL_THRESHOLD is not None and len(raw_text) >= PARALLEL_THRESHOLD:
+        result = _process_raw_text_in_parallel(raw_text, context)
+        if result is not None:
+            return result
+
+    # Chunks of the normalized text.  Unchanged tokens are not copied one by
+    # one; raw_text[copied:pos] is copied only when a change is written.
+    normalized = []
+    _, context, copied, error = _lex(raw_text, 0, context, normalized, 0, {})
+    if error is not None:
+        prior_context, prior_pos = error
+        return (context, None, prior_context, raw_text[prior_pos:])
+    if not normalized:
+        # Nothing changed so there is no need to copy.
+        return (context, raw_text, None, None)
+    normalized.append(raw_text[copied:])
+    return (context, ''.join(normalized), None, None)
+
+
+def _lex(raw_text, pos, context, normalized, copied, searches, limit=None,
+         minify=0):
+    """
+    Lexes raw_text from pos, appending the normalized text to normalized.
+
+    normalized - a list of chunks of normalized text, or None to compute only
+        contexts, in which case copied is not meaningful.
+    copied - raw_text[copied:pos] is unchanged text not yet in normalized.
+    searches - as for _search.
+    limit - as for _lex_step.
+    minify - MINIFY_* flags for whitespace in tokens to collapse.
 
-    while raw_text:
-        prior_context, prior_raw_text = context, raw_text
+    Returns (the position lexed to, the context there, the updated copied,
+             None or (context, position) immediately prior to an error)
+    """
+    end = len(raw_text)
+
+    while pos < end:
+        prior_context, prior_pos = context, pos
+        step = _lex_step(
+            raw_text, pos, end, context, normalized, copied, searches, limit,
+            minify)
+        if step is None:
+            break
+        pos, context, copied = step
+        if is_error_context(context):
+            return (pos, context, copied, (prior_context, prior_pos))
+    return (pos, context, copied, None)
 
-        delim_type = delim_type_of(context)
 
-        # If we are in an attribute value, then decode raw_text (except
-        # for the delimiter) up to the next occurrence of delimiter.
+def _lex_step(raw_text, pos, end, context, normalized, copied, searches,
+              limit, minify=0):
+    """
+    Lexes the token, or the whole attribute value, at pos in raw_text[:end]
+    and appends any change to normalized as for _lex.
+    If normalized is None, only contexts are computed.
 
-        # The end of the section to decode.  Either before a delimiter
-        # or > symbol that closes an attribute, at the end of the raw_text,
-        # or -1 if no decoding needs to happen.
+    limit - as for _process_next_token.  When not None, an attribute value
+        is not lexed until its end is in raw_text.
 
-        attr_value_end = _end_of_attr_value(raw_text, delim_type)
-        if attr_value_end == -1:
-            # Outside an attribute value.  No need to decode.
-            num_consumed, context, replacement_text = _process_next_token(
-                raw_text, context)
-            raw_text = raw_text[num_consumed:]
-            normalized.write(replacement_text)
+    Returns (the position after it, the context there, the updated copied)
+    or None if limit prevents lexing it.
+    """
 
-            if delim_type_of(context) == DELIM_SPACE_OR_TAG_END:
-                # Introduce a double quote when we transition into an unquoted
-                # attribute body.
-                normalized.write('"')
+    delim_type = delim_type_of(context)
+
+    # If we are in an attribute value, then decode raw_text (except
+    # for the delimiter) up to the next occurrence of delimiter.
+
+    # The end of the section to decode.  Either before a delimiter
+    # or > symbol that closes an attribute, at the end of the raw_text,
+    # or -1 if no decoding needs to happen.
+
+    attr_value_end = _end_of_attr_value(raw_text, pos, delim_type)
+    if attr_value_end == -1:
+        # Outside an attribute value.  No need to decode.
+        token = _process_next_token(
+            raw_text, pos, end, context, searches, limit)
+        if token is None:
+            return None
+        token_start, prior_context = pos, context
+        pos, context, replacement_text = token
+        if minify:
+            replacement_text = _minify_token(
+                raw_text, token_start, pos, prior_context, replacement_text,
+                minify)
+        if normalized is None:
+            pass
+        elif replacement_text is not None:
+            normalized.append(raw_text[copied:token_start])
+            normalized.append(replacement_text)
+            copied = pos
+
+        if (normalized is not None
+            and delim_type_of(context) == DELIM_SPACE_OR_TAG_END):
+            # Introduce a double quote when we transition into an unquoted
+            # attribute body.
+            normalized.append(raw_text[copied:pos])
+            normalized.append('"')
+            copied = pos
+    else:
+        # Inside an attribute value.  Find the end and decode up to it.
+        if limit is not None and attr_value_end == end:
+            return None
+        if delim_type == DELIM_SPACE_OR_TAG_END:
+            # Check for suspicious characters in the value.
+            # http://www.w3.org/TR/html5/tokenization.html
+            # #attribute-value-unquoted-state
+            # identifies [\0"'<=`] as transitions to error states.
+            # If they occur in an unquoted value they are almost surely
+            # an indication of an error in the template.
+            bad = re.compile(r'[\x00"\'<=`]').search(
+                raw_text, pos, attr_value_end)
+            if bad:
+                raise ContextUpdateFailure(
+                    '%r in unquoted attr: %r'
+                    % (bad.group(), raw_text[pos:attr_value_end]))
+
+        # All of the languages we deal with (HTML, CSS, and JS) use
+        # quotes as delimiters.
+        # When one language is embedded in the other, we need to
+        # decode delimiters before trying to parse the content in the
+        # embedded language.
+
+        # For example, in
+        #       <a onclick="alert(&quot;Hello {$world}&quot;)">
+        # the decoded value of the event handler is
+        #       alert("Hello {$world}")
+        # so to determine the appropriate escaping convention we decode
+        # the attribute value before delegating to _process_next_token.
+
+        # We could take the cross-product of two languages to avoid
+        # decoding but that leads to either an explosion in the
+        # number of states, or the amount of lookahead required.
+
+        # The end of the attribute value.  At attr_value_end, or
+        # attr_value_end + 1 if a delimiter needs to be consumed.
+        if attr_value_end < end:
+            attr_end = attr_value_end + len(DELIM_TEXT[delim_type])
         else:
-            # Inside an attribute value.  Find the end and decode up to it.
-
-            if delim_type == DELIM_SPACE_OR_TAG_END:
-                # Check for suspicious characters in the value.
-                # http://www.w3.org/TR/html5/tokenization.html
-                # #attribute-value-unquoted-state
-                # identifies [\0"'<=`] as transitions to error states.
-                # If they occur in an unquoted value they are almost surely
-                # an indication of an error in the template.
-                bad = re.search(r'[\x00"\'<=`]', raw_text[:attr_value_end])
-                if bad:
-                    raise ContextUpdateFailure(
-                        '%r in unquoted attr: %r'
-                        % (bad.group(), raw_text[:attr_value_end]))
-
-            # All of the languages we deal with (HTML, CSS, and JS) use
-            # quotes as delimiters.
-            # When one language is embedded in the other, we need to
-            # decode delimiters before trying to parse the content in the
-            # embedded language.
-
-            # For example, in
-            #       <a onclick="alert(&quot;Hello {$world}&quot;)">
-            # the decoded value of the event handler is
-            #       alert("Hello {$world}")
-            # so to determine the appropriate escaping convention we decode
-            # the attribute value before delegating to _process_next_token.
-
-            # We could take the cross-product of two languages to avoid
-            # decoding but that leads to either an explosion in the
-            # number of states, or the amount of lookahead required.
-
-            # The end of the attribute value.  At attr_value_end, or
-            # attr_value_end + 1 if a delimiter needs to be consumed.
-            if attr_value_end < len(raw_text):
-                attr_end = attr_value_end + len(DELIM_TEXT[delim_type])
-            else:
-                attr_end = -1
-
-            # Decode so that the JavaScript rules work on attribute values
-            # like
-            #     <a onclick='alert(&quot;{$msg}!&quot;)'>
-
-            # If we've already processed the tokens "<a", " onclick='" to
-            # get into the single quoted JS attribute context, then we do
-            # three things:
-            #   (1) This class will decode "&quot;" to "\"" and work below
-            #       to go from STATE_JS to STATE_JSDQ_STR.
-            #   (2) Then the caller checks {$msg} and realizes that $msg is
-            #       part of a JS string.
-            #   (3) Then, the above will identify the "'" as the end, and
-            #       so we reach here with:
-            #       r a w T e x t = " ! & q u o t ; ) ' > "
-            #                                         ^ ^
-            #                            attr_value_end attr_end
-
-            # We use this example more in the comments below.
-
-            attr_value_tail = html.unescape_html(raw_text[:attr_value_end])
-            # attr_value_tail is "!\")" in the example above.
-
-            if delim_type == DELIM_SINGLE_QUOTE:
-                escaper = escaping.escape_html_sq_only
-            else:
-                escaper = escaping.escape_html_dq_only
-
-            # Recurse on the decoded value.
-            while attr_value_tail:
-                num_consumed, context, replacement = _process_next_token(
-                    attr_value_tail, context)
-                attr_value_tail = attr_value_tail[num_consumed:]
-                normalized.write(escaper(replacement))
-
-            # TODO: Maybe check that context is legal to end an attr in.
-            # Throw if the attribute ends inside a quoted string.
-
-            if attr_end != -1:
-                raw_text = raw_text[attr_end:]
-                # raw_text is now ">" from the example above.
-
-                # When an attribute ends, we're back in the tag.
-                context = STATE_TAG | element_type_of(context)
-
-                # Append the delimiter on exiting an attribute.
-                if delim_type == DELIM_SINGLE_QUOTE:
-                    normalized.write("'")
-                else:
-                    # Inserts an end quote for unquoted attributes.
-                    normalized.write('"')
-            else:
-                # Whole tail is part of an unterminated attribute.
-                if attr_value_end != len(raw_text):  # pragma: no cover
-                    raise AssertionError()  # Illegal state.
-                raw_text = ""
+            attr_end = -1
+
+        # Decode so that the JavaScript rules work on attribute values
+        # like
+        #     <a onclick='alert(&quot;{$msg}!&quot;)'>
+
+        # If we've already processed the tokens "<a", " onclick='" to
+        # get into the single quoted JS attribute context, then we do
+        # three things:
+        #   (1) This class will decode "&quot;" to "\"" and work below
+        #       to go from STATE_JS to STATE_JSDQ_STR.
+        #   (2) Then the caller checks {$msg} and realizes that $msg is
+        #       part of a JS string.
+        #   (3) Then, the above will identify the "'" as the end, and
+        #       so we reach here with:
+        #       r a w T e x t = " ! & q u o t ; ) ' > "
+        #                                         ^ ^
+        #                            attr_value_end attr_end
+
+        # We use this example more in the comments below.
+
+        if raw_text.find('&', pos, attr_value_end) < 0:
+            # Lex the value in place.
+            value, value_pos, value_end = raw_text, pos, attr_value_end
+            offsets = None
+        elif normalized is None:
+            value = html.unescape_html(raw_text[pos:attr_value_end])
+            value_pos, value_end = 0, len(value)
+            offsets = None
+        else:
+            value, entities = html.unescape_html_with_offsets(
+                raw_text, pos, attr_value_end)
+            # value is "!\")" in the example above.
+            value_pos, value_end = 0, len(value)
+            offsets = _AttrValueOffsets(pos, entities)
+
+        if delim_type == DELIM_SINGLE_QUOTE:
+            escaper = escaping.escape_html_sq_only
+        else:
+            escaper = escaping.escape_html_dq_only
+
+        # Only the decoded text that a transition rewrote, or whose raw
+        # text is not already in the form the escaper produces, is
+        # re-encoded.  The rest is copied from raw_text as is.
+        pending, raw_pending = value_pos, pos
+        value_searches = {}
+        while value_pos < value_end:
+            token_start, prior_context = value_pos, context
+            value_pos, context, replacement = _process_next_token(
+                value, value_pos, value_end, context, value_searches)
+            if minify:
+                replacement = _minify_token(
+                    value, token_start, value_pos, prior_context,
+                    replacement, minify)
+            if replacement is not None and normalized is not None:
+                raw_start = offsets.raw(token_start) if offsets else token_start
+                copied = _copy_attr_value(
+                    raw_text, copied, raw_pending, raw_start,
+                    value, pending, token_start, escaper, normalized)
+                if copied is not None:
+                    normalized.append(raw_text[copied:raw_start])
+                normalized.append(escaper(replacement))
+                pending = value_pos
+                raw_pending = copied = (
+                    offsets.raw(value_pos) if offsets else value_pos)
+        if normalized is not None:
+            copied = _copy_attr_value(
+                raw_text, copied, raw_pending, attr_value_end,
+                value, pending, value_end, escaper, normalized)
+
+        # TODO: Maybe check that context is legal to end an attr in.
+        # Throw if the attribute ends inside a quoted string.
+
+        if attr_end != -1:
+            pos = attr_end
+            # raw_text[pos:] is now ">" from the example above.
+
+            # When an attribute ends, we're back in the tag.
+            context = STATE_TAG | element_type_of(context)
+
+            # The delimiter of a quoted attribute is copied as is.
+            if (normalized is not None
+                and delim_type == DELIM_SPACE_OR_TAG_END):
+                # Inserts an end quote for unquoted attributes.
+                normalized.append(raw_text[copied:pos])
+                normalized.append('"')
+                copied = pos
+        else:
+            # Whole tail is part of an unterminated attribute.
+            if attr_value_end != end:  # pragma: no cover
+                raise AssertionError()  # Illegal state.
+            pos = end
+    return (pos, context, copied)
+
+
+def _collapse_html_space(match):
+    """Replaces a run of HTML whitespace with one space or line break."""
+    if re.search('[\n\r]', match.group()):
+        return '\n'
+    return ' '
+
+
+def _collapse_tag_space(match):
+    """Drops whitespace before a tag end and collapses the rest."""
+    return match.group(1) or ' '
+
+
+def _collapse_js_space(match):
+    """Collapses a run of JS whitespace, keeping one line terminator."""
+    if re.search('[%s]' % NLS, match.group()):
+        return '\n'
+    return ' '
+
+
+# Maps states to (a MINIFY_* flag, a pattern for whitespace to collapse in
+# tokens that start in that state, a replacement for matches).
+_MINIFIERS = {
+    STATE_TEXT: (
+        MINIFY_TEXT, lazy_regex.compile(r'[ \t\n\f\r]+'),
+        _collapse_html_space),
+    # Tokens in tags start with any whitespace.
+    STATE_TAG: (
+        MINIFY_CODE, lazy_regex.compile(r'\A\s+(>)?'), _collapse_tag_space),
+    STATE_CSS: (MINIFY_CODE, lazy_regex.compile(r'\s+'), ' '),
+    STATE_JS: (MINIFY_CODE, lazy_regex.compile(r'\s+'), _collapse_js_space),
+    }
+
+
+def _minify_token(text, start, end, prior, replacement, minify):
+    """
+    Collapses whitespace in the token text[start:end] that was lexed after
+    prior and normalized to replacement as by _process_next_token.
+
+    minify - MINIFY_* flags.
+
+    Returns the new replacement for the token.
+    """
+    minifier = _MINIFIERS.get(state_of(prior))
+    if minifier is None:
+        return replacement
+    flag, pattern, collapse = minifier
+    if not minify & flag:
+        return replacement
+    if replacement is None:
+        replacement = text[start:end]
+        minified = pattern.sub(collapse, replacement)
+        if minified == replacement:
+            return None
+        return minified
+    return pattern.sub(collapse, replacement)
+
+
+# The characters that escape_html_sq_only or escape_html_dq_only encode.
+# Raw attribute value text without them decodes to itself and is not changed
+# by re-encoding.
+_ATTR_VALUE_SPECIAL = lazy_regex.compile(r'[\x00&"\x27+<>`]')
+
+
+def _copy_attr_value(raw_text, copied, raw_start, raw_end,
+                     value, start, end, escaper, normalized):
+    """
+    Appends the encoded form of value[start:end], the decoded text of
+    raw_text[raw_start:raw_end], to normalized unless that is raw_text's own
+    text.
+
+    copied - as for _lex or None if raw_start is None.
+    raw_start, raw_end - None if value[start:end] does not start or end on
+        the boundary of an entity.
+
+    Returns the updated copied.
+    """
+    if (raw_start is not None and raw_end is not None
+        and not _ATTR_VALUE_SPECIAL.search(raw_text, raw_start, raw_end)):
+        # raw_text[copied:raw_end] is unchanged.
+        return copied
+    if raw_start is not None:
+        normalized.append(raw_text[copied:raw_start])
+    normalized.append(escaper(value[start:end]))
+    return raw_end
+
+
+class _AttrValueOffsets(object):
+    """
+    Maps offsets into the decoded text of an attribute value to offsets into
+    the raw text.
+    """
+
+    def __init__(self, raw_pos, entities):
+        """
+        raw_pos - the start of the attribute value in the raw text.
+        entities - as from html.unescape_html_with_offsets.
+        """
+        self.raw_pos = raw_pos
+        self.starts = [entity[0] for entity in entities]
+        self.ends = [entity[1] for entity in entities]
+        self.raw_ends = [entity[2] for entity in entities]
+
+    def raw(self, pos):
+        """
+        The offset in the raw text of pos in the decoded text, or None if pos
+        is inside the text an entity decoded to.
+        """
+        i = bisect.bisect_right(self.ends, pos)
+        if i < len(self.starts) and self.starts[i] < pos:
+            return None
+        if i == 0:
+            return self.raw_pos + pos
+        return self.raw_ends[i - 1] + pos - self.ends[i - 1]
+
+
+class TransferSummary(object):
+    """
+    The transfer function of a chunk of raw text: the result of
+    process_raw_text for each start context that it has been extended to.
+
+    Runs of the lexer from different start contexts usually converge quickly,
+    e.g. at the end of the first tag, after which they lex the rest of the
+    text identically.  Each run records the (position, context) checkpoints
+    that it passes, and a later run stops at the first checkpoint it reaches
+    and shares the rest of the earlier run's outcome, so the text is lexed
+    once plus the prefixes on which runs diverge.
+
+    Runs may also cover just a piece of raw_text: from start to the first
+    token boundary at or after stop, which end_position gives.  The
+    normalized text is then that of the piece, but lexed in the context of
+    all of raw_text, so it is what process_raw_text would produce for the
+    piece when the run from start_context reaches start.
+
+    If raw_text is only a prefix of the text, limit is as for _lex_step and
+    runs that reach a token which limit prevents lexing stop without an
+    outcome: start_contexts omits them and end_position gives None.
+    """
+
+    def __init__(self, raw_text, start_contexts=(), start=0, stop=None,
+                 limit=None):
+        self.raw_text = raw_text
+        self.start = start
+        self.stop = stop
+        self.limit = limit
+        # Maps start contexts of runs that lexed to the end, or to an error,
+        # to outcomes as stored in PROCESS_RAW_TEXT_CACHE.
+        self._outcomes = {}
+        # Maps start contexts of runs that lexed to the end to where they
+        # stopped.
+        self._ends = {}
+        # Maps start contexts of runs that reached a checkpoint of an earlier
+        # run to (normalized text before the checkpoint, the start context of
+        # the earlier run, the offset of the checkpoint in its normalized
+        # text).
+        self._joins = {}
+        # Maps pos << 16 | context for each checkpoint passed to
+        # offset << 16 | start context, where offset is the position in the
+        # normalized text of the run from start context corresponding to pos.
+        self._checkpoints = {}
+        # Start contexts of runs that stopped at the limit.
+        self._incomplete = set()
+        self.extend(start_contexts)
+
+    def extend(self, start_contexts):
+        """Computes the transfer function for the given start contexts."""
+        for start_context in start_contexts:
+            if (start_context not in self._outcomes
+                and start_context not in self._joins
+                and start_context not in self._incomplete):
+                self._run(start_context)
+
+    def start_contexts(self):
+        """The start contexts for which the transfer function is known."""
+        return sorted(set(self._outcomes) | set(self._joins))
+
+    def process(self, start_context):
+        """
+        Equivalent to process_raw_text(self.raw_text, start_context) but
+        reuses work done for other start contexts.
+        """
+        self.extend((start_context,))
+        result, failure = self._outcome(start_context)
+        if failure is not None:
+            raise failure
+        return result
+
+    def end_position(self, start_context):
+        """
+        Where the run from start_context stopped: len(raw_text) unless stop
+        was given.  None if the run ended in an error or at the limit.
+        """
+        self.extend((start_context,))
+        while start_context in self._joins:
+            start_context = self._joins[start_context][1]
+        return self._ends.get(start_context)
+
+    def _outcome(self, start_context):
+        """The outcome for a start context that the summary covers."""
+        outcome = self._outcomes.get(start_context)
+        if outcome is not None:
+            return outcome
+        prefix, joined_context, offset = self._joins[start_context]
+        result, failure = self._outcome(joined_context)
+        if failure is not None or result[1] is None:
+            # Runs that share a checkpoint fail the same way.
+            return result, failure
+        end_context, normalized, _, _ = result
+        return (end_context, prefix + normalized[offset:], None, None), None
+
+    def _run(self, start_context):
+        """Lexes from start_context until the end or a known checkpoint."""
+        assert 0 <= start_context < 1 << 16
+        raw_text = self.raw_text
+        checkpoints = self._checkpoints
+        start = self.start
+        end = len(raw_text)
+        stop = end if self.stop is None else self.stop
+        normalized = []
+        # (checkpoint key, len(normalized), pos - copied) for each checkpoint
+        # passed.
+        passed = []
+        pos, context, copied = start, start_context, start
+        searches = {}
+        outcome = None
+        try:
+            while True:
+                key = pos << 16 | context
+                joined = checkpoints.get(key)
+                if joined is not None:
+                    normalized.append(raw_text[copied:pos])
+                    self._joins[start_context] = (
+                        ''.join(normalized), joined & 0xffff, joined >> 16)
+                    break
+                passed.append((key, len(normalized), pos - copied))
+                if pos >= stop:
+                    if normalized:
+                        normalized.append(raw_text[copied:pos])
+                        text = ''.join(normalized)
+                    elif start == 0 and pos == end:
+                        text = raw_text
+                    else:
+                        text = raw_text[start:pos]
+                    outcome = ((context, text, None, None), None)
+                    self._ends[start_context] = pos
+                    break
+                prior_context, prior_pos = context, pos
+                step = _lex_step(
+                    raw_text, pos, end, context, normalized, copied, searches,
+                    self.limit)
+                if step is None:
+                    # Its checkpoints are not recorded since runs that join
+                    # it would stop at the limit too.
+                    self._incomplete.add(start_context)
+                    return
+                pos, context, copied = step
+                if is_error_context(context):
+                    outcome = ((context, None, prior_context,
+                                raw_text[prior_pos:]), None)
+                    break
+        except ContextUpdateFailure, failure:
+            outcome = (None, failure)
+        if outcome is not None:
+            self._outcomes[start_context] = outcome
+        # Record checkpoints with their offsets in the normalized text.
+        offsets = [0]
+        for chunk in normalized:
+            offsets.append(offsets[-1] + len(chunk))
+        for key, index, delta in passed:
+            checkpoints[key] = (offsets[index] + delta) << 16 | start_context
+
+
+# How far into a piece speculative runs record checkpoints at which the run
+# from the previous piece can join them.
+_PARALLEL_WINDOW = 4096
+# How much text past the end of a piece a worker gets so that runs can
+# finish the token at the end of the piece.  Runs through longer tokens
+# stop short, and that piece is lexed sequentially instead.
+_PARALLEL_LOOKAHEAD = 1 << 16
+# How much text before a piece a worker gets for patterns that look behind
+# their start, e.g. the \b in \burl(.
+_PARALLEL_LOOKBEHIND = 16
+
+# The pool that _process_raw_text_in_parallel reuses as
+# [pool, number of processes, id of the process that made it], or empty
+# until first use.
+_PARALLEL_POOL = []
+_PARALLEL_POOL_LOCK = threading.Lock()
+
+
+def _parallel_pool(processes):
+    """The pool of processes to lex pieces in, made on first use."""
+    import multiprocessing
+    with _PARALLEL_POOL_LOCK:
+        if _PARALLEL_POOL[1:] != [processes, os.getpid()]:
+            # PARALLEL_PROCESSES changed, or this process was forked from
+            # the one whose workers the pool talks to.
+            _close_parallel_pool()
+            _PARALLEL_POOL[:] = [
+                multiprocessing.Pool(processes), processes, os.getpid()]
+        return _PARALLEL_POOL[0]
+
+
+def close_parallel_pool():
+    """
+    Stops the processes that process_raw_text keeps to lex long texts
+    when PARALLEL_THRESHOLD is set.  They are started again when needed.
+    """
+    with _PARALLEL_POOL_LOCK:
+        _close_parallel_pool()
+
+
+def _close_parallel_pool():
+    """close_parallel_pool with _PARALLEL_POOL_LOCK held."""
+    if _PARALLEL_POOL:
+        pool, _, pid = _PARALLEL_POOL
+        del _PARALLEL_POOL[:]
+        if pid == os.getpid():
+            pool.terminate()
+            pool.join()
+
+
+def _process_raw_text_in_parallel(raw_text, context):
+    """
+    Like _process_raw_text but splits raw_text into pieces at line breaks
+    and lexes each piece in a pool of processes from each of
+    PARALLEL_START_CONTEXTS, or from context for the first piece.
+
+    The runs are stitched together like a parallel DFA run: lexing proceeds
+    sequentially but whenever it reaches a (position, context) that a run
+    for the current piece passed through, it skips to the end of that run
+    since the run lexed the rest of the piece exactly as a sequential run
+    would.  So the result is identical to that of _process_raw_text.
+
+    The pool is made on first use and kept, since starting processes costs
+    more than lexing a few megabytes, and each worker is sent only its piece
+    and the text around it that its runs may look at.
+
+    Returns None if no pool of processes is available or it fails.
+    """
+    try:
+        import multiprocessing
+        processes = PARALLEL_PROCESSES or multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return None
+    end = len(raw_text)
+    bounds = [0]
+    for index in xrange(1, processes):
+        bound = raw_text.find('\n', max(bounds[-1], index * end // processes))
+        if bound < 0 or bound + 1 >= end:
+            break
+        bounds.append(bound + 1)
+    bounds.append(end)
+    if len(bounds) < 3:
+        return None
+    jobs = []
+    for index in xrange(len(bounds) - 1):
+        start, stop = bounds[index], bounds[index + 1]
+        offset = max(0, start - _PARALLEL_LOOKBEHIND)
+        piece_end = min(end, stop + _PARALLEL_LOOKAHEAD)
+        jobs.append((
+            raw_text[offset:piece_end], offset, start, stop, piece_end == end,
+            PARALLEL_START_CONTEXTS if index else (context,)))
+    try:
+        pieces = _parallel_pool(processes).map(_lex_piece, jobs)
+    except Exception:
+        # E.g. processes cannot be started here, or a worker died.
+        # The text is lexed sequentially instead.
+        close_parallel_pool()
+        return None
+
+    normalized = []
+    pos, copied = 0, 0
+    searches = {}
+    piece = 0
+    while pos < end:
+        while piece + 2 < len(bounds) and bounds[piece + 1] <= pos:
+            piece += 1
+        runs, joins, checkpoints = pieces[piece]
+        joined = checkpoints.get(pos << 16 | context)
+        if joined is not None:
+            text, run_end, context = _piece_run(
+                raw_text, bounds[piece], runs, joins, joined & 0xffff)
+            if text is not None:
+                normalized.append(raw_text[copied:pos])
+                normalized.append(text[joined >> 16:])
+                copied = run_end
+            pos = run_end
+            continue
+        prior_context, prior_pos = context, pos
+        pos, context, copied = _lex_step(
+            raw_text, pos, end, context, normalized, copied, searches, None)
         if is_error_context(context):
-            return (context, None, prior_context, prior_raw_text)
-    return (context, normalized.getvalue(), None, None)
+            return (context, None, prior_context, raw_text[prior_pos:])
+    if not normalized:
+        return (context, raw_text, None, None)
+    normalized.append(raw_text[copied:])
+    return (context, ''.join(normalized), None, None)
+
+
+def _lex_piece(job):
+    """
+    Lexes a piece of the raw text in a worker process.
+
+    job - (text, the position of text in the raw text, start, stop,
+        True iff text runs to the end of the raw text, start contexts) where
+        start and stop are positions in the raw text as for TransferSummary.
+
+    Returns (runs, joins, checkpoints) where runs maps start contexts of runs
+    that lexed the piece without error to (end position, end context,
+    normalized text or None if unchanged), joins maps start contexts that
+    joined another run to (normalized text up to the join, its start context,
+    offset) and checkpoints is as for TransferSummary, but only for the start
+    of the piece and for runs without errors.  Positions are in the raw text.
+    """
+    text, offset, start, stop, at_end, start_contexts = job
+    limit = None if at_end else len(text) - _TRACKER_LOOKAHEAD
+    summary = TransferSummary(
+        text, start_contexts, start - offset, stop - offset, limit)
+    runs = {}
+    for start_context, (result, failure) in summary._outcomes.iteritems():
+        if failure is None and result[1] is not None:
+            end_pos = summary._ends[start_context]
+            normalized = result[1]
+            if normalized == text[start - offset:end_pos]:
+                normalized = None
+            runs[start_context] = (end_pos + offset, result[0], normalized)
+    joins = {}
+    for start_context, join in summary._joins.iteritems():
+        joined_context = join[1]
+        while joined_context in summary._joins:
+            joined_context = summary._joins[joined_context][1]
+        if joined_context in runs:
+            joins[start_context] = join
+    checkpoints = {}
+    for key, value in summary._checkpoints.iteritems():
+        key += offset << 16
+        if key >> 16 < start + _PARALLEL_WINDOW and (
+            (value & 0xffff) in runs or (value & 0xffff) in joins):
+            checkpoints[key] = value
+    return runs, joins, checkpoints
+
+
+def _piece_run(raw_text, start, runs, joins, start_context):
+    """
+    Returns (normalized text or None if unchanged, end position,
+    end context) for the run from start_context as returned by _lex_piece.
+    """
+    if start_context in runs:
+        end_pos, end_context, text = runs[start_context]
+        return text, end_pos, end_context
+    prefix, joined_context, offset = joins[start_context]
+    text, end_pos, end_context = _piece_run(
+        raw_text, start, runs, joins, joined_context)
+    if text is None:
+        text = raw_text[start:end_pos]
+    return prefix + text[offset:], end_pos, end_context
+
+
+# How far past the end of a token the lexer may need to look to be sure of
+# it, e.g. to tell "<!doctype" from "<!d" or "</script>" from "</scrip".
+_TRACKER_LOOKAHEAD = 32
+
+
+class ContextTracker(object):
+    """
+    Propagates context across HTML/CSS/JS that arrives in chunks which may
+    split tokens, e.g. "<scr" then "ipt>", giving the same context and
+    normalized text as process_raw_text on the concatenation of the chunks.
+
+        tracker = ContextTracker(STATE_TEXT)
+        for chunk in chunks:
+            out.write(tracker.feed(chunk))
+        out.write(tracker.close())
+
+    Text is held back only until what follows cannot change how it is lexed,
+    so memory use is bounded by the longest tag or attribute value instead
+    of the size of the stream.  Long runs of text, comments and style sheets
+    are lexed in pieces.
+
+    str and unicode chunks may be mixed.  A str that is not ASCII is then
+    read one character per byte, as the lexer reads any str.
+
+    A tracker made with normalize=False only propagates context, as for
+    end_context, and feed and close return None.
+    """
+
+    def __init__(self, context=STATE_TEXT, normalize=True):
+        # The context after the text lexed so far.
+        self.context = context
+        # True to compute normalized text.
+        self.normalize = normalize
+        # Text fed but not yet lexed.
+        self._pending = ''
+        # The length of pending text that could not be lexed at all.
+        # Lexing is not retried until the pending text has doubled so that
+        # a long token fed in small chunks is not rescanned for each chunk.
+        self._stalled = 0
+
+    def feed(self, chunk):
+        """
+        Lexes as much of the text fed so far as can be lexed without knowing
+        what follows.
+        Returns the normalized text for the portion lexed.
+
+        Raises ContextUpdateFailure if the text reaches an error context.
+        """
+        pending = self._pending
+        if type(pending) is not type(chunk) and pending and chunk:
+            # str + unicode decodes the str as ASCII.
+            if type(pending) is str:
+                pending = pending.decode('latin-1')
+            else:
+                chunk = chunk.decode('latin-1')
+        text = pending + chunk
+        if len(text) < 2 * self._stalled:
+            self._pending = text
+            return '' if self.normalize else None
+        normalized = self._lex(text, len(text) - _TRACKER_LOOKAHEAD)
+        if len(self._pending) == len(text):
+            self._stalled = len(text)
+        else:
+            self._stalled = 0
+        return normalized
+
+    def close(self):
+        """
+        Lexes the remaining text as the end of the stream.
+        Returns the normalized text for it.
+
+        Raises ContextUpdateFailure if the text reaches an error context.
+        """
+        self._stalled = 0
+        return self._lex(self._pending, None)
+
+    def _lex(self, text, limit):
+        """
+        Lexes text in self.context up to limit as for _process_next_token,
+        keeping the rest pending.
+        """
+        normalized = [] if self.normalize else None
+        pos, context, copied, error = _lex(
+            text, 0, self.context, normalized, 0, {}, limit)
+        if error is None and limit is not None and pos < limit:
+            # Text, comments and style sheets without tags can be one token
+            # that never ends before the limit.  Its start is lexed now so
+            # that the pending text does not grow with the stream.
+            split = _split_token(text, pos, limit, context)
+            if split is not None:
+                cut, replacement = split
+                if normalized is not None and replacement is not None:
+                    normalized.append(text[copied:pos])
+                    normalized.append(replacement)
+                    copied = cut
+                pos = cut
+        self.context = context
+        if error is not None:
+            self._pending = ''
+            prior_context, prior_pos = error
+            raise ContextUpdateFailure('bad content in %s: `%s`' % (
+                debug.context_to_string(prior_context), text[prior_pos:]))
+        self._pending = text[pos:]
+        if normalized is None:
+            return None
+        normalized.append(text[copied:pos])
+        return ''.join(normalized)
+
+
+def _split_token(text, pos, limit, context):
+    """
+    Splits the token at pos in text, which ends after limit, so that the
+    part before limit can be lexed now.  The split is made only where
+    lexing text[cut:] in context finds a token that ends at the same
+    place, in the same context and with the same normalized text as the
+    token at pos.
+
+    Returns (cut, normalized text for text[pos:cut] or None if it is
+    unchanged) or None if the token cannot be split.
+    """
+    if delim_type_of(context) != DELIM_NONE:
+        # Attribute values are decoded as a whole.
+        return None
+    finder = _token_finder(context)
+    transition, match = finder.find(text, pos, len(text), context, {})
+    if transition is None:
+        return None
+    if match.start() > pos:
+        # Text before the match is consumed with it.
+        cut = min(limit, match.start())
+    else:
+        # A run of characters like [^<]+.
+        cut = limit
+    hazard = _split_hazard(text, pos, cut, finder, transition)
+    if hazard is not None:
+        # E.g. "url" and spaces in CSS may be the start of "url  (".
+        cut = hazard
+    if cut <= pos:
+        return None
+    rest = text[cut:]
+    rest_transition, rest_match = finder.find(rest, 0, len(rest), context, {})
+    if (rest_transition is not transition
+        or cut + rest_match.end() != match.end()
+        or (transition.compute_next_context(context, match)
+            != transition.compute_next_context(context, rest_match))):
+        return None
+    replacement = transition.raw_text(match)
+    rest_replacement = transition.raw_text(rest_match)
+    if replacement is None or rest_replacement is None:
+        if replacement is not rest_replacement:
+            return None
+        return cut, None
+    if not replacement.endswith(rest_replacement):
+        return None
+    return cut, replacement[:len(replacement) - len(rest_replacement)]
+
+
+def _split_hazard(text, pos, cut, finder, transition):
+    """
+    The earliest position in text[pos:cut] at which a transition of finder
+    other than transition, the one that lexes the token at pos, would match
+    a token that does not end within text if one more character followed,
+    or None.  Such a token can be longer than _TRACKER_LOOKAHEAD, as for
+    r'url\s*\(', so text from there on must not be lexed yet.
+    """
+    end = len(text) - pos
+    hazard = None
+    for probe in _split_probes(finder):
+        probed = text[pos:] + probe
+        for other in finder.transitions:
+            if other is transition:
+                continue
+            start = 0
+            bound = cut - pos if hazard is None else hazard - pos
+            while start < bound:
+                match = other.pattern.search(probed, start)
+                if match is None or match.start() >= bound:
+                    break
+                if match.end() > end:
+                    hazard = pos + match.start()
+                    break
+                start = match.start() + 1
+    return hazard
+
+
+# Maps _TokenFinders to the characters that _split_hazard appends to text.
+_SPLIT_PROBES = {}
+
+def _split_probes(finder):
+    """
+    The characters that tokens found by finder may need next: the
+    punctuation in their patterns, a letter, a space and a newline.
+    """
+    probes = _SPLIT_PROBES.get(finder)
+    if probes is None:
+        chars = set('a \n')
+        for transition in finder.transitions:
+            for char in transition.pattern.pattern:
+                if char in _PUNCTUATION:
+                    chars.add(char)
+        probes = _SPLIT_PROBES[finder] = tuple(sorted(chars))
+    return probes
+
+_PUNCTUATION = frozenset('!"#$%&\'()*+,-./:;<=>?@[]^_`{|}~')
 
 
 class ContextUpdateFailure(BaseException):
@@ -5,11 +5,13 @@ Implements the HTML contextual escaping algorithm as defined at
 http://js-quasis-libraries-and-repl.googlecode.com/svn/trunk/safetemplate.html
 """
 
-from autoesc import context, context_update, debug, escaping, trace_analysis
+from autoesc import context, context_update, debug, escaping, lazy_regex, \
+    trace_analysis
 import functools
 
 
-def escape(name_to_body, public_template_names, start_state=context.STATE_TEXT):
+def escape(name_to_body, public_template_names, start_state=context.STATE_TEXT,
+           minify=False):
     """
     name_to_body - maps template names to template bodies.
         A template body is an object that implements
@@ -20,6 +22,9 @@ def escape(name_to_body, public_template_names, start_state=context.STATE_TEXT):
     public_template_names - the names that might be called with an empty
         output buffer in the given start state.
     start_state - the state in which the named templates might be called.
+    minify - true to collapse insignificant whitespace in text nodes as by
+        context_update.minify.  Whitespace in HTML text is kept if any
+        template might contain preformatted text.
 
     A body node is an object that implements
         1. children() -> a series of nodes
@@ -35,7 +40,13 @@ def escape(name_to_body, public_template_names, start_state=context.STATE_TEXT):
     If escape exits with an exception, then it is unsafe to use the templates
     in name_to_body.
     """
-    analyzer = _Analyzer(name_to_body, start_state)
+    minify_flags = 0
+    if minify:
+        minify_flags = context_update.MINIFY_CODE
+        if not _has_preformatted_text(name_to_body.values()):
+            minify_flags |= context_update.MINIFY_TEXT
+
+    analyzer = _Analyzer(name_to_body, start_state, minify=minify_flags)
 
     has_errors = False
 
@@ -66,7 +77,8 @@ class _Analyzer(trace_analysis.Analyzer):
     templates that are used in non-start contexts.
     """
 
-    def __init__(self, name_to_body, start_state, templates=None):
+    def __init__(self, name_to_body, start_state, templates=None,
+                 summaries=None, minify=0):
         trace_analysis.Analyzer.__init__(self)
         # Maps template names to bodies.
         self.name_to_body = name_to_body
@@ -88,6 +100,16 @@ class _Analyzer(trace_analysis.Analyzer):
         self.calls = {}
         # Messages that explain failure to escape.
         self.errors = []
+        # Maps (type, raw text) of text nodes to context_update
+        # TransferSummaries so that text shared by clones of a template
+        # called in many contexts is lexed once.
+        # Shared, not copied, with derived analyzers since summaries do not
+        # depend on any assumptions.
+        if summaries is None:
+            summaries = {}
+        self.summaries = summaries
+        # context_update.MINIFY_* flags for rewritten text nodes.
+        self.minify = minify
 
     def error(self, debug_hint, msg):
         """Queues a message explaining a problem noticed during escaping."""
@@ -103,15 +125,23 @@ class _Analyzer(trace_analysis.Analyzer):
             # Handle text nodes specified by the template author.
             raw_content = step_value.to_raw_content()
             if raw_content is not None:
+                key = (type(raw_content), raw_content)
+                summary = self.summaries.get(key)
+                if summary is None:
+                    summary = context_update.TransferSummary(raw_content)
+                    self.summaries[key] = summary
                 try:
                     end_state, new_content, error_ctx, error_text = (
-                        context_update.process_raw_text(
-                            raw_content, start_state))
+                        summary.process(start_state))
                     if context.is_error_context(end_state):
                         self.error(debug_hint, 'bad content in %s: `%s`' % (
                             debug.context_to_string(error_ctx), error_text))
-                    elif new_content != raw_content:
-                        self.text_values[step_value] = new_content
+                    else:
+                        if self.minify:
+                            new_content = context_update.minify(
+                                new_content, start_state, self.minify)
+                        if new_content != raw_content:
+                            self.text_values[step_value] = new_content
                 except context_update.ContextUpdateFailure, err:
                     self.error(debug_hint, str(err))
                     end_state = context.STATE_ERROR
@@ -263,7 +293,8 @@ class _Analyzer(trace_analysis.Analyzer):
         # Derive an analyzer so we can see if our assumptions hold before
         # committing to them.
         analyzer = _Analyzer(self.name_to_body, self.start_state,
-                             templates=self.templates)
+                             templates=self.templates,
+                             summaries=self.summaries, minify=self.minify)
         end_ctx = body.reduce_traces(start_ctx, analyzer)
 
         if not ctx_filter(end_ctx, analyzer):
@@ -343,6 +374,27 @@ class _Analyzer(trace_analysis.Analyzer):
             self.name_to_body[contextualized_name] = rewrite_node(body)
 
 
+# Matches the start of elements and style properties that preformat text.
+_PREFORMATTED = lazy_regex.compile(
+    r'(?i)<(?:pre|listing|plaintext)(?![a-z\-])|white-space')
+
+
+def _has_preformatted_text(nodes):
+    """
+    True iff the text of any of the given body nodes or their descendants
+    might make HTML text preformatted so that its whitespace is significant.
+    """
+    nodes = list(nodes)
+    while nodes:
+        node = nodes.pop()
+        if hasattr(node, 'to_raw_content'):
+            raw_content = node.to_raw_content()
+            if raw_content is not None and _PREFORMATTED.search(raw_content):
+                return True
+        nodes.extend(node.children())
+    return False
+
+
 def ensure_pipeline_contains(pipeline, to_insert):
     '''
     ensures that an interpolated expression has calls to the functions named
@@ -10,9 +10,9 @@ These sanitization functions correspond to values of the ESC_MODE_* enum
 defined in the context module.
 """
 
-from autoesc import content, context, html
-import json
+from autoesc import content, context, html, lazy_regex, lru
 import re
+import threading
 
 # Encodes HTML special characters.
 ESC_MODE_ESCAPE_HTML = 0
@@ -127,6 +127,10 @@ ESC_MODE_FOR_STATE[context.STATE_JSREGEXP] = ESC_MODE_ESCAPE_JS_REGEX
 ESC_MODE_FOR_STATE[context.STATE_URL] = ESC_MODE_ESCAPE_HTML_ATTRIBUTE
 
 
+# Maps contexts to the result of esc_mode_for_hole.
+# There are fewer than context.CONTEXT_BOUND keys so this is bounded.
+_ESC_MODES_FOR_HOLE = {}
+
 def esc_mode_for_hole(context_before):
     """
     Given a context in which an untrusted value hole appears, computes the
@@ -135,8 +139,17 @@ def esc_mode_for_hole(context_before):
 
     context_before - The input context before the substitution.
 
-    Returns (context after, (escaping_modes...,))
+    Returns (context after, (escaping_modes...,), problem or None)
     """
+    result = _ESC_MODES_FOR_HOLE.get(context_before)
+    if result is None:
+        result = _compute_esc_mode_for_hole(context_before)
+        _ESC_MODES_FOR_HOLE[context_before] = result
+    return result
+
+
+def _compute_esc_mode_for_hole(context_before):
+    """Computes esc_mode_for_hole(context_before) without the memo."""
     ctx = context.force_epsilon_transition(context_before)
     state, url_part = context.state_of(ctx), context.url_part_of(ctx)
     esc_modes = [ESC_MODE_FOR_STATE[state]]
@@ -282,7 +295,7 @@ def escape_html_attribute(value):
 # Optional space, an attr name in group 1,
 # optionally (=, open quote, value in group 2, close quote),
 # optional space.
-_ATTR_NAME_VALUE_PAIR = re.compile(
+_ATTR_NAME_VALUE_PAIR = lazy_regex.compile(
     r'(?s)\A(?:\s*)([0-9A-Za-z\-:]+)(?:\s*=\s*[\"\']?(.*?)[\"\']?)?\s*\Z')
 
 def filter_html_attribute(value):
@@ -393,6 +406,37 @@ def _marshal_json_obj(obj):
     return None
 
 
+# The JSONEncoder and string encoder used by escape_js_value, loaded on first
+# use since importing json compiles regular expressions.
+_JSON_ENCODER = None
+_ENCODE_JSON_STRING = None
+
+def _load_json_encoder():
+    """Loads the JSON encoder on first use."""
+    global _JSON_ENCODER, _ENCODE_JSON_STRING
+    if _JSON_ENCODER is None:
+        import json
+        import json.encoder
+        # One encoder is shared since building one per call costs more than
+        # encoding a short value.  Encoding does not change it.
+        _ENCODE_JSON_STRING = json.encoder.encode_basestring_ascii
+        _JSON_ENCODER = json.JSONEncoder(
+            ensure_ascii=True,  # Encodes JS newlines U+2028 and U+2029
+            check_circular=True,  # Don't allow denial of service via cyclic
+                                  # vals.
+            allow_nan=True,  # NaN is ok in JS.
+            indent=None,
+            default=_marshal_json_obj,
+            separators=(',', ':'))
+        # Could provide default(obj) to convert user-defined classes to dicts.
+
+
+# Matches a close tag that would end a <script> element.
+_SCRIPT_END_TAG = lazy_regex.compile(r'(?i)</script')
+
+_INFINITY = float('inf')
+
+
 def escape_js_value(value):
     """
     Encodes a value as a JavaScript literal.
@@ -403,26 +447,41 @@ def escape_js_value(value):
     Returns a JavaScript code representation of the input.
     """
 
+    value_type = type(value)
+    # Fast paths for common values that give the same output as json.
+    if value is None:
+        return " null "
+    if value_type is bool:
+        if value:
+            return " true "
+        return " false "
+    if value_type in (int, long):
+        return " %d " % value
+    if value_type is float:
+        if value != value:
+            return " NaN "
+        if value == _INFINITY:
+            return " Infinity "
+        if value == -_INFINITY:
+            return " -Infinity "
+        return " %r " % value
+    if _JSON_ENCODER is None:
+        _load_json_encoder()
+    if value_type in (str, unicode):
+        return _escape_js_chunk(_ENCODE_JSON_STRING(value))
+
     if isinstance(value, content.TypedContent):
         if value.kind == content.CONTENT_KIND_JS:
             value = value.content
             # We can't allow a value that contains the substring '</script'.
             # We could try to fixup, but that is problematic.
-            if re.search(r'(?i)</script', value):
+            if _SCRIPT_END_TAG.search(value):
                 value = None
             return value
         elif value.kind == content.CONTENT_KIND_JS_STR_CHARS:
             return '"%s"' % escape_js_string(value)
 
-    escaped = json.dumps(
-        value,
-        ensure_ascii=True,  # Encodes JS newlines U+2028 and U+2029
-        check_circular=True,  # Don't allow denial of service via cyclic vals.
-        allow_nan=True,  # NaN is ok in JS.
-        indent=None,
-        default=_marshal_json_obj,
-        separators=(',', ':'))
-    # Could provide default(obj) to convert user-defined classes to dicts.
+    escaped = _JSON_ENCODER.encode(value)
 
     if not len(escaped):  # Paranoia.
         return " null "
@@ -443,6 +502,146 @@ def escape_js_value(value):
     return escaped.replace('<', r'\x3c').replace('>', r'\x3e')
 
 
+# The approximate size of the chunks yielded by escape_js_value_chunks.
+JS_VALUE_CHUNK_SIZE = 1 << 13
+
+# Lists, tuples and dicts that hold at least this many elements at any depth
+# are encoded by escape_js_value_chunks one element at a time.  Smaller ones
+# are encoded in one call to the JSON encoder, which is much faster than
+# json's incremental encoder.
+_JS_VALUE_STREAM_MIN_LEN = 64
+
+
+def escape_js_value_chunks(value, chunk_size=JS_VALUE_CHUNK_SIZE):
+    """
+    Yields strings that concatenate to escape_js_value(value).
+
+    Large lists, tuples and dicts are encoded incrementally, so the memory
+    used depends on chunk_size and the depth of nesting, not on the size of
+    value.  Non-ASCII characters, including the JS newlines U+2028
+    and U+2029, are encoded as in escape_js_value, and '<' and '>' are
+    escaped in each chunk as it is produced.
+
+    If value cannot be encoded, the exception is raised after the chunks
+    before the problem have been yielded.
+    """
+    if not isinstance(value, (list, tuple, dict)):
+        yield escape_js_value(value)
+        return
+    if _JSON_ENCODER is None:
+        _load_json_encoder()
+    is_object = isinstance(value, dict)
+    if is_object:
+        # There is a higher risk that {...} will be interpreted as a block than
+        # that the parentheses will introduce a function call.
+        yield '('
+    buffered = []
+    size = 0
+    for chunk in _iterencode_json(value, set()):
+        buffered.append(chunk)
+        size += len(chunk)
+        if size >= chunk_size:
+            yield _escape_js_chunk(''.join(buffered))
+            buffered = []
+            size = 0
+    if buffered:
+        yield _escape_js_chunk(''.join(buffered))
+    if is_object:
+        yield ')'
+
+
+def _is_streamed(value):
+    """
+    True iff value is a list, tuple or dict that holds, at any depth, at
+    least _JS_VALUE_STREAM_MIN_LEN elements, so that _iterencode_json
+    encodes it one element at a time.
+    Looks at no more than about twice that many elements.
+    """
+    if not isinstance(value, _JSON_CONTAINERS):
+        return False
+    count = 0
+    pending = [value]
+    while pending:
+        container = pending.pop()
+        count += len(container)
+        if count >= _JS_VALUE_STREAM_MIN_LEN:
+            return True
+        if isinstance(container, dict):
+            container = container.itervalues()
+        pending.extend([item for item in container
+                        if isinstance(item, _JSON_CONTAINERS)])
+    return False
+
+_JSON_CONTAINERS = (list, tuple, dict)
+
+
+def _iterencode_json(value, markers):
+    """
+    Yields chunks of the JSON encoding of value.
+
+    markers - The ids of the containers being encoded, to detect cycles.
+    """
+    if not _is_streamed(value):
+        yield _JSON_ENCODER.encode(value)
+        return
+    marker = id(value)
+    if marker in markers:
+        raise ValueError('Circular reference detected')
+    markers.add(marker)
+    encode = _JSON_ENCODER.encode
+    if isinstance(value, dict):
+        separator = ''
+        yield '{'
+        for key, item in value.iteritems():
+            # Encoding a dict with one entry converts the key as json does.
+            if _is_streamed(item):
+                yield separator + encode({key: 0})[1:-2]
+                for chunk in _iterencode_json(item, markers):
+                    yield chunk
+            else:
+                yield separator + encode({key: item})[1:-1]
+            separator = ','
+        yield '}'
+    else:
+        yield '['
+        separator = ''
+        # Elements not yet encoded, which are encoded together since
+        # encoding each separately costs more than encoding a few.
+        run = []
+        for item in value:
+            if _is_streamed(item):
+                if run:
+                    yield separator + encode(run)[1:-1]
+                    separator = ','
+                    run = []
+                yield separator
+                for chunk in _iterencode_json(item, markers):
+                    yield chunk
+                separator = ','
+            else:
+                run.append(item)
+                if len(run) == _JS_VALUE_STREAM_MIN_LEN:
+                    yield separator + encode(run)[1:-1]
+                    separator = ','
+                    run = []
+        if run:
+            yield separator + encode(run)[1:-1]
+        yield ']'
+    markers.remove(marker)
+
+
+def _escape_js_chunk(chunk):
+    """
+    Escapes '<' and '>' in a chunk of JSON so that string content is not
+    interpreted as containing HTML token boundaries.
+    """
+    if '<' in chunk:
+        chunk = chunk.replace('<', r'\x3c')
+    if '>' in chunk:
+        chunk = chunk.replace('>', r'\x3e')
+    return chunk
+
+
 def escape_js_regex(value):
     """
     Escapes characters in the string to make it valid content for a JS regular
@@ -472,16 +671,33 @@ def escape_js_regex(value):
 
 
 # unreserved  = ALPHA / DIGIT / "-" / "." / "_" / "~"
-_NOT_URL_UNRESERVED = re.compile(r"[^0-9A-Za-z\._~\-]+")
+_MATCHER_FOR_ESCAPE_URL = lazy_regex.compile(r"([^0-9A-Za-z\._~\-])")
 
-def _pct_encode(match):
-    """URL encodes octets in value"""
-    value = match.group(0)
-    if type(value) is unicode:
+# Maps each byte to its percent-encoded form.
+_PCT_ENCODED_BYTES = dict([(chr(byte), '%%%02x' % byte)
+                           for byte in xrange(0x100)])
+
+def _pct_encode(matcher, value):
+    """
+    Percent-encodes the UTF-8 bytes of each character matched by matcher,
+    a pattern with one group that matches one character.
+
+    Returns value itself when there is nothing to encode.  Otherwise value
+    is encoded to UTF-8 once and the matched bytes are looked up in
+    _PCT_ENCODED_BYTES in one list comprehension.
+    """
+    if not matcher.search(value):
+        return value
+    is_unicode = type(value) is unicode
+    if is_unicode:
         value = value.encode('UTF-8')
-    if len(value) == 1:
-        return '%%%02x' % ord(value)
-    return "".join(["%%%02x" % ord(char) for char in value])
+    parts = matcher.split(value)
+    parts[1::2] = [_PCT_ENCODED_BYTES[byte] for byte in parts[1::2]]
+    encoded = ''.join(parts)
+    if is_unicode:
+        # Only ASCII remains.
+        return unicode(encoded)
+    return encoded
 
 def escape_url(value):
     """
@@ -501,7 +717,7 @@ def escape_url(value):
     if type(value) not in (str, unicode):
         value = str(value)
 
-    return _NOT_URL_UNRESERVED.sub(_pct_encode, value)
+    return _pct_encode(_MATCHER_FOR_ESCAPE_URL, value)
 
 
 
@@ -522,8 +738,10 @@ def escape_url(value):
 # They are technically special in URIs, but only appear in the obsolete mark
 # production in Appendix D.2 of RFC 3986, so can be encoded without changing
 # semantics.
-_NOT_URL_UNRESERVED_AND_SPECIAL = re.compile(
-    r"(?:[^0-9A-Za-z\._~:/?#\[\]@!$&*+,;=%\-]|%(?![0-9A-Fa-f]{2}))+")
+_URL_NOT_UNRESERVED_OR_SPECIAL_CHAR = r"[^0-9A-Za-z\._~:/?#\[\]@!$&*+,;=%\-]"
+
+_MATCHER_FOR_NORMALIZE_URL = lazy_regex.compile(
+    r"(%s|%%(?![0-9A-Fa-f]{2}))" % _URL_NOT_UNRESERVED_OR_SPECIAL_CHAR)
 
 def normalize_url(value):
     """
@@ -541,7 +759,7 @@ def normalize_url(value):
     if type(value) not in (str, unicode):
         value = str(value)
 
-    return _NOT_URL_UNRESERVED_AND_SPECIAL.sub(_pct_encode, value)
+    return _pct_encode(_MATCHER_FOR_NORMALIZE_URL, value)
 
 
 def filter_url(value):
@@ -645,13 +863,14 @@ def filter_css_value(value):
             return decoded
     return 'zSafehtmlz'
 
-_CSS_VALUE_DISALLOWED = re.compile(r'[\0"\'()/;@\[\\\]`{}<]|--')
+_CSS_VALUE_DISALLOWED = lazy_regex.compile(r'[\0"\'()/;@\[\\\]`{}<]|--')
 
-_CSS_IDENT_DISALLOWED = re.compile(r'(?i)\A(?:expression|(moz)?binding)')
+_CSS_IDENT_DISALLOWED = lazy_regex.compile(
+    r'(?i)\A(?:expression|(moz)?binding)')
 
-_NOT_ALPHANUMERIC = re.compile(r'[^A-Za-z0-9]+')
+_NOT_ALPHANUMERIC = lazy_regex.compile(r'[^A-Za-z0-9]+')
 
-_CSS_ESC = re.compile(r'\\([0-9A-Fa-f]+)[\t\n\f\r ]?')
+_CSS_ESC = lazy_regex.compile(r'\\([0-9A-Fa-f]+)[\t\n\f\r ]?')
 
 
 def _css_decode_one(match):
@@ -662,47 +881,98 @@ def _css_decode_one(match):
     return unichr(int(match.group(1), 16))
 
 
-_ESCAPE_MAP_FOR_HTML = {
-    # The HTML5 parser replaces NULs with the unknown codepoint rune.
-    "\x00": "&#xfffd;",
-    "&": "&amp;",
-    "<": "&lt;",
-    ">": "&gt;",
-    }
+def _escape_html_char(char):
+    """ '<' -> '&#60;' """
+    return '&#%d;' % ord(char)
 
-def _replacer_for_html(match):
-    """A regex replacer"""
-    group = match.group(0)
-    encoded = _ESCAPE_MAP_FOR_HTML.get(group)
-    if encoded is None:
-        encoded = "&#%d;" % ord(group)
-        _ESCAPE_MAP_FOR_HTML[group] = encoded
-    return encoded
 
+def _escape_js_char(char):
+    """ '\u2028' -> '\\u2028' """
+    char_code = ord(char)
+    if char_code < 0x100:
+        return r'\x%02x' % char_code
+    return r'\u%04x' % char_code
 
-_ESCAPE_MAP_FOR_ESCAPE_JS_STRING__AND__ESCAPE_JS_REGEX = {
-    # We do not escape "\x08" to "\\b" since that means word-break in RegExps.
-    "\x09": "\\t",
-    "\x0a": "\\n",
-    "\x0c": "\\f",
-    "\x0d": "\\r",
-    "/": "\\/",
-    "\\": "\\\\",
-    }
 
-def _replacer_for_js(match):
-    """A replacer for characters in JS strings and regular expressions."""
-    group = match.group(0)
-    encoded = _ESCAPE_MAP_FOR_ESCAPE_JS_STRING__AND__ESCAPE_JS_REGEX.get(group)
-    if encoded is None:
-        # "\u2028" -> "\\u2028"
-        char_code = ord(group)
-        if char_code < 0x100:
-            encoded = r'\x%02x' % char_code
-        else:
-            encoded = r'\u%04x' % char_code
-        _ESCAPE_MAP_FOR_ESCAPE_JS_STRING__AND__ESCAPE_JS_REGEX[group] = encoded
-    return encoded
+def _escape_css_char(char):
+    """ '<' -> '\3c ' """
+    return r'\%x ' % ord(char)
+
+
+def _escape_tables(chars, escape_char, special_cases):
+    """
+    Maps str and unicode to a table from each of chars, as a character of
+    that type, to special_cases[char] or escape_char(char).
+    Only characters below U+0100 appear in the str table.
+
+    The tables are built at import and never modified afterwards, so they
+    are safe to share between threads and their size does not depend on
+    the values escaped.
+    """
+    tables = {str: {}, unicode: {}}
+    for char in chars:
+        encoded = special_cases.get(char) or escape_char(char)
+        tables[unicode][char] = encoded
+        if ord(char) < 0x100:
+            tables[str][chr(ord(char))] = encoded
+    return tables
+
+
+# Includes every character matched by the _MATCHER_FOR_*_HTML patterns.
+_ESCAPE_TABLES_FOR_HTML = _escape_tables(
+    u'\x00"&\'+<>`',
+    _escape_html_char,
+    {
+        # The HTML5 parser replaces NULs with the unknown codepoint rune.
+        "\x00": "&#xfffd;",
+        "&": "&amp;",
+        "<": "&lt;",
+        ">": "&gt;",
+        })
+
+# Includes every character matched by the _MATCHER_FOR_*_JS_* patterns
+# outside of escape sequences.
+_ESCAPE_TABLES_FOR_JS = _escape_tables(
+    u'\x00\x08\x09\x0a\x0b\x0c\x0d"$&\'()*+-./:<=>?[\\]^`{|}\x7f\x85'
+    u'\u2028\u2029',
+    _escape_js_char,
+    {
+        # We do not escape "\x08" to "\\b" since that means word-break in
+        # RegExps.
+        "\x09": "\\t",
+        "\x0a": "\\n",
+        "\x0c": "\\f",
+        "\x0d": "\\r",
+        "/": "\\/",
+        "\\": "\\\\",
+        })
+
+# Includes every character matched by _MATCHER_FOR_ESCAPE_CSS_STRING.
+_ESCAPE_TABLES_FOR_CSS = _escape_tables(
+    u'\x00\x08\x09\x0a\x0b\x0c\x0d"&\'()*+/:;<=>@\\`{}\x85\xa0'
+    u'\u2028\u2029',
+    _escape_css_char,
+    {
+        '\\': r'\\',
+        })
+
+
+def _escape_chars(matcher, tables, value):
+    """
+    Replaces each character matched by matcher, a pattern with one group,
+    with its entry in tables.
+
+    Returns value itself when there is nothing to replace.  Otherwise the
+    replacements are looked up in one list comprehension instead of in a
+    call per match.
+    """
+    if not matcher.search(value):
+        return value
+    parts = matcher.split(value)
+    table = tables[type(parts[0])]
+    parts[1::2] = [table[char] for char in parts[1::2]]
+    return parts[0][:0].join(parts)
+
 
 def _replacer_for_js_escs(match):
     """
@@ -715,84 +985,71 @@ def _replacer_for_js_escs(match):
         if ('A' <= esc <= 'Z') or ('a' <= esc <= 'z') or ('0' <= esc <= '9'):
             return group
         group = esc
-    encoded = _ESCAPE_MAP_FOR_ESCAPE_JS_STRING__AND__ESCAPE_JS_REGEX.get(group)
-    if encoded is None:
-        # "\u2028" -> "\\u2028"
-        char_code = ord(group)
-        if char_code < 0x100:
-            encoded = r'\x%02x' % char_code
-        else:
-            encoded = r'\u%04x' % char_code
-        _ESCAPE_MAP_FOR_ESCAPE_JS_STRING__AND__ESCAPE_JS_REGEX[group] = encoded
-    return encoded
-
-_ESCAPE_MAP_FOR_ESCAPE_CSS_STRING = {
-    '\\': r'\\',
-    }
-
-def _replacer_for_css(match):
-    """A regexp replacer."""
-    group = match.group(0)
-    encoded = _ESCAPE_MAP_FOR_ESCAPE_CSS_STRING.get(group)
+    encoded = _ESCAPE_TABLES_FOR_JS[type(group)].get(group)
     if encoded is None:
-        encoded = r'\%x ' % ord(group)
-        _ESCAPE_MAP_FOR_ESCAPE_CSS_STRING[group] = encoded
+        # Any character may follow a backslash, so these are not tabled.
+        encoded = _escape_js_char(group)
     return encoded
 
 
-_MATCHER_FOR_ESCAPE_HTML = re.compile(r'[\x00"&\x27+<>`]')
+_MATCHER_FOR_ESCAPE_HTML = lazy_regex.compile(r'([\x00"&\x27+<>`])')
 
-_MATCHER_FOR_ESCAPE_HTML_SQ_ONLY = re.compile(r'[\x00&\x27+<>`]')
+_MATCHER_FOR_ESCAPE_HTML_SQ_ONLY = lazy_regex.compile(r'([\x00&\x27+<>`])')
 
-_MATCHER_FOR_ESCAPE_HTML_DQ_ONLY = re.compile(r'[\x00&"+<>`]')
+_MATCHER_FOR_ESCAPE_HTML_DQ_ONLY = lazy_regex.compile(r'([\x00&"+<>`])')
 
-_MATCHER_FOR_NORMALIZE_HTML = re.compile(r'[\x00"\x27+<>]')
+_MATCHER_FOR_NORMALIZE_HTML = lazy_regex.compile(r'([\x00"\x27+<>])')
 
-_MATCHER_FOR_ESCAPE_JS_STRING = re.compile(
-    ur'[\x00\x08-\x0d"&\x27+/<=>\\`\x7f\x85\u2028\u2029]')
+_MATCHER_FOR_ESCAPE_JS_STRING = lazy_regex.compile(
+    ur'([\x00\x08-\x0d"&\x27+/<=>\\`\x7f\x85\u2028\u2029])')
 
-_MATCHER_FOR_NORMALIZE_JS_STRING = re.compile(
+_MATCHER_FOR_NORMALIZE_JS_STRING = lazy_regex.compile(
     ur'(?s)(?:\\(.|\Z)|[\n\r\"\'+<=>&\u2028\u2029])')
 
-_MATCHER_FOR_ESCAPE_JS_REGEX = re.compile(
-    ur'[\x00\x08-\x0d"$&-+\--/:<-?\[-^`\x7b-\x7d\x7f\x85\u2028\u2029]')
+_MATCHER_FOR_ESCAPE_JS_REGEX = lazy_regex.compile(
+    ur'([\x00\x08-\x0d"$&-+\--/:<-?\[-^`\x7b-\x7d\x7f\x85\u2028\u2029])')
 
-_MATCHER_FOR_NORMALIZE_JS_REGEX = re.compile(
+_MATCHER_FOR_NORMALIZE_JS_REGEX = lazy_regex.compile(
     # A '*' or '/' at the beginning could turn a /{{.}}/ into a comment.
     ur'(?s)(?:\A[*]|\\(.|\Z)|[\n\r+\"\'/<=>&\u2028\u2029])')
 
-_MATCHER_FOR_ESCAPE_CSS_STRING = re.compile(
-    ur'[\x00\x08-\x0d"&-*/:->+@\\`\x7b\x7d\x85\xa0\u2028\u2029]')
+_MATCHER_FOR_ESCAPE_CSS_STRING = lazy_regex.compile(
+    ur'([\x00\x08-\x0d"&-*/:->+@\\`\x7b\x7d\x85\xa0\u2028\u2029])')
 
-_FILTER_FOR_FILTER_URL = re.compile(
+_FILTER_FOR_FILTER_URL = lazy_regex.compile(
     r'(?i)\A(?:(?:https?|mailto):|[^&:/?#]*(?:[/?#]|\Z))')
 
-_FILTER_FOR_FILTER_HTML_ATTRIBUTE = re.compile(
+_FILTER_FOR_FILTER_HTML_ATTRIBUTE = lazy_regex.compile(
     r'(?i)\A(?:[a-z0-9_$:\-]+|dir=(?:ltr|rtl))\Z')
 
-_FILTER_FOR_FILTER_HTML_ELEMENT_NAME = re.compile(
+_FILTER_FOR_FILTER_HTML_ELEMENT_NAME = lazy_regex.compile(
     r'(?i)\A(?!script|style|title|textarea|xmp|no)[a-z0-9_$:\-]*\Z')
 
 def _escape_html_helper(value):
     """ '<a&gt;' -> '&lt;a&amp;gt;' """
-    return _MATCHER_FOR_ESCAPE_HTML.sub(_replacer_for_html, value)
+    return _escape_chars(
+        _MATCHER_FOR_ESCAPE_HTML, _ESCAPE_TABLES_FOR_HTML, value)
 
 def escape_html_sq_only(value):
     """ Escapes an HTML attribute value for embedding between single quotes."""
-    return _MATCHER_FOR_ESCAPE_HTML_SQ_ONLY.sub(_replacer_for_html, value)
+    return _escape_chars(
+        _MATCHER_FOR_ESCAPE_HTML_SQ_ONLY, _ESCAPE_TABLES_FOR_HTML, value)
 
 def escape_html_dq_only(value):
     """ Escapes an HTML attribute value for embedding between double quotes."""
-    return _MATCHER_FOR_ESCAPE_HTML_DQ_ONLY.sub(_replacer_for_html, value)
+    return _escape_chars(
+        _MATCHER_FOR_ESCAPE_HTML_DQ_ONLY, _ESCAPE_TABLES_FOR_HTML, value)
 
 
 def _normalize_html_helper(value):
     """ '<a&gt;' -> '&lt;a&gt;' """
-    return _MATCHER_FOR_NORMALIZE_HTML.sub(_replacer_for_html, value)
+    return _escape_chars(
+        _MATCHER_FOR_NORMALIZE_HTML, _ESCAPE_TABLES_FOR_HTML, value)
 
 def _escape_js_string_helper(value):
     """ '</script>' -> '\x3c/script\x3e' """
-    return _MATCHER_FOR_ESCAPE_JS_STRING.sub(_replacer_for_js, value)
+    return _escape_chars(
+        _MATCHER_FOR_ESCAPE_JS_STRING, _ESCAPE_TABLES_FOR_JS, value)
 
 def _normalize_js_string_helper(value):
     """ '</script>' -> '\x3c/script\x3e' """
@@ -801,7 +1058,8 @@ def _normalize_js_string_helper(value):
 
 def _escape_js_regex_helper(value):
     """ '</script>' -> '\x3c\x2fscript\x3e' """
-    return _MATCHER_FOR_ESCAPE_JS_REGEX.sub(_replacer_for_js, value)
+    return _escape_chars(
+        _MATCHER_FOR_ESCAPE_JS_REGEX, _ESCAPE_TABLES_FOR_JS, value)
 
 def _normalize_js_regex_helper(value):
     """ '</script>' -> '\x3c/script\x3e' """
@@ -809,7 +1067,8 @@ def _normalize_js_regex_helper(value):
 
 def _escape_css_string_helper(value):
     """ '</style>' -> '\3c \2f style\3e ' """
-    return _MATCHER_FOR_ESCAPE_CSS_STRING.sub(_replacer_for_css, value)
+    return _escape_chars(
+        _MATCHER_FOR_ESCAPE_CSS_STRING, _ESCAPE_TABLES_FOR_CSS, value)
 
 def _filter_html_attribute_helper(value):
     """ Whitelists attribute name=value pairs. """
@@ -824,7 +1083,7 @@ def _filter_element_name_helper(value):
     return "zSafehtmlz"
 
 # Matches all tags, HTML comments, and DOCTYPEs in tag soup HTML.
-_HTML_TAG_REGEX = re.compile(
+_HTML_TAG_REGEX = lazy_regex.compile(
     r'(?i)<(?:!|/?[a-z])(?:[^>\x27"]|"[^"]*"|\x27[^\x27]*\x27)*>')
 
 SANITIZER_FOR_ESC_MODE = [None for _ in xrange(0, _COUNT_OF_ESC_MODES)]
@@ -846,3 +1105,578 @@ SANITIZER_FOR_ESC_MODE[ESC_MODE_NORMALIZE_URL] = normalize_url
 SANITIZER_FOR_ESC_MODE[ESC_MODE_FILTER_URL] = filter_url
 SANITIZER_FOR_ESC_MODE[ESC_MODE_ELIDE] = elide
 SANITIZER_FOR_ESC_MODE[ESC_MODE_OPEN_QUOTE] = open_quote
+
+# Maps sanitizers to their ESC_MODE_*.
+ESC_MODE_FOR_SANITIZER = dict([
+    (sanitizer, esc_mode)
+    for esc_mode, sanitizer in enumerate(SANITIZER_FOR_ESC_MODE)
+    if sanitizer is not None])
+
+
+# Maps ESC_MODE_*s whose sanitizers, given a non-empty string, replace each
+# character in a character class independently of the others, to that
+# character class.  A chain of these is fused into one pass over the value.
+_CHAR_CLASS_FOR_ESC_MODE = {
+    # Without the parentheses around the character class.
+    ESC_MODE_ESCAPE_HTML: _MATCHER_FOR_ESCAPE_HTML.pattern[1:-1],
+    ESC_MODE_ESCAPE_HTML_RCDATA: _MATCHER_FOR_ESCAPE_HTML.pattern[1:-1],
+    ESC_MODE_ESCAPE_HTML_ATTRIBUTE: _MATCHER_FOR_ESCAPE_HTML.pattern[1:-1],
+    ESC_MODE_ESCAPE_JS_STRING: _MATCHER_FOR_ESCAPE_JS_STRING.pattern[1:-1],
+    ESC_MODE_ESCAPE_JS_REGEX: _MATCHER_FOR_ESCAPE_JS_REGEX.pattern[1:-1],
+    ESC_MODE_ESCAPE_CSS_STRING: _MATCHER_FOR_ESCAPE_CSS_STRING.pattern[1:-1],
+    ESC_MODE_ESCAPE_URL: _MATCHER_FOR_ESCAPE_URL.pattern[1:-1],
+    # Also encodes a '%' that does not start an escape sequence, so is only
+    # fused when first in a chain.
+    ESC_MODE_NORMALIZE_URL: _URL_NOT_UNRESERVED_OR_SPECIAL_CHAR,
+    }
+
+# ESC_MODE_*s whose sanitizers look only at ASCII characters and pass other
+# characters through or percent-encode their UTF-8 bytes, so they give the
+# same result on the UTF-8 bytes of a string as on its characters.
+_UTF8_NATIVE_ESC_MODES = frozenset([
+    ESC_MODE_ESCAPE_HTML,
+    ESC_MODE_ESCAPE_HTML_RCDATA,
+    ESC_MODE_ESCAPE_HTML_ATTRIBUTE,
+    ESC_MODE_ESCAPE_URL,
+    ESC_MODE_NORMALIZE_URL,
+    ESC_MODE_FILTER_URL,
+    ESC_MODE_ELIDE,
+    ESC_MODE_OPEN_QUOTE,
+    ])
+
+# Maps ESC_MODE_*s to the kinds of typed content that their sanitizers treat
+# differently from the content's text.
+_CONTENT_KINDS_FOR_ESC_MODE = {
+    ESC_MODE_ESCAPE_HTML: (content.CONTENT_KIND_HTML,),
+    ESC_MODE_ESCAPE_HTML_RCDATA: (content.CONTENT_KIND_HTML,),
+    ESC_MODE_ESCAPE_HTML_ATTRIBUTE: (content.CONTENT_KIND_HTML,),
+    ESC_MODE_FILTER_HTML_ATTRIBUTE: (content.CONTENT_KIND_HTML_ATTR,),
+    ESC_MODE_ESCAPE_JS_STRING: (content.CONTENT_KIND_JS_STR_CHARS,),
+    ESC_MODE_ESCAPE_JS_VALUE: (
+        content.CONTENT_KIND_JS, content.CONTENT_KIND_JS_STR_CHARS),
+    ESC_MODE_ESCAPE_JS_REGEX: (content.CONTENT_KIND_JS_STR_CHARS,),
+    ESC_MODE_FILTER_CSS_VALUE: (content.CONTENT_KIND_CSS,),
+    ESC_MODE_ESCAPE_URL: (content.CONTENT_KIND_URL,),
+    ESC_MODE_FILTER_URL: (content.CONTENT_KIND_URL,),
+    }
+
+# Matches a byte that is part of a multi-byte UTF-8 sequence.
+NON_ASCII_BYTE = lazy_regex.compile(r'[\x80-\xff]')
+
+# The number of tokens whose replacement a fused sanitizer remembers.
+# Tokens are characters, so this covers the text of most values without
+# letting unusual inputs grow the tables without bound.
+_FUSED_TABLE_LIMIT = 1024
+
+# Maps tuples of ESC_MODE_* to sanitizers that apply them all.
+_SANITIZER_FOR_ESC_MODES = {}
+
+# Maps tuples of ESC_MODE_* to sanitizers that read and write UTF-8.
+_UTF8_SANITIZER_FOR_ESC_MODES = {}
+
+# Maps (esc_modes, ...) keys derived from values by _sanitizer_cache_key to
+# sanitized values.  The same names, titles and URLs are often sanitized
+# many times, but a lookup costs about as much as escaping a short string,
+# so this is disabled by default.
+# Use SANITIZER_CACHE.resize(n) to enable it, or SanitizerCacheScope to
+# cache values for one render.
+SANITIZER_CACHE = lru.LruCache(0)
+
+# Values longer than this are sanitized without consulting a cache.
+SANITIZER_CACHE_MAX_LENGTH = 1024
+
+# Holds the caches of the SanitizerCacheScopes that the current thread is in.
+_SCOPES = threading.local()
+
+# Distinguishes a missing cache entry from a sanitized value.
+_MISSING = object()
+
+
+def sanitizer_for_esc_modes(esc_modes):
+    """
+    A function equivalent to applying SANITIZER_FOR_ESC_MODE[esc_mode] for
+    each esc_mode in order, as produced by esc_mode_for_hole.
+
+    Runs of sanitizers that replace characters independently, like
+    (ESC_MODE_ESCAPE_HTML, ESC_MODE_ESCAPE_HTML_ATTRIBUTE), are fused
+    into one pass over the value.
+    Results are memoized in the current SanitizerCacheScope's cache or in
+    SANITIZER_CACHE when enabled.
+    """
+    sanitizer = _SANITIZER_FOR_ESC_MODES.get(esc_modes)
+    if sanitizer is None:
+        esc_modes = tuple(esc_modes)
+        sanitizer = _MemoizedSanitizer(esc_modes, _fuse(esc_modes))
+        _SANITIZER_FOR_ESC_MODES[esc_modes] = sanitizer
+    return sanitizer
+
+
+def utf8_sanitizer_for_esc_modes(esc_modes):
+    """
+    Like sanitizer_for_esc_modes but for output written as UTF-8 bytes:
+    str values are read as UTF-8 and the result is always a str.
+
+    Chains of sanitizers that look only at ASCII, like those for HTML text,
+    attributes and URLs, work on the bytes of str values directly.  Others
+    decode str values that are not all ASCII first.  Either way, malformed
+    UTF-8 is read as U+FFFD as an HTML parser would.
+    """
+    sanitizer = _UTF8_SANITIZER_FOR_ESC_MODES.get(esc_modes)
+    if sanitizer is None:
+        esc_modes = tuple(esc_modes)
+        kinds = None
+        if not _UTF8_NATIVE_ESC_MODES.issuperset(esc_modes):
+            kinds = _CONTENT_KINDS_FOR_ESC_MODE.get(esc_modes[0], ())
+        sanitizer = _Utf8Sanitizer(esc_modes, _fuse(esc_modes), kinds)
+        _UTF8_SANITIZER_FOR_ESC_MODES[esc_modes] = sanitizer
+    return sanitizer
+
+
+class SanitizerCacheScope(object):
+    """
+    Memoizes sanitized values in a cache of its own instead of in
+    SANITIZER_CACHE while the current thread is within a with statement,
+    so that values cached while rendering one page are dropped afterwards:
+
+        with escaping.SanitizerCacheScope(256) as scope:
+            env.execute('main', out)
+        rate = scope.cache.hit_rate()
+    """
+
+    def __init__(self, max_size):
+        # An lru.LruCache whose counters report on the scope.
+        self.cache = lru.LruCache(max_size)
+
+    def __enter__(self):
+        caches = getattr(_SCOPES, 'caches', None)
+        if caches is None:
+            caches = _SCOPES.caches = []
+        caches.append(self.cache)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _SCOPES.caches.remove(self.cache)
+
+
+def _sanitizer_cache_key(esc_modes, value):
+    """
+    A key under which sanitizing value for esc_modes may be cached, or None
+    if value is mutable, unhashable or too long.
+    """
+    value_type = type(value)
+    if value_type in (str, unicode):
+        if len(value) <= SANITIZER_CACHE_MAX_LENGTH:
+            # The type is part of the key since 'foo' == u'foo' but the
+            # sanitized values differ in type.
+            return (esc_modes, value_type, value)
+    elif value_type in _SCALAR_TYPES:
+        return (esc_modes, value_type, value)
+    elif isinstance(value, content.TypedContent):
+        # Sanitizers look only at the kind and the content.
+        text = value.content
+        if (type(text) in (str, unicode)
+            and len(text) <= SANITIZER_CACHE_MAX_LENGTH):
+            return (esc_modes, value.kind, type(text), text)
+    return None
+
+
+class _MemoizedSanitizer(object):
+    """
+    Consults the current cache of sanitized values before calling the
+    sanitizer for a tuple of ESC_MODE_*.
+    """
+
+    def __init__(self, esc_modes, sanitizer):
+        self.esc_modes = esc_modes
+        # Applies the sanitizers for esc_modes without consulting a cache.
+        self.sanitizer = sanitizer
+
+    def __call__(self, value):
+        caches = getattr(_SCOPES, 'caches', None)
+        cache = caches[-1] if caches else SANITIZER_CACHE
+        if not cache.max_size:
+            return self.sanitizer(value)
+        key = _sanitizer_cache_key(self.esc_modes, value)
+        if key is None:
+            return self.sanitizer(value)
+        sanitized = cache.get(key, _MISSING)
+        if sanitized is _MISSING:
+            sanitized = self.sanitizer(value)
+            cache.put(key, sanitized)
+        return sanitized
+
+
+class _Utf8Sanitizer(_MemoizedSanitizer):
+    """
+    Like _MemoizedSanitizer, but reads str values as UTF-8 and returns UTF-8
+    encoded str, which is what is cached.  The sanitizer that it wraps reads
+    a str as one character per byte.
+    """
+
+    def __init__(self, esc_modes, sanitizer, kinds):
+        _MemoizedSanitizer.__init__(self, esc_modes, sanitizer)
+        # None if str values are sanitized as bytes, or else the kinds of
+        # typed content that the first sanitizer treats differently from
+        # text when decoding str text that is not ASCII.
+        self.kinds = kinds
+
+    def __call__(self, value):
+        # The cache is consulted here rather than by wrapping a
+        # _MemoizedSanitizer since a call costs as much as escaping a short
+        # string.
+        caches = getattr(_SCOPES, 'caches', None)
+        cache = caches[-1] if caches else SANITIZER_CACHE
+        key = None
+        if cache.max_size:
+            key = _sanitizer_cache_key(self.esc_modes, value)
+            if key is not None:
+                # Kept apart from the output of sanitizer_for_esc_modes.
+                key = ('UTF-8', key)
+                sanitized = cache.get(key, _MISSING)
+                if sanitized is not _MISSING:
+                    return sanitized
+        if self.kinds is not None:
+            value = _decode_utf8(value, self.kinds)
+        else:
+            value = _repair_utf8(value)
+        sanitized = self.sanitizer(value)
+        if type(sanitized) is not str:
+            if isinstance(sanitized, content.TypedContent):
+                # filter_css_value passes safe CSS through.
+                sanitized = sanitized.content
+            if type(sanitized) is unicode:
+                sanitized = sanitized.encode('UTF-8')
+        if key is not None:
+            cache.put(key, sanitized)
+        return sanitized
+
+
+def _repair_utf8(value):
+    """
+    value, or value with malformed UTF-8 in its str text replaced with the
+    UTF-8 encoding of U+FFFD, as _decode_utf8 would read it.
+    """
+    text = value
+    if isinstance(value, content.TypedContent):
+        text = value.content
+    if type(text) is not str or not NON_ASCII_BYTE.search(text):
+        return value
+    try:
+        text.decode('UTF-8')
+        return value
+    except UnicodeDecodeError:
+        text = text.decode('UTF-8', 'replace').encode('UTF-8')
+    if isinstance(value, content.TypedContent):
+        return content.TypedContent(text, value.kind)
+    return text
+
+
+def _decode_utf8(value, kinds):
+    """
+    value, or value with its str text decoded from UTF-8 if that text is
+    not all ASCII.  Typed content of a kind not in kinds becomes its text,
+    since sanitizers coerce it with str which would fail once decoded.
+    """
+    if type(value) is str:
+        if NON_ASCII_BYTE.search(value):
+            return value.decode('UTF-8', 'replace')
+    elif isinstance(value, content.TypedContent):
+        text = value.content
+        if type(text) is str and NON_ASCII_BYTE.search(text):
+            text = text.decode('UTF-8', 'replace')
+            if value.kind in kinds:
+                return content.TypedContent(text, value.kind)
+            return text
+    return value
+
+
+def escape_many(esc_modes, values):
+    """
+    Like map(sanitizer_for_esc_modes(esc_modes), values) but faster for
+    many values, such as the cells of a table.
+
+    esc_modes - A tuple of ESC_MODE_* as produced by esc_mode_for_hole.
+    values - A sequence of values, or a NumPy array which is read in
+        row-major order.
+
+    Returns a list of the escaped values.
+    Raises what the sanitizer raises for a value that cannot be escaped,
+    as map would, though not necessarily for the first such value.
+    """
+    esc_modes = tuple(esc_modes)
+    sanitizer = sanitizer_for_esc_modes(esc_modes)
+    if hasattr(values, 'ravel') and hasattr(values, 'tolist'):
+        # NumPy arrays convert their elements to the nearest Python types.
+        values = values.ravel().tolist()
+    joinable = _is_joinable(esc_modes, sanitizer)
+    escaped = [None] * len(values)
+    # Maps str and unicode to (indices, non-empty strings of that type).
+    batches = {str: ([], []), unicode: ([], [])}
+    # Maps (type, value) of None, booleans and integers to escaped values.
+    scalars = {}
+    for i, value in enumerate(values):
+        value_type = type(value)
+        if value_type in _BATCH_STRING_TYPES:
+            if value:
+                indices, strings = batches[value_type]
+                indices.append(i)
+                strings.append(value)
+                continue
+        elif joinable and value_type in _BATCH_NUMBER_TYPES:
+            # The sanitizers that can be joined escape str(value).
+            indices, strings = batches[str]
+            indices.append(i)
+            strings.append(str(value))
+            continue
+        elif value_type not in _SCALAR_TYPES:
+            escaped[i] = sanitizer(value)
+            continue
+        key = (value_type, value)
+        if key not in scalars:
+            scalars[key] = sanitizer(value)
+        escaped[i] = scalars[key]
+    for indices, strings in batches.itervalues():
+        if not strings:
+            continue
+        if joinable and len(strings) > 1:
+            strings = _escape_joined(sanitizer.sanitizer, strings)
+        else:
+            strings = [sanitizer(value) for value in strings]
+        for i, value in zip(indices, strings):
+            escaped[i] = value
+    return escaped
+
+
+_BATCH_STRING_TYPES = (str, unicode)
+
+# Types whose values are equal only if they sanitize the same.  Not float,
+# since 0.0 == -0.0.
+_SCALAR_TYPES = (type(None), bool, int, long)
+
+_BATCH_NUMBER_TYPES = (bool, int, long, float)
+
+# Joins strings that escape_many escapes in one pass.  A control character
+# that none of the HTML, JS or CSS escapers replace.
+_BATCH_SEPARATOR = u'\x1f'
+
+
+def escapes_chars_independently(esc_modes):
+    """
+    True iff applying the sanitizers for esc_modes to a non-empty string
+    gives the same result as applying them to each non-empty piece of it
+    and concatenating the results, for pieces split anywhere but within a
+    surrogate pair.
+    """
+    return bool(esc_modes) and all([
+        esc_mode in _CHAR_CLASS_FOR_ESC_MODE
+        # Splitting an escape sequence like %41 changes what it encodes.
+        and esc_mode != ESC_MODE_NORMALIZE_URL
+        for esc_mode in esc_modes])
+
+
+def _is_joinable(esc_modes, sanitizer):
+    """
+    True iff sanitizer, the sanitizer for esc_modes, can be applied to
+    non-empty strings joined on _BATCH_SEPARATOR and then split apart.
+    """
+    return (escapes_chars_independently(esc_modes)
+            and sanitizer(_BATCH_SEPARATOR) == _BATCH_SEPARATOR)
+
+
+def _escape_joined(sanitizer, strings):
+    """
+    Applies sanitizer to each of strings, non-empty strings of one type, in
+    one call on the strings joined on _BATCH_SEPARATOR.
+    """
+    separator = type(strings[0])(_BATCH_SEPARATOR)
+    joined = separator.join(strings)
+    # A string that contains the separator would be split in two.
+    if joined.count(separator) == len(strings) - 1:
+        try:
+            parts = sanitizer(joined).split(separator)
+        except Exception:
+            # Escaped one at a time, the value at fault raises on its own.
+            parts = None
+        if parts is not None and len(parts) == len(strings):
+            return parts
+    return [sanitizer(value) for value in strings]
+
+
+def _fuse(esc_modes):
+    """Builds the sanitizer for sanitizer_for_esc_modes."""
+    sanitizers = [SANITIZER_FOR_ESC_MODE[esc_mode] for esc_mode in esc_modes]
+    # Find the longest run of sanitizers that can be fused.
+    best_start, best_end = 0, 0
+    start = 0
+    while start < len(esc_modes):
+        end = start
+        while (end < len(esc_modes)
+               and esc_modes[end] in _CHAR_CLASS_FOR_ESC_MODE
+               and (end == start or esc_modes[end] != ESC_MODE_NORMALIZE_URL)):
+            end += 1
+        if end - start > best_end - best_start:
+            best_start, best_end = start, end
+        start = max(end, start + 1)
+    if best_end - best_start < 2:
+        if len(sanitizers) == 1:
+            return sanitizers[0]
+        return _SequentialSanitizer(sanitizers)
+    return _FusedSanitizer(
+        sanitizers[:best_start], esc_modes[best_start:best_end],
+        sanitizers[best_end:])
+
+
+class _SequentialSanitizer(object):
+    """Applies sanitizers one after the other."""
+
+    def __init__(self, sanitizers):
+        self.sanitizers = tuple(sanitizers)
+
+    def __call__(self, value):
+        for sanitizer in self.sanitizers:
+            value = sanitizer(value)
+        return value
+
+
+class _FusedSanitizer(object):
+    """
+    Applies head sanitizers, then a run of per-character sanitizers in one
+    pass, then tail sanitizers.
+
+    The fused pass matches runs of characters that some sanitizer in the run
+    replaces, and replaces each with the result of applying the run to that
+    character alone.  That is the same as applying the run to the whole
+    value since each sanitizer in it replaces characters independently.
+    """
+
+    def __init__(self, head, esc_modes, tail):
+        self.head = tuple(head)
+        self.fused = tuple([SANITIZER_FOR_ESC_MODE[esc_mode]
+                            for esc_mode in esc_modes])
+        self.tail = tuple(tail)
+        token, self.prefixes = _fused_token_pattern(esc_modes)
+        self.token_pattern = lazy_regex.compile(token)
+        self.pattern = lazy_regex.compile(u'(?:%s)+' % token)
+        # Replacements for tokens in str and unicode values.  They are kept
+        # apart so that the type of the output matches sequential application.
+        self.tables = {str: {}, unicode: {}}
+
+    def __call__(self, value):
+        for sanitizer in self.head:
+            value = sanitizer(value)
+        value_type = type(value)
+        if value and value_type in (str, unicode):
+            table = self.tables[value_type]
+            def replace(match):
+                """Replaces a run of characters."""
+                run = match.group()
+                try:
+                    # Prefixes of longer tokens are never in the table so
+                    # each character here is a token.
+                    return ''.join([table[char] for char in run])
+                except KeyError:
+                    return self._replace_tokens(run, table)
+            value = self.pattern.sub(replace, value)
+        else:
+            # None, empty strings and typed content get special treatment.
+            for sanitizer in self.fused:
+                value = sanitizer(value)
+        for sanitizer in self.tail:
+            value = sanitizer(value)
+        return value
+
+    def _replace_tokens(self, run, table):
+        """Replaces each token in run, adding replacements to table."""
+        replacements = []
+        for token in self.token_pattern.findall(run):
+            replacement = table.get(token)
+            if replacement is None:
+                replacement = token
+                for sanitizer in self.fused:
+                    replacement = sanitizer(replacement)
+                if (len(table) < _FUSED_TABLE_LIMIT
+                    and token not in self.prefixes):
+                    table[token] = replacement
+            replacements.append(replacement)
+        return ''.join(replacements)
+
+
+def _fused_token_pattern(esc_modes):
+    """
+    A pattern that matches a token that a run of per-character sanitizers
+    replaces, and the set of tokens that start longer tokens.
+    """
+    # sre_parse is imported here since it is only needed to build patterns.
+    import sre_parse
+    import sys
+    char_ranges = []
+    for esc_mode in esc_modes:
+        char_ranges.extend(_char_class_ranges(
+            sre_parse, _CHAR_CLASS_FOR_ESC_MODE[esc_mode], sys.maxunicode))
+    alternatives = []
+    prefixes = set()
+    if sys.maxunicode == 0xffff:
+        # UTF-8 encoders treat a surrogate pair as one character.
+        alternatives.append(u'[\ud800-\udbff][\udc00-\udfff]')
+        prefixes.update([unichr(code_unit)
+                         for code_unit in xrange(0xd800, 0xdc00)])
+    if esc_modes[0] == ESC_MODE_NORMALIZE_URL:
+        # An escape sequence is kept by normalize_url, but later sanitizers
+        # may replace its characters.  A lone '%' is encoded.
+        alternatives.append(u'%[0-9A-Fa-f]{2}')
+        prefixes.add('%')
+        char_ranges.append((ord('%'), ord('%')))
+    char_ranges.sort()
+    merged = []
+    for low, high in char_ranges:
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(high, merged[-1][1]))
+        else:
+            merged.append((low, high))
+    char_class = []
+    for low, high in merged:
+        char_class.append(_class_char(low))
+        if high != low:
+            char_class.append(u'-' + _class_char(high))
+    alternatives.append(u'[%s]' % u''.join(char_class))
+    return u'|'.join(alternatives), frozenset(prefixes)
+
+
+def _char_class_ranges(sre_parse, char_class, max_code_point):
+    """
+    The sorted (low, high) code point ranges matched by a character class
+    pattern like r'[^a-z]'.
+    """
+    [(opcode, items)] = sre_parse.parse(char_class)
+    assert opcode == sre_parse.IN, char_class
+    negate = False
+    ranges = []
+    for item_opcode, arg in items:
+        if item_opcode == sre_parse.NEGATE:
+            negate = True
+        elif item_opcode == sre_parse.LITERAL:
+            ranges.append((arg, arg))
+        elif item_opcode == sre_parse.RANGE:
+            ranges.append(arg)
+        else:
+            raise AssertionError(char_class)
+    ranges.sort()
+    if not negate:
+        return ranges
+    complement = []
+    low = 0
+    for range_low, range_high in ranges:
+        if range_low > low:
+            complement.append((low, range_low - 1))
+        low = max(low, range_high + 1)
+    if low <= max_code_point:
+        complement.append((low, max_code_point))
+    return complement
+
+
+def _class_char(code_point):
+    """A code point escaped for use in a character class."""
+    char = unichr(code_point)
+    if char.isalnum() or code_point >= 0x80:
+        return char
+    return u'\\' + char
@@ -6,29 +6,50 @@ propagates context over safe chunks while picking appropriate escapers
 for untrusted values.
 """
 
-from autoesc import context, context_update, escaping
+from autoesc import context, context_update, escape, escaping
+import codecs
 
 class File(object):
     """
     Wraps a stream to contextually escape untrusted values.
     """
 
-    def __init__(self, underlying, start_context=context.STATE_TEXT):
+    def __init__(self, underlying, start_context=context.STATE_TEXT,
+                 utf8=False):
         """
         underlying - a writable that receives chunks of safe HTML.
+        utf8 - True if underlying receives only UTF-8 encoded str, as a
+            socket does.  str chunks and values are then read as UTF-8.
         """
         self.ctx_ = start_context
         self.underlying_ = underlying
+        # Tracks context across consecutive safe chunks, which may split
+        # tokens, or None after an untrusted value.
+        self.tracker_ = None
+        self.utf8_ = utf8
+        # Decodes safe str chunks, which may split UTF-8 sequences, for the
+        # tracker when they are not all ASCII.
+        self.decoder_ = None
+        if utf8:
+            self.decoder_ = codecs.getincrementaldecoder('UTF-8')('replace')
 
 
     def close(self):
-        """Closes the underlying stream"""
+        """
+        Closes the underlying stream.
+        Raises escape.EscapeError if the safe chunks written last do not
+        lex.
+        """
         # TODO: require that the system end in a proper end-context.
         # E.g., not in the middle of an unclosed quoted string, ...
-        self.underlying_.close()
+        try:
+            self._end_safe()
+        finally:
+            self.underlying_.close()
 
 
     def write(self, *vals):
+        self._end_safe()
         ctx = context.force_epsilon_transition(self.ctx_)
         underlying = self.underlying_
         for val in vals:
@@ -36,24 +57,107 @@ class File(object):
                 escaping.esc_mode_for_hole(ctx)
             )
             if problem is not None:
-                raise AutoescapeError(problem)
+                raise escape.EscapeError(problem)
             ctx = ctx_after
-            for esc_mode in esc_modes:
-                escaper = escaping.SANITIZER_FOR_ESC_MODE[esc_mode]
-                val = escaper(val)
-            underlying.write(val)
+            underlying.write(self._sanitizer(esc_modes)(val))
         self.ctx_ = ctx
 
 
+    def write_js_value(self, val):
+        """
+        Like write(val), but where val is interpolated as a JavaScript value,
+        writes it in chunks as it is encoded, so large lists and dicts
+        embedded in <script> elements are never held as one string.
+        """
+        self._end_safe()
+        ctx = context.force_epsilon_transition(self.ctx_)
+        ctx_after, esc_modes, problem = escaping.esc_mode_for_hole(ctx)
+        if problem is not None:
+            raise escape.EscapeError(problem)
+        rest = esc_modes[1:]
+        if (esc_modes[0] != escaping.ESC_MODE_ESCAPE_JS_VALUE
+            or (rest and not escaping.escapes_chars_independently(rest))):
+            self.write(val)
+            return
+        write = self.underlying_.write
+        if rest:
+            sanitizer = self._sanitizer(rest)
+            for chunk in escaping.escape_js_value_chunks(val):
+                if chunk:
+                    write(sanitizer(chunk))
+        else:
+            for chunk in escaping.escape_js_value_chunks(val):
+                write(chunk)
+        self.ctx_ = ctx_after
+
+
     def write_safe(self, *safe_strs):
-        ctx = self.ctx_
+        """
+        Writes chunks of safe HTML.  Consecutive chunks are treated as one
+        so they may be split at arbitrary points, e.g. "<scr" then "ipt>".
+        Raises escape.EscapeError if the chunks do not lex, which for the end
+        of the chunks may only be known on the next write or close.
+        """
+        tracker = self.tracker_
+        if tracker is None:
+            tracker = context_update.ContextTracker(self.ctx_, False)
+            self.tracker_ = tracker
         underlying = self.underlying_
+        decoder = self.decoder_
         for safe_str in safe_strs:
-            end_ctx, safe_text, before_error, unprocessed = (
-                context_update.process_raw_text(safe_str, ctx))
-            if context.is_error_context(end_ctx):
-                raise AutoescapeError(
-                    safe_text[:-len(unprocessed)], unprocessed)
-            ctx = end_ctx
+            if decoder is None:
+                self._feed(safe_str)
+            elif type(safe_str) is unicode:
+                self._feed(safe_str)
+                safe_str = safe_str.encode('UTF-8')
+            elif (escaping.NON_ASCII_BYTE.search(safe_str)
+                  or decoder.getstate()[0]):
+                # The lexer needs characters to see line terminators like
+                # U+2028.
+                self._feed(decoder.decode(safe_str))
+            else:
+                self._feed(safe_str)
             underlying.write(safe_str)
-        self.ctx_ = ctx
+
+
+    def _feed(self, safe_str):
+        """Feeds safe_str to the tracker."""
+        tracker = self.tracker_
+        try:
+            tracker.feed(safe_str)
+        except context_update.ContextUpdateFailure, err:
+            self.tracker_ = None
+            self.ctx_ = context.STATE_ERROR
+            if self.decoder_ is not None:
+                self.decoder_.reset()
+            raise escape.EscapeError(str(err))
+
+
+    def _sanitizer(self, esc_modes):
+        """The sanitizer for esc_modes for the underlying stream."""
+        if self.utf8_:
+            return escaping.utf8_sanitizer_for_esc_modes(esc_modes)
+        return escaping.sanitizer_for_esc_modes(esc_modes)
+
+
+    def _end_safe(self):
+        """
+        Computes the context after the safe chunks written so far.
+        Raises escape.EscapeError if they do not lex.
+        """
+        tracker = self.tracker_
+        if tracker is not None:
+            if self.decoder_ is not None:
+                # A UTF-8 sequence cut short is decoded to U+FFFD.
+                tail = self.decoder_.decode('', True)
+                if tail:
+                    self._feed(tail)
+            self.tracker_ = None
+            try:
+                tracker.close()
+            except context_update.ContextUpdateFailure, err:
+                self.ctx_ = context.STATE_ERROR
+                raise escape.EscapeError(str(err))
+            self.ctx_ = tracker.context
+        elif context.is_error_context(self.ctx_):
+            raise escape.EscapeError('earlier safe chunks did not lex')
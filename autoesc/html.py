@@ -4,8 +4,7 @@
 HTML5 definitions including a replacement for htmlentitydefs.
 """
 
-from autoesc import content
-import re
+from autoesc import content, lazy_regex
 
 CONTENT_KIND_UNSAFE = -1
 
@@ -167,6 +166,9 @@ def attr_type(attr_name):
 
 ENTITY_NAME_TO_TEXT_ = None
 
+_ENTITY = lazy_regex.compile(
+    '&(?:#(?:[xX]([0-9A-Fa-f]+);|([0-9]+);)|([a-zA-Z0-9]+;?))')
+
 def unescape_html(html):
     """
     Given HTML that would parse to a single text node, returns the text
@@ -175,13 +177,43 @@ def unescape_html(html):
     # Fast path for common case.
     if html.find("&") < 0:
         return html
+    _load_entities()
+    return _ENTITY.sub(_decode_html_entity, html)
+
+
+def unescape_html_with_offsets(html, start=0, end=None):
+    """
+    Like unescape_html(html[start:end]) but also returns where each entity
+    was decoded, as a list of (start in text, end in text, end in html)
+    in order.
+    Outside entities, each character of the text corresponds to one
+    character of html.
+    """
+    if end is None:
+        end = len(html)
+    _load_entities()
+    text = []
+    entities = []
+    copied = start
+    text_len = 0
+    for match in _ENTITY.finditer(html, start, end):
+        text.append(html[copied:match.start()])
+        text_start = text_len + match.start() - copied
+        decoded = _decode_html_entity(match)
+        text.append(decoded)
+        text_len = text_start + len(decoded)
+        copied = match.end()
+        entities.append((text_start, text_len, copied))
+    text.append(html[copied:end])
+    return ''.join(text), entities
+
+
+def _load_entities():
+    """Loads the entity table on first use."""
     global ENTITY_NAME_TO_TEXT_
     if not ENTITY_NAME_TO_TEXT_:
         from autoesc import entities
         ENTITY_NAME_TO_TEXT_ = entities.ENTITY_NAME_TO_TEXT
-    return re.sub(
-        '&(?:#(?:[xX]([0-9A-Fa-f]+);|([0-9]+);)|([a-zA-Z0-9]+;?))',
-        _decode_html_entity, html)
 
 
 def _decode_html_entity(match):
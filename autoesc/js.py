@@ -5,14 +5,49 @@ Utilities for dealing with JavaScript source code.
 """
 
 from autoesc import context
-import re
 
 
 _REGEX_PRECEDER_KEYWORDS = set([
     "break", "case", "continue", "delete", "do", "else", "finally",
     "instanceof", "return", "throw", "try", "typeof"])
 
-def next_js_ctx(js_tokens, ctx):
+# The length of the longest keyword in _REGEX_PRECEDER_KEYWORDS.
+_MAX_KEYWORD_LEN = max([len(kw) for kw in _REGEX_PRECEDER_KEYWORDS])
+
+# Classes of the last significant character in a run of JS tokens.
+# A character that ends a token which precedes a div op, like ')' or ']'.
+_CHAR_DIV = 0
+# A character that ends a token which precedes a regular expression.
+_CHAR_REGEX = 1
+# A '+' or '-' which could be part of an increment or decrement operator.
+_CHAR_SIGN = 2
+# A '.' which could be part of a number.
+_CHAR_DOT = 3
+# A '/' which ends a div op.
+_CHAR_SLASH = 4
+# A character in [\w$] which could end a keyword.
+_CHAR_WORD = 5
+
+
+def _make_char_classes():
+    """Builds _CHAR_CLASSES."""
+    classes = [_CHAR_DIV] * 128
+    for char in '!#%&(*,:;<=>?[^{|}~':
+        classes[ord(char)] = _CHAR_REGEX
+    for char in '+-':
+        classes[ord(char)] = _CHAR_SIGN
+    classes[ord('.')] = _CHAR_DOT
+    classes[ord('/')] = _CHAR_SLASH
+    for char in ('$_0123456789abcdefghijklmnopqrstuvwxyz'
+                 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'):
+        classes[ord(char)] = _CHAR_WORD
+    return tuple(classes)
+
+# Maps the code-unit of an ASCII character to its _CHAR_* class.
+# Non-ASCII characters are all _CHAR_DIV.
+_CHAR_CLASSES = _make_char_classes()
+
+def next_js_ctx(js_tokens, ctx, start=0, end=None):
     """
     True iff a slash after the given run of non-whitespace tokens
     starts a regular expression instead of a div operator : (/ or /=).
@@ -26,11 +61,20 @@ def next_js_ctx(js_tokens, ctx):
 
     js_tokens - A run of non-whitespace, non-comment, non string
     tokens not including the '/' character.  Non-empty.
+    start, end - the run is js_tokens[start:end] so that callers need not
+    slice it out of a larger string.
     """
 
-    js_tokens = js_tokens.strip()
-    if not js_tokens:
+    if end is None:
+        end = len(js_tokens)
+
+    # Skip whitespace around the tokens.
+    while end > start and js_tokens[end - 1].isspace():
+        end -= 1
+    if end == start:
         return ctx
+    while js_tokens[start].isspace():
+        start += 1
 
     # Tokens that precede a regular expression in JavaScript.
     # "!", "!=", "!==", "#", "%", "%=", "&", "&&",
@@ -44,33 +88,42 @@ def next_js_ctx(js_tokens, ctx):
     # "else", "finally", "instanceof", "return",
     # "throw", "try", "typeof"
 
-    js_tokens_len = len(js_tokens)
-    last_char = js_tokens[-1]
-    if last_char == '+' or last_char == '-':
+    last_char = js_tokens[end - 1]
+    code_unit = ord(last_char)
+    char_class = _CHAR_CLASSES[code_unit] if code_unit < 128 else _CHAR_DIV
+    if char_class == _CHAR_REGEX:
+        is_regex = True
+    elif char_class == _CHAR_WORD:
+        # Look for one of the keywords above.
+        word_start = end - 1
+        limit = max(start, end - _MAX_KEYWORD_LEN - 1)
+        while word_start > limit:
+            code_unit = ord(js_tokens[word_start - 1])
+            if code_unit >= 128 or _CHAR_CLASSES[code_unit] != _CHAR_WORD:
+                break
+            word_start -= 1
+        is_regex = js_tokens[word_start:end] in _REGEX_PRECEDER_KEYWORDS
+    elif char_class == _CHAR_SIGN:
         # ++ and -- are not
-        sign_start = js_tokens_len - 1
+        sign_start = end - 1
         # Count the number of adjacent dashes or pluses.
-        while sign_start > 0 and js_tokens[sign_start - 1] == last_char:
+        while sign_start > start and js_tokens[sign_start - 1] == last_char:
             sign_start -= 1
-        num_adjacent = js_tokens_len - sign_start
+        num_adjacent = end - sign_start
         # True for odd numbers since "---" is the same as "-- -".
         # False for even numbers since "----" is the same as "-- --" which ends
         # with a decrement, not a minus sign.
         is_regex = (num_adjacent & 1) == 1
-    elif last_char == '.':
-        if js_tokens_len == 1:
+    elif char_class == _CHAR_DOT:
+        if end - start == 1:
             is_regex = True
         else:
-            after_dot = js_tokens[-2]
+            after_dot = js_tokens[end - 2]
             is_regex = not ("0" <= after_dot <= "9")
-    elif last_char == '/':  # Match a div op, but not a regexp.
-        is_regex = js_tokens_len <= 2
-    elif re.search(r'[!#%&(*,:;<=>?\[^{|}~]', last_char):
-        is_regex = True
+    elif char_class == _CHAR_SLASH:  # Match a div op, but not a regexp.
+        is_regex = end - start <= 2
     else:
-        # Look for one of the keywords above.
-        word = re.search(r'[\w$]+\Z', js_tokens)
-        is_regex = (word and word.group(0)) in _REGEX_PRECEDER_KEYWORDS
+        is_regex = False
     ctx = ctx & ~context.JS_CTX_ALL
     if is_regex:
         ctx = ctx | context.JS_CTX_REGEX
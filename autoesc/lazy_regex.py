@@ -0,0 +1,48 @@
+#!/usr/bin/env python -O
+
+"""
+Regular expressions that are compiled on first use instead of at import time
+so that importing modules with many patterns is cheap.
+"""
+
+import re
+
+# The attributes of compiled patterns that a LazyRegex forwards.
+_FORWARDED = (
+    'findall', 'finditer', 'flags', 'groupindex', 'groups', 'match',
+    'scanner', 'search', 'split', 'sub', 'subn')
+
+
+class LazyRegex(object):
+    """
+    Stands in for the compiled pattern re.compile(pattern, flags).
+    The pattern is compiled when any attribute besides pattern is first used,
+    after which the compiled pattern's attributes are copied onto this
+    object so that later uses cost no more than with the compiled pattern.
+    """
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self._flags = flags
+
+    def compiled(self):
+        """The compiled pattern."""
+        compiled = re.compile(self.pattern, self._flags)
+        for name in _FORWARDED:
+            setattr(self, name, getattr(compiled, name))
+        self.compiled = lambda: compiled
+        return compiled
+
+    def __getattr__(self, name):
+        # Only called for attributes not yet copied from the compiled pattern.
+        if name not in _FORWARDED:
+            raise AttributeError(name)
+        return getattr(self.compiled(), name)
+
+    def __repr__(self):
+        return 'LazyRegex(%r)' % self.pattern
+
+
+def compile(pattern, flags=0):
+    """Like re.compile but compiles pattern on first use."""
+    return LazyRegex(pattern, flags)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python -O
+
+"""
+A bounded, thread-safe least-recently-used cache with hit, miss and eviction
+counters.
+"""
+
+import collections
+import threading
+
+
+class LruCache(object):
+    """
+    Maps keys to values, evicting the least recently used entry once more
+    than max_size entries are stored.
+    A max_size of zero disables caching.
+    """
+
+    def __init__(self, max_size):
+        if max_size < 0:
+            raise ValueError(max_size)
+        self.max_size = max_size
+        # Number of lookups that found an entry.
+        self.hits = 0
+        # Number of lookups that did not find an entry.
+        self.misses = 0
+        # Number of entries dropped to make room for newer ones.
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        The value stored for key, or default if there is none.
+        Marks the entry as most recently used.
+        """
+        with self._lock:
+            entries = self._entries
+            if key in entries:
+                value = entries.pop(key)
+                entries[key] = value
+                self.hits += 1
+                return value
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        """Stores value for key, evicting old entries as necessary."""
+        with self._lock:
+            entries = self._entries
+            entries.pop(key, None)
+            entries[key] = value
+            self._evict_to(self.max_size)
+
+    def resize(self, max_size):
+        """Changes the bound on the number of entries."""
+        if max_size < 0:
+            raise ValueError(max_size)
+        with self._lock:
+            self.max_size = max_size
+            self._evict_to(max_size)
+
+    def clear(self):
+        """Drops all entries and resets the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def hit_rate(self):
+        """The fraction of lookups that found an entry, or 0.0 if none."""
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def _evict_to(self, max_size):
+        """Drops least recently used entries until at most max_size remain."""
+        entries = self._entries
+        while len(entries) > max_size:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
@@ -37,7 +37,7 @@ The set of functions is determined by the environment.  Env().fns is a dict
 mapping function names to the python functions that implement them.
 """
 
-from autoesc import escaping
+from autoesc import escaping, lazy_regex
 from cStringIO import StringIO
 import collections
 import re
@@ -54,17 +54,20 @@ for _builtin_fn in escaping.SANITIZER_FOR_ESC_MODE:
 class Env(object):
     """Templates and the environment in which they can be executed."""
 
-    def __init__(self, data=None, fns=None, templates=None):
+    def __init__(self, data=None, fns=None, templates=None, utf8=False):
         self.data = data
         self.fns = fns or _BUILTIN_FNS
         self.templates = templates or {}
+        # True if output is written as UTF-8 encoded str.
+        self.utf8 = utf8
 
     def with_data(self, data):
         """
         Returns an environment with the same functions and templates but
         with the given data value.
         """
-        return Env(data=data, fns=self.fns, templates=self.templates)
+        return Env(data=data, fns=self.fns, templates=self.templates,
+                   utf8=self.utf8)
 
     def with_fns(self, fns):
         """
@@ -77,7 +80,7 @@ class Env(object):
             fun = fns[name]
             assert isinstance(fun, collections.Callable), name
             all_fns[name] = fun
-        return Env(self.data, all_fns, self.templates)
+        return Env(self.data, all_fns, self.templates, self.utf8)
 
     def execute(self, name, out):
         """
@@ -92,6 +95,23 @@ class Env(object):
         self.execute(name, buf)
         return buf.getvalue()
 
+    def execute_utf8(self, name, out):
+        """
+        Like execute but appends only UTF-8 encoded str to out, so that
+        the output can be written to a socket without encoding it again.
+        str values are treated as UTF-8.
+        """
+        Env(self.data, self.fns, self.templates, True).execute(name, out)
+
+    def sexecute_utf8(self, name):
+        """
+        Returns the result of executing the named template as a UTF-8
+        encoded str.
+        """
+        buf = StringIO()
+        self.execute_utf8(name, buf)
+        return buf.getvalue()
+
     def __str__(self):
         """Returns a form parseable by parse_templates."""
         names = self.templates.keys()
@@ -190,9 +210,17 @@ class _TextNode(Node):
         Node.__init__(self, loc)
         assert type(text) in (str, unicode)
         self.text = text
+        # The text as written by Env.execute_utf8, encoded once here.
+        if type(text) is unicode:
+            self.utf8 = text.encode('UTF-8')
+        else:
+            self.utf8 = text
 
     def execute(self, env, out):
-        out.write(self.text)
+        if env.utf8:
+            out.write(self.utf8)
+        else:
+            out.write(self.text)
 
     def children(self):
         return ()
@@ -232,6 +260,8 @@ class _InterpolationNode(Node):
         if value is not None:
             if type(value) not in (str, unicode):
                 value = str(value)
+            elif env.utf8 and type(value) is unicode:
+                value = value.encode('UTF-8')
             out.write(value)
 
     def children(self):
@@ -295,8 +325,29 @@ class _CallNode(ExprNode):
         self.args = tuple(args)
 
     def evaluate(self, env):
-        return env.fns[self.name](
-            *[arg.evaluate(env) for arg in self.args])
+        fns = env.fns
+        fun = fns[self.name]
+        esc_mode = escaping.ESC_MODE_FOR_SANITIZER.get(fun)
+        if esc_mode is not None and len(self.args) == 1:
+            # Apply a pipeline of sanitizers like
+            # .X | escape_html | escape_html_attribute
+            # with one fused and memoized sanitizer.
+            esc_modes = [esc_mode]
+            arg = self.args[0]
+            while _is_pipe(arg):
+                esc_mode = escaping.ESC_MODE_FOR_SANITIZER.get(fns[arg.name])
+                if esc_mode is None:
+                    break
+                esc_modes.append(esc_mode)
+                arg = arg.args[0]
+            esc_modes.reverse()
+            if env.utf8:
+                sanitizer = escaping.utf8_sanitizer_for_esc_modes(
+                    tuple(esc_modes))
+            else:
+                sanitizer = escaping.sanitizer_for_esc_modes(tuple(esc_modes))
+            return sanitizer(arg.evaluate(env))
+        return fun(*[arg.evaluate(env) for arg in self.args])
 
     def children(self):
         return self.args
@@ -995,9 +1046,9 @@ _LITERAL_VALUES = {
     'False': False,
     }
 
-_INT = re.compile(r'\A[+-]?(0[xX][0-9A-Fa-f]+|0+|[1-9][0-9]*)\Z')
+_INT = lazy_regex.compile(r'\A[+-]?(0[xX][0-9A-Fa-f]+|0+|[1-9][0-9]*)\Z')
 
-_NUMBER = re.compile(
+_NUMBER = lazy_regex.compile(
     r'\A[+-]?('
     # Hex
     r'0[xX][0-9A-Fa-f]+'
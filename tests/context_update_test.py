@@ -4,8 +4,11 @@
 
 from autoesc import content, context, context_update, debug, \
                     escape, escaping, template
+import multiprocessing
+import re
 import sys
 from tests import test_common
+import time
 import unittest
 
 
@@ -584,6 +587,623 @@ class ContextUpdateTest(unittest.TestCase):
                        % (test_input, want_text, got_text)))
 
 
+    def test_token_finder(self):
+        """
+        Checks that the per-state alternations pick the same transitions as
+        searching with each transition's pattern in turn.
+        """
+        snippets = (
+            '', ' ', 'foo', '<', '</', '<!--', '-->', '<b>', '</b>',
+            '<script>', '</script>', '</SCRIPT ', '<style', '</style>',
+            '</title>', '</textarea >', '<!doctype html>', '<3',
+            'a="b"', "c='d'", '=', '/>', '/*', '*/', '//', '\n', '\r\n',
+            u'\u2028', '/[/]/', '\\"', "\\'", '\\', 'url(', 'URL ( "',
+            '?', '#', '\\3f', '%23', 'return /x/', 'x++/y', '1.5/2',
+            )
+        texts = set(snippets)
+        for left in snippets:
+            for right in snippets:
+                texts.add(left + right)
+
+        def brute_force(transitions, text, ctx):
+            """Searches with each transition's pattern in turn."""
+            earliest = (None, None)
+            for transition in transitions:
+                match = transition.pattern.search(text)
+                if (match and (earliest[1] is None
+                               or match.start() < earliest[1].start())
+                    and transition.is_applicable_to(ctx, match)):
+                    earliest = (transition, match)
+            return earliest
+
+        contexts = []
+        for state, transitions in enumerate(context_update._TRANSITIONS):
+            if transitions is None:
+                continue
+            for extra in (0, context.ELEMENT_TITLE, context.ATTR_SCRIPT):
+                contexts.append(state | extra)
+        for ctx in contexts:
+            transitions = context_update._TRANSITIONS[context.state_of(ctx)]
+            finder = context_update._token_finder(ctx)
+            for left in ('', '-->', ' x'):
+                for right in texts:
+                    if left == ' x' and right[:1].isalnum():
+                        # \b at the start position sees the preceding 'x'.
+                        # The lexer never needs to start a token after a
+                        # word character in a state that uses \b.
+                        continue
+                    text = left + right
+                    pos = len(left)
+                    want_transition, want_match = brute_force(
+                        transitions, right, ctx)
+                    got_transition, got_match = finder.find(
+                        text, pos, len(text), ctx, {})
+                    message = '%s %r at %d' % (
+                        debug.context_to_string(ctx), text, pos)
+                    self.assertEquals(
+                        want_transition is None, got_transition is None,
+                        message)
+                    if want_match is not None:
+                        # The finder's transitions are specialized to ctx.
+                        self.assertEquals(
+                            want_transition.compute_next_context(
+                                ctx, want_match),
+                            got_transition.compute_next_context(
+                                ctx, got_match), message)
+                        self.assertEquals(
+                            want_transition.raw_text(want_match),
+                            got_transition.raw_text(got_match), message)
+                        start, end = want_match.span()
+                        self.assertEquals(
+                            ((start + pos, end + pos), want_match.groups()),
+                            (got_match.span(), got_match.groups()), message)
+                        self.assertEquals(pos, got_match.pos, message)
+
+    def test_token_finder_specialization(self):
+        """
+        Tests that token finders leave out transitions that cannot apply in
+        their context and are shared between contexts.
+        """
+        in_script = context.STATE_JS | context.ELEMENT_SCRIPT
+        in_attr = context.STATE_JS | context.ATTR_SCRIPT | \
+            context.DELIM_DOUBLE_QUOTE
+        # </script only ends a script outside attributes.
+        for ctx, want in ((in_script, 0), (in_attr, 1)):
+            transition, match = context_update._token_finder(ctx).find(
+                '</script>', 0, 9, ctx, {})
+            self.assertEquals(want, match.start())
+        # Only </title ends a title.
+        in_title = context.STATE_RCDATA | context.ELEMENT_TITLE
+        end_tag = context_update._token_finder(in_title).transitions[0]
+        self.assertEquals(4, end_tag.pattern.search('</b></TITLE>').start())
+        self.assertTrue(
+            context_update._token_finder(in_script)
+            is context_update._token_finder(
+                in_script | context.JS_CTX_DIV_OP))
+
+    def test_context_tables(self):
+        """
+        Tests that the tables behind force_epsilon_transition and
+        context_union agree with computing the result directly.
+        """
+        contexts = []
+        for state in xrange(context.COUNT_OF_STATES):
+            for el_type in (context.ELEMENT_NONE, context.ELEMENT_SCRIPT):
+                for attr in (context.ATTR_NONE, context.ATTR_URL):
+                    for delim in (context.DELIM_NONE,
+                                  context.DELIM_SPACE_OR_TAG_END):
+                        for part in (context.JS_CTX_DIV_OP,
+                                     context.URL_PART_PRE_QUERY,
+                                     context.URL_PART_UNKNOWN):
+                            contexts.append(
+                                state | el_type | attr | delim | part)
+        for ctx in contexts:
+            want = context._compute_epsilon_transition(ctx)
+            for _ in xrange(2):
+                self.assertEquals(
+                    want, context.force_epsilon_transition(ctx),
+                    debug.context_to_string(ctx))
+        for ctx0 in contexts[::7]:
+            for ctx1 in contexts[::5]:
+                want = ctx0 if ctx0 == ctx1 else (
+                    context_update._compute_context_union(ctx0, ctx1))
+                for _ in xrange(2):
+                    self.assertEquals(
+                        want, context_update.context_union(ctx0, ctx1),
+                        '%s, %s' % (debug.context_to_string(ctx0),
+                                    debug.context_to_string(ctx1)))
+
+    def test_process_raw_text_cache(self):
+        """
+        Tests the bounded memo in front of process_raw_text.
+        """
+        cache = context_update.PROCESS_RAW_TEXT_CACHE
+        old_size = cache.max_size
+        try:
+            cache.resize(2)
+            cache.clear()
+            html_ctx = context.STATE_TEXT
+            js_ctx = context.STATE_JS | context.JS_CTX_UNKNOWN
+
+            want = context_update.process_raw_text('<b>', html_ctx)
+            self.assertEquals((0, 1), (cache.hits, cache.misses))
+            self.assertEquals(
+                want, context_update.process_raw_text('<b>', html_ctx))
+            self.assertEquals((1, 1), (cache.hits, cache.misses))
+
+            # str and unicode inputs are cached separately.
+            context_update.process_raw_text(u'<b>', html_ctx)
+            self.assertEquals((1, 2), (cache.hits, cache.misses))
+
+            # Failures are cached and re-raised.
+            for _ in xrange(2):
+                try:
+                    context_update.process_raw_text('/', js_ctx)
+                except context_update.ContextUpdateFailure:
+                    pass
+                else:
+                    self.fail('expected failure')
+            self.assertEquals((2, 3), (cache.hits, cache.misses))
+            self.assertEquals(2, len(cache))
+            self.assertEquals(1, cache.evictions)
+
+            cache.resize(0)
+            self.assertEquals(0, len(cache))
+            context_update.process_raw_text('<b>', html_ctx)
+            self.assertEquals(0, len(cache))
+        finally:
+            cache.resize(old_size)
+
+    def test_linear_scaling(self):
+        """
+        Benchmarks process_raw_text on inline scripts of increasing size to
+        check that the time taken grows linearly with the size of the chunk.
+        """
+        line = (
+            'var x = a[i] / 2 + "str\\"ing" + \'q\'; // c\n'
+            '/* block */ if (x < y) { f(x, /re[/]/g); }\n')
+        cache = context_update.PROCESS_RAW_TEXT_CACHE
+        old_size = cache.max_size
+        try:
+            cache.resize(0)
+            times = []
+            for size in (25000, 100000):
+                text = '<script>%s</script>' % (line * (size // len(line)))
+                best = None
+                for _ in xrange(3):
+                    start = time.time()
+                    end_ctx, _, _, _ = context_update.process_raw_text(
+                        text, context.STATE_TEXT)
+                    elapsed = time.time() - start
+                    if best is None or elapsed < best:
+                        best = elapsed
+                self.assertEquals(context.STATE_TEXT, end_ctx)
+                times.append(best)
+        finally:
+            cache.resize(old_size)
+        # Four times the input should take about four times as long.
+        # Quadratic behavior would take sixteen times as long.
+        ratio = times[1] / max(times[0], 1e-3)
+        self.assertTrue(ratio < 10, 'times=%r' % times)
+
+    def test_context_tracker(self):
+        """
+        Tests that feeding a chunk of text to a ContextTracker in pieces
+        gives the same result as processing it all at once.
+        """
+        docs = (
+            '<!doctype html><html><head><title>A <b> title</title>',
+            '<script>var x = a / b, re = /<\\/script[/]/;'
+            ' // comment\n/* block\n */ s = "</scr" + \'ipt>\';</script>',
+            '<style>p { background: url( "/foo?bar#baz" ) }'
+            ' /* c */ // x\n</style>',
+            '<a href="/foo?a=b&amp;c=d" onclick="alert(&quot;hi&quot;)"'
+            ' title=unquoted style=\'color: red\'>link</a>',
+            '<p>Hello, <!-- a comment --> World &amp; co.</p>',
+            '<textarea><b>not a tag</b></textarea><xmp></xmp >',
+            '<input checked value=>< 3 <3 <!-',
+            '<script>x = 1 /*\n*/ / 2</script><img src=x>',
+            '<a onclick="x = \'\\\'\'" b=c',
+            # Ends in an error.
+            '<script>var x = a; /',
+            '<a title=x"y>',
+            )
+
+        def process(text):
+            """The context and normalized text after text, or 'error'."""
+            try:
+                end_ctx, normalized, _, _ = context_update.process_raw_text(
+                    text, context.STATE_TEXT)
+            except context_update.ContextUpdateFailure:
+                return 'error'
+            if context.is_error_context(end_ctx):
+                return 'error'
+            return end_ctx, normalized
+
+        def track(chunks, normalize=True):
+            """Like process but feeds chunks to a ContextTracker."""
+            tracker = context_update.ContextTracker(
+                context.STATE_TEXT, normalize)
+            normalized = []
+            try:
+                for chunk in chunks:
+                    normalized.append(tracker.feed(chunk))
+                normalized.append(tracker.close())
+            except context_update.ContextUpdateFailure:
+                return 'error'
+            if not normalize:
+                self.assertEquals([None] * len(normalized), normalized)
+                return tracker.context
+            return tracker.context, ''.join(normalized)
+
+        for doc in docs:
+            want = process(doc)
+            want_ctx = want if want == 'error' else want[0]
+            splits = [[doc[:i], doc[i:]] for i in xrange(len(doc) + 1)]
+            splits.append(list(doc))
+            for chunks in splits:
+                self.assertEquals(
+                    want, track(chunks), 'chunks=%r' % (chunks,))
+                self.assertEquals(
+                    want_ctx, track(chunks, False), 'chunks=%r' % (chunks,))
+
+    def test_context_tracker_memory(self):
+        """
+        Tests that a ContextTracker does not hold on to long runs of text,
+        comments and style sheets that arrive in small chunks.
+        """
+        for prefix, chunk in (
+            ('', 'Hello, World! '),
+            ('<!--', 'a comment '),
+            ('<textarea>', 'a <b>textarea</b> '),
+            ('<style>', 'p { color: red } '),
+            ('<script>/*', 'a block comment '),
+            ('<script>//', 'a line comment '),
+            ):
+            chunks = [prefix] + [chunk] * 2000
+            want_ctx, want_normalized, _, _ = (
+                context_update.process_raw_text(
+                    ''.join(chunks), context.STATE_TEXT))
+            for normalize in (True, False):
+                tracker = context_update.ContextTracker(
+                    context.STATE_TEXT, normalize)
+                normalized = []
+                max_pending = 0
+                for chunk in chunks:
+                    normalized.append(tracker.feed(chunk))
+                    max_pending = max(max_pending, len(tracker._pending))
+                normalized.append(tracker.close())
+                self.assertEquals(want_ctx, tracker.context)
+                if normalize:
+                    self.assertEquals(want_normalized, ''.join(normalized))
+                self.assertTrue(max_pending < 100, '%r: %d pending' % (
+                    prefix, max_pending))
+
+    def test_context_tracker_long_tokens(self):
+        """
+        Tests that a ContextTracker does not lex the start of a token that
+        is longer than its lookahead before the token is complete.
+        """
+        spaces = ' ' * (context_update._TRACKER_LOOKAHEAD + 10)
+        docs = (
+            '<style>p { background: url' + spaces + '(javascript',
+            '<style>p { background: url' + spaces + '("a b',
+            '<style>p { background: url(' + spaces + '"a b',
+            '<style>p { background: url' + spaces + ': red }',
+            )
+        for doc in docs:
+            want_ctx, want_normalized, _, _ = context_update.process_raw_text(
+                doc, context.STATE_TEXT)
+            splits = [[doc[:i], doc[i:]] for i in xrange(len(doc) + 1)]
+            splits += [[doc[i:i + size] for i in xrange(0, len(doc), size)]
+                       for size in (1, 7, 50)]
+            for chunks in splits:
+                tracker = context_update.ContextTracker(context.STATE_TEXT)
+                normalized = [tracker.feed(chunk) for chunk in chunks]
+                normalized.append(tracker.close())
+                self.assertEquals(
+                    (want_ctx, want_normalized),
+                    (tracker.context, ''.join(normalized)),
+                    'chunks=%r' % (chunks,))
+
+    def test_context_tracker_mixed_chunks(self):
+        """
+        Tests that str and unicode chunks can be fed to one tracker.
+        """
+        for chunks in (
+            ['caf\xc3\xa9 ', u'x'],
+            [u'caf\xe9 ', '\xc3\xa9<b', u'>'],
+            ['<a title="\xff', u'\u2028">'],
+            ):
+            tracker = context_update.ContextTracker(context.STATE_TEXT)
+            for chunk in chunks:
+                tracker.feed(chunk)
+            tracker.close()
+            self.assertEquals(context.STATE_TEXT, tracker.context)
+
+    def test_end_context(self):
+        """
+        Tests that end_context agrees with process_raw_text.
+        """
+        texts = (
+            '<a href="/foo?a=b&amp;c=d" onclick="alert(&quot;hi&quot;)"'
+            ' title=unquoted style=\'color: red\'>link</a>',
+            '<script>var x = a / b; /* c */ "</scr" + \'ipt>\'</script>',
+            '<textarea><b>not a tag</b></textarea>',
+            '<a onclick="f(&quot;x\'\', \'y\')',
+            '<style>p { color: red }',
+            '<script>var x = a; /',
+            )
+        for text in texts:
+            for start in (context.STATE_TEXT, context.STATE_TAG):
+                try:
+                    end_ctx, _, error_ctx, error_text = (
+                        context_update.process_raw_text(text, start))
+                    want = (end_ctx, error_ctx, error_text)
+                except context_update.ContextUpdateFailure, err:
+                    want = str(err)
+                try:
+                    got = context_update.end_context(text, start)
+                except context_update.ContextUpdateFailure, err:
+                    got = str(err)
+                self.assertEquals(want, got, repr(text))
+
+    def test_transfer_summary(self):
+        """
+        Tests that a TransferSummary agrees with process_raw_text in each
+        start context and shares work between start contexts.
+        """
+        texts = (
+            '',
+            'Hello, World!',
+            ' title="x">Hello, <b>World</b>!',
+            '="onclick" onclick="alert(&quot;Hi&quot;)">',
+            'p { color: red } </style><b>',
+            '/* a comment */ x / y; </script>',
+            "'; alert(1) </script>",
+            '<a href="/foo?q=1#x">',
+            'x"><script>/</script>',
+            )
+        start_contexts = []
+        for state, transitions in enumerate(context_update._TRANSITIONS):
+            if transitions is None:
+                continue
+            for extra in (0, context.ELEMENT_SCRIPT, context.ELEMENT_STYLE,
+                          context.ATTR_SCRIPT | context.DELIM_DOUBLE_QUOTE,
+                          context.JS_CTX_DIV_OP):
+                start_contexts.append(state | extra)
+
+        def process(text, ctx):
+            """process_raw_text's result or its failure message."""
+            try:
+                return context_update.process_raw_text(text, ctx)
+            except context_update.ContextUpdateFailure, err:
+                return str(err)
+
+        for text in texts:
+            summary = context_update.TransferSummary(text, start_contexts)
+            self.assertEquals(
+                sorted(set(start_contexts)), summary.start_contexts())
+            for ctx in start_contexts:
+                try:
+                    got = summary.process(ctx)
+                except context_update.ContextUpdateFailure, err:
+                    got = str(err)
+                self.assertEquals(
+                    process(text, ctx), got,
+                    '%s %r' % (debug.context_to_string(ctx), text))
+
+        # Runs from different start contexts that converge share a suffix.
+        text = ' x>' + '<p class="c">Hi</p>' * 100
+        summary = context_update.TransferSummary(text, [context.STATE_TAG])
+        checkpoints_for_one_run = len(summary._checkpoints)
+        summary.extend([context.STATE_TEXT, context.STATE_ATTR_NAME,
+                        context.STATE_AFTER_NAME])
+        self.assertTrue(
+            len(summary._checkpoints) < checkpoints_for_one_run + 10)
+        self.assertEquals(
+            context_update.process_raw_text(text, context.STATE_ATTR_NAME),
+            summary.process(context.STATE_ATTR_NAME))
+
+    def test_parallel(self):
+        """
+        Tests that lexing pieces in parallel gives the same result as lexing
+        sequentially.
+        """
+        script = (
+            'var x = a[i] / 2 + "str\\"ing"; // c\n'
+            '/* block\n */ if (x < y) { f(x, /re[/]/g); }\n')
+        style = 'p { background: url("/a?b#c") } /* c\n */\n'
+        para = '<p class="x"\ntitle=y>Hello &amp; <b>world</b></p>\n'
+        docs = (
+            para * 20 + '<script>' + script * 20 + '</script>' + para,
+            '<style>' + style * 20 + '</style><!--\n' + para * 10 + '-->',
+            '<textarea>\n' + para * 10 + '</textarea><a title="\n'
+            + para * 10 + '">',
+            # Ends in an error.
+            para * 10 + '<a href="\n' + para * 10 + '"x" >',
+            # Fails.
+            para * 10 + '<script>\n' + script * 10 + ' x = a / b; f()\n/',
+            )
+
+        def process(text):
+            """process_raw_text's result or its failure message."""
+            try:
+                return context_update.process_raw_text(
+                    text, context.STATE_TEXT)
+            except context_update.ContextUpdateFailure, err:
+                return str(err)
+
+        cache = context_update.PROCESS_RAW_TEXT_CACHE
+        old_settings = (cache.max_size,
+                        context_update.PARALLEL_THRESHOLD,
+                        context_update.PARALLEL_PROCESSES)
+        try:
+            cache.resize(0)
+            for doc in docs:
+                context_update.PARALLEL_THRESHOLD = None
+                want = process(doc)
+                context_update.PARALLEL_THRESHOLD = 0
+                for processes in (2, 5):
+                    context_update.PARALLEL_PROCESSES = processes
+                    self.assertEquals(want, process(doc), repr(doc))
+
+            def failing_pool(*args):
+                """Fails like a pool made in a daemonic process."""
+                raise AssertionError(
+                    'daemonic processes are not allowed to have children')
+
+            # Text is lexed sequentially when processes cannot be started.
+            context_update.close_parallel_pool()
+            pool = multiprocessing.Pool
+            multiprocessing.Pool = failing_pool
+            try:
+                for doc in docs:
+                    context_update.PARALLEL_THRESHOLD = None
+                    want = process(doc)
+                    context_update.PARALLEL_THRESHOLD = 0
+                    self.assertEquals(want, process(doc), repr(doc))
+            finally:
+                multiprocessing.Pool = pool
+        finally:
+            (max_size, context_update.PARALLEL_THRESHOLD,
+             context_update.PARALLEL_PROCESSES) = old_settings
+            cache.resize(max_size)
+            context_update.close_parallel_pool()
+
+    def test_attr_value_lexing(self):
+        """
+        Tests that attribute values are normalized token by token and that
+        text no transition rewrote keeps its original encoding.
+        """
+        tests = (
+            ('<a onclick="f(&quot;/*x*/&quot;) /* c */ + 1<2">',
+             '<a onclick="f(&#34;/*x*/&#34;)   &#43; 1&lt;2">'),
+            ("<a onclick='x /*&#39;*/ y'>",
+             "<a onclick='x   y'>"),
+            ('<a title=foo&amp;bar x=1>',
+             '<a title="foo&amp;bar" x="1">'),
+            ('<a onclick="&#x2665;/*&lt;*/&bogus;">',
+             u'<a onclick="\u2665 &amp;bogus;">'),
+            ('<p style="color: red /* &lt; */">',
+             '<p style="color: red  ">'),
+            )
+        for raw_text, want in tests:
+            self.assertEquals(
+                want, context_update.process_raw_text(
+                    raw_text, context.STATE_TEXT)[1])
+
+        raw_text = '<a onclick="%s">' % ('f(x, y / 2);' * 1000)
+        self.assertTrue(
+            context_update.process_raw_text(
+                raw_text, context.STATE_TEXT)[1] is raw_text)
+
+    def test_minify(self):
+        """
+        Tests that minify collapses only insignificant whitespace.
+        """
+        tests = (
+            ('<div  class="a  b"\n   id=x  >\n   Hi,   <b>you</b>\n  </div>',
+             '<div class="a  b" id="x">\nHi, <b>you</b>\n</div>'),
+            ('<br  />  <textarea>  a   b  </textarea>  ',
+             '<br /> <textarea>  a   b  </textarea> '),
+            # Comments become whitespace that collapses with its neighbours.
+            # A line break in JS stays a line break.
+            ('<script>\n  var x = 1  /* c */ ;\n  return  /* a\n b */ x\n'
+             '  s = "a   b"; r = /a  b/;\n</script>',
+             '<script>\nvar x = 1 ;\nreturn\nx\n'
+             's = "a   b"; r = /a  b/;\n</script>'),
+            ('<style>\n  p  {  color :  red ;  }\n  a  b { x: "a  b" }\n'
+             '</style>',
+             '<style> p { color : red ; } a b { x: "a  b" } </style>'),
+            ('<a onclick="  f(  1 ,\n 2 )  " style="  color:  red  "'
+             ' title="  x  y  ">',
+             '<a onclick=" f( 1 ,\n2 ) " style=" color: red "'
+             ' title="  x  y  ">'),
+            )
+        for raw_text, want in tests:
+            end_ctx, normalized, _, _ = context_update.process_raw_text(
+                raw_text, context.STATE_TEXT)
+            self.assertEquals(
+                (end_ctx, want, None, None),
+                context_update.process_raw_text(
+                    raw_text, context.STATE_TEXT, context_update.MINIFY_ALL))
+            self.assertEquals(
+                want, context_update.minify(normalized, context.STATE_TEXT))
+            self.assertEquals(
+                want, context_update.minify(want, context.STATE_TEXT))
+        # HTML text is kept without MINIFY_TEXT.
+        self.assertEquals(
+            '<p>  a  b  </p>',
+            context_update.minify(
+                '<p  >  a  b  </p>', context.STATE_TEXT,
+                context_update.MINIFY_CODE))
+
+    def test_js_body_patterns(self):
+        """
+        Tests that the patterns for JS string and regular expression bodies
+        and for JS punctuation match the same text as the straightforward
+        patterns with one iteration per character.
+        """
+        nls = context_update.NLS
+        reference_patterns = (
+            (context.STATE_JS, 5,
+             r'(?i)(?:[^<\/\"\'\s\\]|<(?!\/script))+'),
+            (context.STATE_JSDQ_STR, 2,
+             r'(?i)\A(?:[^\"\\' + nls + r'<]'
+             r'|\\(?:\r\n?|[^\r<]|<(?!/script))|<(?!/script))+'),
+            (context.STATE_JSSQ_STR, 2,
+             r"(?i)\A(?:[^\'\\" + nls + r"<]"
+             r"|\\(?:\r\n?|[^\r<]|<(?!/script))|<(?!/script))+"),
+            (context.STATE_JSREGEXP, 2,
+             r'\A(?:[^\[\\/<' + nls + r']|\\[^' + nls + r']'
+             r'|\\?<(?!/script)|\[(?:[^\]\\<' + nls + r']'
+             r'|\\(?:[^' + nls + r']))*|\\?<(?!/script)\])+'),
+            )
+        alphabet = ('a', '"', "'", '\\', '<', '/', '[', ']', ' ', '\n',
+                    '\r', u'\u2028', '/script', '/SCRIPT')
+        texts = ['']
+        for _ in xrange(4):
+            texts = [text + char for text in texts for char in alphabet]
+            for text in texts:
+                for state, index, reference in reference_patterns:
+                    pattern = context_update._TRANSITIONS[state][index].pattern
+                    want = re.match(reference, text)
+                    got = pattern.match(text)
+                    self.assertEquals(
+                        want and want.end(), got and got.end(),
+                        '%s %r' % (pattern.pattern, text))
+
+    def test_pathological_js_inputs(self):
+        """
+        Benchmarks JS content shaped to make a backtracking lexer slow, to
+        check that lexing time stays within a budget.
+        """
+        js_ctx = context.STATE_JS | context.JS_CTX_REGEX | \
+            context.ELEMENT_SCRIPT
+        size = 100000
+        inputs = (
+            '"' + '<\\<\\x<' * (size // 6) + '"',
+            "'" + '\\<\\\r\n<<' * (size // 7) + "'",
+            '/' + '[<\\]<]\\<<[' * (size // 10) + ']/',
+            'a<b<c<' * (size // 6),
+            '"' + '</scrip' * (size // 7) + '"',
+            '/' + '\\/' * (size // 2) + '/',
+            )
+        cache = context_update.PROCESS_RAW_TEXT_CACHE
+        old_size = cache.max_size
+        try:
+            cache.resize(0)
+            for text in inputs:
+                start = time.time()
+                context_update.process_raw_text(text, js_ctx)
+                elapsed = time.time() - start
+                # About 50ms is typical.
+                self.assertTrue(
+                    elapsed < 1.0, '%.3fs for %r' % (elapsed, text[:20]))
+        finally:
+            cache.resize(old_size)
+
     def test_redundant_funcs(self):
         """
         Check that the redundant funcs invariant holds.
@@ -0,0 +1,1314 @@
+#!/usr/bin/env python -O
+
+"""
+Compares alternate lexing and escaping engines to the reference lexer and
+sanitizers over the string literals in tests/*.py and generated inputs,
+and reports their throughput side by side.
+
+The reference lexer and sanitizers are frozen copies, kept in this module,
+of the loop that sliced off one token at a time with _process_next_token,
+of the patterns of its grammar and of the regular expression based
+sanitizers.  The reference lexer still uses the transition classes of
+context_update to compute contexts.
+The URL sanitizers are also compared to regular expression based ones
+on generated query-heavy URLs.
+
+A fast path is added by registering it in LEXER_ENGINES or
+SANITIZER_ENGINES.
+
+Environment variables configure a run:
+  AUTOESC_DIFF_SEED - seeds the generator.  Defaults to a fixed seed.
+  AUTOESC_DIFF_GENERATED - number of generated inputs.
+"""
+
+from autoesc import content, context, context_update, debug, escaping, html
+import ast
+import copy
+import json
+import multiprocessing
+import os
+import random
+import re
+import sys
+import time
+import unittest
+
+
+def _env_int(name, default):
+    """The integer value of the named environment variable or default."""
+    value = os.environ.get(name)
+    if value:
+        return int(value)
+    return default
+
+SEED = _env_int('AUTOESC_DIFF_SEED', 0xd1ff)
+GENERATED = _env_int('AUTOESC_DIFF_GENERATED', 300)
+
+_TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The contexts in which inputs are lexed.
+START_CONTEXTS = (
+    context.STATE_TEXT,
+    context.STATE_RCDATA | context.ELEMENT_TITLE,
+    context.STATE_TAG,
+    context.STATE_BEFORE_VALUE | context.ATTR_URL,
+    context.STATE_ATTR | context.DELIM_DOUBLE_QUOTE,
+    context.STATE_URL | context.ATTR_URL | context.DELIM_SINGLE_QUOTE,
+    context.STATE_JS | context.ATTR_SCRIPT | context.DELIM_DOUBLE_QUOTE,
+    context.STATE_JS | context.ELEMENT_SCRIPT | context.JS_CTX_REGEX,
+    context.STATE_JS | context.ELEMENT_SCRIPT | context.JS_CTX_DIV_OP,
+    context.STATE_JSDQ_STR | context.ELEMENT_SCRIPT,
+    context.STATE_CSS | context.ELEMENT_STYLE,
+    context.STATE_CSS | context.ATTR_STYLE | context.DELIM_SPACE_OR_TAG_END,
+    )
+
+
+# The reference lexer and sanitizers below are frozen copies of the
+# implementations that the fast paths replaced, so that engines are compared
+# to independent code rather than to themselves.  The reference lexer uses
+# the transition classes of context_update with the patterns below, which
+# are those of the grammar before any fast path.
+
+
+# The patterns of the transitions in context_update._TRANSITIONS by state.
+_REFERENCE_PATTERNS = (
+    # STATE_TEXT
+    (
+        '\\A[^<]+',
+        '<!--',
+        '(?i)<script(?![a-z\\-])',
+        '(?i)<style(?![a-z\\-])',
+        '(?i)<textarea(?![a-z\\-])',
+        '(?i)<title(?![a-z\\-])',
+        '(?i)<xmp(?![a-z\\-])',
+        '(?i)<(?!/?(?:[a-z]|\\Z)|!doctype)',
+        '</',
+        '<',
+        ),
+    # STATE_RCDATA
+    (
+        '(?i)</([a-z\\-]+)(?![a-z\\-])',
+        '<',
+        '\\Z',
+        ),
+    # STATE_HTML_BEFORE_TAG_NAME
+    (
+        '\\A[A-Za-z]+',
+        '\\A(?=[^A-Za-z])',
+        ),
+    # STATE_TAG_NAME
+    (
+        '\\A[A-Za-z0-9:-]*(?:[A-Za-z0-9]|\\Z)',
+        '\\A(?=[\\/\\s>])',
+        ),
+    # STATE_TAG
+    (
+        '\\A\\s*([A-Za-z][\\w:-]*)',
+        '\\A\\s*\\/?>',
+        '\\A\\s+\\Z',
+        ),
+    # STATE_ATTR_NAME
+    (
+        '[A-Za-z0-9\\-]+',
+        '\\A',
+        ),
+    # STATE_AFTER_NAME
+    (
+        '\\A\\s*=',
+        '\\A\\s+',
+        '\\A',
+        ),
+    # STATE_BEFORE_VALUE
+    (
+        '\\A\\s*["]',
+        "\\A\\s*[\\']",
+        '\\A(?=[^=\\"\\\'\\`\\s>])',
+        '\\A(?=/?>)',
+        '\\A\\s+',
+        ),
+    # STATE_HTMLCMT
+    (
+        '-->',
+        '\\Z',
+        ),
+    # STATE_ATTR
+    (
+        '\\Z',
+        ),
+    # STATE_CSS
+    (
+        '\\/\\*',
+        '\\/\\/',
+        '["]',
+        "[\\']",
+        '(?i)\\burl\\s*\\(\\s*([\\"\\\']?)',
+        '(?i)<\\/style\\b',
+        '\\Z',
+        ),
+    # STATE_CSSLINE_CMT
+    (
+        '[\\n\\f\\r]',
+        '(?i)<\\/style\\b',
+        '\\Z',
+        ),
+    # STATE_CSSBLOCK_CMT
+    (
+        '\\*\\/',
+        '(?i)<\\/style\\b',
+        '\\Z',
+        ),
+    # STATE_CSSDQ_STR
+    (
+        '["]',
+        '\\\\(?:\\r\\n?|[\\n\\f\\"])',
+        '([?#]|\\\\(?:23|3[fF]|[?#]))|\\Z',
+        '[\\n\\r\\f]',
+        '(?i)<\\/style\\b',
+        '\\Z',
+        ),
+    # STATE_CSSSQ_STR
+    (
+        "[\\']",
+        "\\\\(?:\\r\\n?|[\\n\\f\\'])",
+        '([?#]|\\\\(?:23|3[fF]|[?#]))|\\Z',
+        '[\\n\\r\\f]',
+        '(?i)<\\/style\\b',
+        ),
+    # STATE_CSS_URL
+    (
+        '[\\\\)\\s]',
+        '([?#]|\\\\(?:23|3[fF]|[?#]))|\\Z',
+        '[\\"\\\']',
+        '(?i)<\\/style\\b',
+        ),
+    # STATE_CSSDQ_URL
+    (
+        '["]',
+        '([?#]|\\\\(?:23|3[fF]|[?#]))|\\Z',
+        '\\\\(?:\\r\\n?|[\\n\\f\\"])',
+        '[\\n\\r\\f]',
+        '(?i)<\\/style\\b',
+        ),
+    # STATE_CSSSQ_URL
+    (
+        "[\\']",
+        '([?#]|\\\\(?:23|3[fF]|[?#]))|\\Z',
+        "\\\\(?:\\r\\n?|[\\n\\f\\'])",
+        '[\\n\\r\\f]',
+        '(?i)<\\/style\\b',
+        ),
+    # STATE_JS
+    (
+        '/[*]',
+        '//',
+        '["]',
+        "[\\']",
+        '/',
+        '(?i)(?:[^<\\/\\"\\\'\\s\\\\]|<(?!\\/script))+',
+        '\\s+',
+        '(?i)<\\/script\\b',
+        ),
+    # STATE_JSLINE_CMT
+    (
+        u'[\n\r\u2028\u2029]',
+        '(?i)<\\/script\\b',
+        '\\Z',
+        ),
+    # STATE_JSBLOCK_CMT
+    (
+        '[*]/',
+        '(?i)<\\/script\\b',
+        '\\Z',
+        ),
+    # STATE_JSDQ_STR
+    (
+        '["]',
+        '(?i)<\\/script\\b',
+        u'(?i)\\A(?:[^\\"\\\\\n\r\u2028\u2029<]|\\\\(?:\\r\\n?|[^\\r<]|'
+        u'<(?!/script))|<(?!/script))+',
+        ),
+    # STATE_JSSQ_STR
+    (
+        "[\\']",
+        '(?i)<\\/script\\b',
+        u"(?i)\\A(?:[^\\'\\\\\n\r\u2028\u2029<]|\\\\(?:\\r\\n?|[^\\r<]|"
+        u'<(?!/script))|<(?!/script))+',
+        ),
+    # STATE_JSREGEXP
+    (
+        '/',
+        '(?i)<\\/script\\b',
+        u'\\A(?:[^\\[\\\\/<\n\r\u2028\u2029]|\\\\[^\n\r\u2028\u2029]'
+        u'|\\\\?<(?!/script)|\\[(?:[^\\]\\\\'
+        u'<\n\r\u2028\u2029]|\\\\(?:[^\n\r\u2028\u2029]))*|\\\\?<('
+        u'?!/script)\\])+',
+        ),
+    # STATE_URL
+    (
+        '([?#])|\\Z',
+        ),
+    # STATE_ERROR
+    (),
+    )
+
+
+def _reference_transitions():
+    """
+    Copies of the transitions in context_update._TRANSITIONS that search
+    with _REFERENCE_PATTERNS.
+    """
+    transitions = []
+    for state, patterns in enumerate(_REFERENCE_PATTERNS):
+        live = context_update._TRANSITIONS[state] or ()
+        if len(live) != len(patterns):
+            raise AssertionError(
+                'The transitions for %s changed; update _REFERENCE_PATTERNS'
+                % debug.context_to_string(state))
+        frozen = []
+        for transition, pattern in zip(live, patterns):
+            transition = copy.copy(transition)
+            transition.pattern = re.compile(pattern)
+            frozen.append(transition)
+        transitions.append(tuple(frozen))
+    return tuple(transitions)
+
+# The transitions of the reference lexer indexed by state.
+REFERENCE_TRANSITIONS = _reference_transitions()
+
+
+def _end_of_attr_value(raw_text, delim):
+    """
+    Returns the end of the attribute value of -1 if delim indicates we are
+    not in an attribute, or len(raw_text) if we are in an attribute but the
+    end does not appear in raw_text.
+    """
+    if delim == context.DELIM_NONE:
+        return -1
+    if delim == context.DELIM_SPACE_OR_TAG_END:
+        match = re.search(r'[\s>]', raw_text)
+        if match:
+            return match.start(0)
+    else:
+        quote = raw_text.find(context.DELIM_TEXT[delim])
+        if quote >= 0:
+            return quote
+    return len(raw_text)
+
+
+def _process_next_token(text, ctx):
+    """
+    Consume a portion of text and compute the next context.
+    text - Non empty.
+
+    Returns (n, context after text[:n], replacement for text[:n])
+    """
+
+    if context.is_error_context(ctx):  # The ERROR state is infectious.
+        return (len(text), ctx, text)
+
+    # Find the transition whose pattern matches earliest
+    # in the raw text.
+    earliest_start = len(text)+1
+    earliest_transition = None
+    earliest_match = None
+
+    for transition in REFERENCE_TRANSITIONS[context.state_of(ctx)]:
+        match = transition.pattern.search(text)
+        if not match:
+            continue
+        start = match.start(0)
+        if (start < earliest_start
+            and transition.is_applicable_to(ctx, match)):
+            earliest_start = start
+            earliest_transition = transition
+            earliest_match = match
+
+    if earliest_transition:
+        num_consumed = earliest_match.end(0)
+        next_context = earliest_transition.compute_next_context(
+            ctx, earliest_match)
+        normalized_text = earliest_transition.raw_text(earliest_match)
+        if normalized_text is None:
+            # Transitions now return None for text they do not change.
+            normalized_text = text[:num_consumed]
+    else:
+        num_consumed = len(text)
+        next_context = context.STATE_ERROR
+        normalized_text = text
+
+    if (not num_consumed
+        and context.state_of(next_context) == context.state_of(ctx)):
+        # Infinite loop.
+        raise Exception('inf loop. for %r in %s'
+                        % (text, debug.context_to_string(ctx)))
+
+    return (num_consumed, next_context, normalized_text)
+
+
+def _process_raw_text(raw_text, ctx):
+    """
+    The sequential lexer that slices off one token at a time.
+    Returns (the context after raw_text, normalized text or None).
+    May raise ContextUpdateFailure.
+    """
+    normalized = []
+
+    while raw_text:
+        delim_type = context.delim_type_of(ctx)
+        attr_value_end = _end_of_attr_value(raw_text, delim_type)
+        if attr_value_end == -1:
+            # Outside an attribute value.  No need to decode.
+            num_consumed, ctx, replacement_text = _process_next_token(
+                raw_text, ctx)
+            raw_text = raw_text[num_consumed:]
+            normalized.append(replacement_text)
+
+            if context.delim_type_of(ctx) == context.DELIM_SPACE_OR_TAG_END:
+                # Introduce a double quote when we transition into an
+                # unquoted attribute body.
+                normalized.append('"')
+        else:
+            # Inside an attribute value.  Find the end and decode up to it.
+            if delim_type == context.DELIM_SPACE_OR_TAG_END:
+                bad = re.search(r'[\x00"\'<=`]', raw_text[:attr_value_end])
+                if bad:
+                    raise context_update.ContextUpdateFailure(
+                        '%r in unquoted attr: %r'
+                        % (bad.group(), raw_text[:attr_value_end]))
+
+            if attr_value_end < len(raw_text):
+                attr_end = attr_value_end + len(context.DELIM_TEXT[delim_type])
+            else:
+                attr_end = -1
+
+            attr_value_tail = html.unescape_html(raw_text[:attr_value_end])
+
+            if delim_type == context.DELIM_SINGLE_QUOTE:
+                escaper = escape_html_sq_only
+            else:
+                escaper = escape_html_dq_only
+
+            # Recurse on the decoded value.
+            while attr_value_tail:
+                num_consumed, ctx, replacement = _process_next_token(
+                    attr_value_tail, ctx)
+                attr_value_tail = attr_value_tail[num_consumed:]
+                normalized.append(escaper(replacement))
+
+            if attr_end != -1:
+                raw_text = raw_text[attr_end:]
+                # When an attribute ends, we're back in the tag.
+                ctx = context.STATE_TAG | context.element_type_of(ctx)
+
+                # Append the delimiter on exiting an attribute.
+                if delim_type == context.DELIM_SINGLE_QUOTE:
+                    normalized.append("'")
+                else:
+                    # Inserts an end quote for unquoted attributes.
+                    normalized.append('"')
+            else:
+                # Whole tail is part of an unterminated attribute.
+                raw_text = ""
+        if context.is_error_context(ctx):
+            return ctx, None
+    return ctx, ''.join(normalized)
+
+
+def reference_lex(text, ctx):
+    """
+    The reference result of lexing text in ctx:
+    (end context, normalized text or None on error).
+    """
+    try:
+        return _process_raw_text(text, ctx)
+    except context_update.ContextUpdateFailure:
+        return context.STATE_ERROR, None
+
+
+def escape_html(value):
+    """Escapes HTML special characters in a string."""
+    if value is None:
+        return ""
+    if (isinstance(value, content.TypedContent)
+        and value.kind == content.CONTENT_KIND_HTML):
+        return value.content
+    if type(value) not in (str, unicode):
+        value = str(value)
+    return _escape_html_helper(value)
+
+
+def escape_html_rcdata(value):
+    """Escapes HTML special characters so that value can be in RCDATA."""
+    if value is None:
+        return ""
+    if (isinstance(value, content.TypedContent)
+        and value.kind == content.CONTENT_KIND_HTML):
+        return _normalize_html_helper(value.content)
+    if type(value) not in (str, unicode):
+        value = str(value)
+    return _escape_html_helper(value)
+
+
+def _strip_html_tags(value):
+    """Removes HTML tags from a string of known safe HTML."""
+    return _HTML_TAG_REGEX.sub("", value)
+
+
+def escape_html_attribute(value):
+    """Escapes HTML special characters in an HTML attribute value."""
+    if value is None:
+        return ""
+    if (isinstance(value, content.TypedContent)
+        and value.kind == content.CONTENT_KIND_HTML):
+        return _normalize_html_helper(_strip_html_tags(value.content))
+    if type(value) not in (str, unicode):
+        value = str(value)
+    return _escape_html_helper(value)
+
+
+_ATTR_NAME_VALUE_PAIR = re.compile(
+    r'(?s)\A(?:\s*)([0-9A-Za-z\-:]+)(?:\s*=\s*[\"\']?(.*?)[\"\']?)?\s*\Z')
+
+def filter_html_attribute(value):
+    """
+    Filters out strings that cannot be a substring of a valid HTML attribute.
+    """
+    if (isinstance(value, content.TypedContent)
+        and value.kind == content.CONTENT_KIND_HTML_ATTR):
+        value = value.content
+    elif value is None:
+        return ''
+    else:
+        if type(value) not in (str, unicode):
+            value = str(value)
+        value = _filter_html_attribute_helper(value)
+        if content.CONTENT_KIND_PLAIN != html.attr_type(value):
+            return 'zSafehtmlz'
+    if value.find('=') < 0:
+        return value
+    match = _ATTR_NAME_VALUE_PAIR.search(value)
+    if not match:
+        return 'zSafehtmlz'
+    return ' %s="%s"' % (match.group(1), _normalize_html_helper(match.group(2)))
+
+
+def filter_html_attr_suffix(value):
+    """
+    Filters out strings not composed of valid HTML attribute suffix
+    characters.
+    """
+    if value is None:
+        return ''
+    elif type(value) not in (str, unicode):
+        value = str(value)
+    return _filter_html_attribute_helper(value)
+
+
+def filter_html_element_name(value):
+    """
+    Filters out strings that cannot be a substring of a valid HTML element
+    name.
+    """
+    if type(value) not in (str, unicode):
+        value = str(value)
+    return _filter_element_name_helper(value)
+
+
+def escape_js_string(value):
+    """Escapes value to make it valid content for a JS string literal."""
+    if (isinstance(value, content.TypedContent)
+        and value.kind == content.CONTENT_KIND_JS_STR_CHARS):
+        return _normalize_js_string_helper(value.content)
+    if type(value) not in (str, unicode):
+        value = str(value)
+    return _escape_js_string_helper(value)
+
+
+def _marshal_json_obj(obj):
+    """Marshals a JSON object by looking for a to_json method."""
+    if hasattr(obj, 'to_json'):
+        try:
+            return obj.to_json()
+        except (StandardError, Warning):
+            pass
+    elif hasattr(obj, '__unicode__'):
+        return unicode(obj)
+    elif hasattr(obj, '__str__'):
+        return str(obj)
+    return None
+
+
+def escape_js_value(value):
+    """Encodes a value as a JavaScript literal."""
+    if isinstance(value, content.TypedContent):
+        if value.kind == content.CONTENT_KIND_JS:
+            value = value.content
+            if re.search(r'(?i)</script', value):
+                value = None
+            return value
+        elif value.kind == content.CONTENT_KIND_JS_STR_CHARS:
+            return '"%s"' % escape_js_string(value)
+
+    escaped = json.dumps(
+        value,
+        ensure_ascii=True,
+        check_circular=True,
+        allow_nan=True,
+        indent=None,
+        default=_marshal_json_obj,
+        separators=(',', ':'))
+
+    if not len(escaped):
+        return " null "
+    char0 = escaped[0]
+    if char0 == '{':
+        escaped = '(%s)' % escaped
+    elif char0 not in '["':
+        escaped = ' %s ' % escaped
+    return escaped.replace('<', r'\x3c').replace('>', r'\x3e')
+
+
+def escape_js_regex(value):
+    """
+    Escapes value to make it valid content for a JS regular expression
+    literal.
+    """
+    if (isinstance(value, content.TypedContent)
+        and value.kind == content.CONTENT_KIND_JS_STR_CHARS):
+        return _normalize_js_regex_helper(value.content)
+
+    if value is None:
+        escaped = ""
+    else:
+        if type(value) not in (str, unicode):
+            value = str(value)
+        escaped = _escape_js_regex_helper(value)
+
+    if not escaped:
+        escaped = "(?:)"
+    return escaped
+
+
+_NOT_URL_UNRESERVED = re.compile(r"[^0-9A-Za-z\._~\-]+")
+
+def _pct_encode(match):
+    """URL encodes octets in value"""
+    value = match.group(0)
+    if type(value) is unicode:
+        value = value.encode('UTF-8')
+    if len(value) == 1:
+        return '%%%02x' % ord(value)
+    return "".join(["%%%02x" % ord(char) for char in value])
+
+def escape_url(value):
+    """Escapes a string so that it can be safely included in a URL."""
+    if value is None:
+        return ""
+    if (isinstance(value, content.TypedContent)
+        and value.kind == content.CONTENT_KIND_URL):
+        return normalize_url(value.content)
+    if type(value) not in (str, unicode):
+        value = str(value)
+
+    return _NOT_URL_UNRESERVED.sub(_pct_encode, value)
+
+
+_NOT_URL_UNRESERVED_AND_SPECIAL = re.compile(
+    r"(?:[^0-9A-Za-z\._~:/?#\[\]@!$&*+,;=%\-]|%(?![0-9A-Fa-f]{2}))+")
+
+def normalize_url(value):
+    """Escapes any raw HTML/JS string delimiters in a URL."""
+    if value is None:
+        return ""
+    if type(value) not in (str, unicode):
+        value = str(value)
+
+    return _NOT_URL_UNRESERVED_AND_SPECIAL.sub(_pct_encode, value)
+
+
+def filter_url(value):
+    """Vets a URL's protocol."""
+    if (isinstance(value, content.TypedContent)
+        and value.kind == content.CONTENT_KIND_URL):
+        return value
+    if value is None:
+        value = ""
+    elif type(value) not in (str, unicode):
+        value = str(value)
+    if not _FILTER_FOR_FILTER_URL.match(value):
+        return "#zSafehtmlz"
+    return value
+
+
+def elide(_):
+    """Always returns the empty string."""
+    return ''
+
+
+def open_quote(value):
+    """Prefixes value with a quote."""
+    return '"%s' % value
+
+
+def escape_css_string(value):
+    """Escapes a string so it can be included inside a quoted CSS string."""
+    if value is None:
+        value = ""
+    elif type(value) not in (str, unicode):
+        value = str(value)
+    return _escape_css_string_helper(value)
+
+
+def filter_css_value(value):
+    """Encodes a value as a CSS identifier part, keyword, or quantity."""
+    if (isinstance(value, content.TypedContent)
+        and value.kind == content.CONTENT_KIND_CSS):
+        return value
+
+    if value is None:
+        value = ""
+    elif type(value) not in (str, unicode):
+        value = str(value)
+
+    decoded = _CSS_ESC.sub(_css_decode_one, value)
+
+    if not _CSS_VALUE_DISALLOWED.search(decoded):
+        id_chars = _NOT_ALPHANUMERIC.sub('', decoded).lower()
+        if not _CSS_IDENT_DISALLOWED.search(id_chars):
+            return decoded
+    return 'zSafehtmlz'
+
+_CSS_VALUE_DISALLOWED = re.compile(r'[\0"\'()/;@\[\\\]`{}<]|--')
+
+_CSS_IDENT_DISALLOWED = re.compile(r'(?i)\A(?:expression|(moz)?binding)')
+
+_NOT_ALPHANUMERIC = re.compile(r'[^A-Za-z0-9]+')
+
+_CSS_ESC = re.compile(r'\\([0-9A-Fa-f]+)[\t\n\f\r ]?')
+
+
+def _css_decode_one(match):
+    """
+    r'\a' -> '\n'.
+    Expects hex digits in group 1 as per _CSS_ESC.
+    """
+    return unichr(int(match.group(1), 16))
+
+
+_ESCAPE_MAP_FOR_HTML = {
+    # The HTML5 parser replaces NULs with the unknown codepoint rune.
+    "\x00": "&#xfffd;",
+    "&": "&amp;",
+    "<": "&lt;",
+    ">": "&gt;",
+    }
+
+def _replacer_for_html(match):
+    """A regex replacer"""
+    group = match.group(0)
+    encoded = _ESCAPE_MAP_FOR_HTML.get(group)
+    if encoded is None:
+        encoded = "&#%d;" % ord(group)
+        _ESCAPE_MAP_FOR_HTML[group] = encoded
+    return encoded
+
+
+_ESCAPE_MAP_FOR_ESCAPE_JS_STRING__AND__ESCAPE_JS_REGEX = {
+    # We do not escape "\x08" to "\\b" since that means word-break in RegExps.
+    "\x09": "\\t",
+    "\x0a": "\\n",
+    "\x0c": "\\f",
+    "\x0d": "\\r",
+    "/": "\\/",
+    "\\": "\\\\",
+    }
+
+def _replacer_for_js(match):
+    """A replacer for characters in JS strings and regular expressions."""
+    group = match.group(0)
+    encoded = _ESCAPE_MAP_FOR_ESCAPE_JS_STRING__AND__ESCAPE_JS_REGEX.get(group)
+    if encoded is None:
+        # "\u2028" -> "\\u2028"
+        char_code = ord(group)
+        if char_code < 0x100:
+            encoded = r'\x%02x' % char_code
+        else:
+            encoded = r'\u%04x' % char_code
+        _ESCAPE_MAP_FOR_ESCAPE_JS_STRING__AND__ESCAPE_JS_REGEX[group] = encoded
+    return encoded
+
+def _replacer_for_js_escs(match):
+    """
+    A replacer for escape sequences, broken escape sequences and certain
+    characters.
+    """
+    group = match.group(0)
+    if len(group) > 1 and group[0] == '\\':
+        esc = group[1:]
+        if ('A' <= esc <= 'Z') or ('a' <= esc <= 'z') or ('0' <= esc <= '9'):
+            return group
+        group = esc
+    encoded = _ESCAPE_MAP_FOR_ESCAPE_JS_STRING__AND__ESCAPE_JS_REGEX.get(group)
+    if encoded is None:
+        # "\u2028" -> "\\u2028"
+        char_code = ord(group)
+        if char_code < 0x100:
+            encoded = r'\x%02x' % char_code
+        else:
+            encoded = r'\u%04x' % char_code
+        _ESCAPE_MAP_FOR_ESCAPE_JS_STRING__AND__ESCAPE_JS_REGEX[group] = encoded
+    return encoded
+
+_ESCAPE_MAP_FOR_ESCAPE_CSS_STRING = {
+    '\\': r'\\',
+    }
+
+def _replacer_for_css(match):
+    """A regexp replacer."""
+    group = match.group(0)
+    encoded = _ESCAPE_MAP_FOR_ESCAPE_CSS_STRING.get(group)
+    if encoded is None:
+        encoded = r'\%x ' % ord(group)
+        _ESCAPE_MAP_FOR_ESCAPE_CSS_STRING[group] = encoded
+    return encoded
+
+
+_MATCHER_FOR_ESCAPE_HTML = re.compile(r'[\x00"&\x27+<>`]')
+
+_MATCHER_FOR_ESCAPE_HTML_SQ_ONLY = re.compile(r'[\x00&\x27+<>`]')
+
+_MATCHER_FOR_ESCAPE_HTML_DQ_ONLY = re.compile(r'[\x00&"+<>`]')
+
+_MATCHER_FOR_NORMALIZE_HTML = re.compile(r'[\x00"\x27+<>]')
+
+_MATCHER_FOR_ESCAPE_JS_STRING = re.compile(
+    ur'[\x00\x08-\x0d"&\x27+/<=>\\`\x7f\x85\u2028\u2029]')
+
+_MATCHER_FOR_NORMALIZE_JS_STRING = re.compile(
+    ur'(?s)(?:\\(.|\Z)|[\n\r\"\'+<=>&\u2028\u2029])')
+
+_MATCHER_FOR_ESCAPE_JS_REGEX = re.compile(
+    ur'[\x00\x08-\x0d"$&-+\--/:<-?\[-^`\x7b-\x7d\x7f\x85\u2028\u2029]')
+
+_MATCHER_FOR_NORMALIZE_JS_REGEX = re.compile(
+    # A '*' or '/' at the beginning could turn a /{{.}}/ into a comment.
+    ur'(?s)(?:\A[*]|\\(.|\Z)|[\n\r+\"\'/<=>&\u2028\u2029])')
+
+_MATCHER_FOR_ESCAPE_CSS_STRING = re.compile(
+    ur'[\x00\x08-\x0d"&-*/:->+@\\`\x7b\x7d\x85\xa0\u2028\u2029]')
+
+_FILTER_FOR_FILTER_URL = re.compile(
+    r'(?i)\A(?:(?:https?|mailto):|[^&:/?#]*(?:[/?#]|\Z))')
+
+_FILTER_FOR_FILTER_HTML_ATTRIBUTE = re.compile(
+    r'(?i)\A(?:[a-z0-9_$:\-]+|dir=(?:ltr|rtl))\Z')
+
+_FILTER_FOR_FILTER_HTML_ELEMENT_NAME = re.compile(
+    r'(?i)\A(?!script|style|title|textarea|xmp|no)[a-z0-9_$:\-]*\Z')
+
+def _escape_html_helper(value):
+    """ '<a&gt;' -> '&lt;a&amp;gt;' """
+    return _MATCHER_FOR_ESCAPE_HTML.sub(_replacer_for_html, value)
+
+def escape_html_sq_only(value):
+    """ Escapes an HTML attribute value for embedding between single quotes."""
+    return _MATCHER_FOR_ESCAPE_HTML_SQ_ONLY.sub(_replacer_for_html, value)
+
+def escape_html_dq_only(value):
+    """ Escapes an HTML attribute value for embedding between double quotes."""
+    return _MATCHER_FOR_ESCAPE_HTML_DQ_ONLY.sub(_replacer_for_html, value)
+
+def _normalize_html_helper(value):
+    """ '<a&gt;' -> '&lt;a&gt;' """
+    return _MATCHER_FOR_NORMALIZE_HTML.sub(_replacer_for_html, value)
+
+def _escape_js_string_helper(value):
+    """ '</script>' -> '\x3c/script\x3e' """
+    return _MATCHER_FOR_ESCAPE_JS_STRING.sub(_replacer_for_js, value)
+
+def _normalize_js_string_helper(value):
+    """ '</script>' -> '\x3c/script\x3e' """
+    return _MATCHER_FOR_NORMALIZE_JS_STRING.sub(_replacer_for_js_escs, value)
+
+def _escape_js_regex_helper(value):
+    """ '</script>' -> '\x3c\x2fscript\x3e' """
+    return _MATCHER_FOR_ESCAPE_JS_REGEX.sub(_replacer_for_js, value)
+
+def _normalize_js_regex_helper(value):
+    """ '</script>' -> '\x3c/script\x3e' """
+    return _MATCHER_FOR_NORMALIZE_JS_REGEX.sub(_replacer_for_js_escs, value)
+
+def _escape_css_string_helper(value):
+    """ '</style>' -> '\3c \2f style\3e ' """
+    return _MATCHER_FOR_ESCAPE_CSS_STRING.sub(_replacer_for_css, value)
+
+def _filter_html_attribute_helper(value):
+    """ Whitelists attribute name=value pairs. """
+    if _FILTER_FOR_FILTER_HTML_ATTRIBUTE.search(value):
+        return value
+    return "zSafehtmlz"
+
+def _filter_element_name_helper(value):
+    """ Whitelists HTML element names parts. """
+    if _FILTER_FOR_FILTER_HTML_ELEMENT_NAME.search(value):
+        return value
+    return "zSafehtmlz"
+
+# Matches all tags, HTML comments, and DOCTYPEs in tag soup HTML.
+_HTML_TAG_REGEX = re.compile(
+    r'(?i)<(?:!|/?[a-z])(?:[^>\x27"]|"[^"]*"|\x27[^\x27]*\x27)*>')
+
+
+# The reference sanitizers indexed by ESC_MODE_*.
+REFERENCE_SANITIZERS = [None] * len(escaping.SANITIZER_FOR_ESC_MODE)
+REFERENCE_SANITIZERS[escaping.ESC_MODE_ESCAPE_HTML] = escape_html
+REFERENCE_SANITIZERS[escaping.ESC_MODE_ESCAPE_HTML_RCDATA] = (
+    escape_html_rcdata)
+REFERENCE_SANITIZERS[escaping.ESC_MODE_ESCAPE_HTML_ATTRIBUTE] = (
+    escape_html_attribute)
+REFERENCE_SANITIZERS[escaping.ESC_MODE_FILTER_HTML_ELEMENT_NAME] = (
+    filter_html_element_name)
+REFERENCE_SANITIZERS[escaping.ESC_MODE_FILTER_HTML_ATTRIBUTE] = (
+    filter_html_attribute)
+REFERENCE_SANITIZERS[escaping.ESC_MODE_FILTER_HTML_ATTR_SUFFIX] = (
+    filter_html_attr_suffix)
+REFERENCE_SANITIZERS[escaping.ESC_MODE_ESCAPE_JS_STRING] = escape_js_string
+REFERENCE_SANITIZERS[escaping.ESC_MODE_ESCAPE_JS_VALUE] = escape_js_value
+REFERENCE_SANITIZERS[escaping.ESC_MODE_ESCAPE_JS_REGEX] = escape_js_regex
+REFERENCE_SANITIZERS[escaping.ESC_MODE_ESCAPE_CSS_STRING] = escape_css_string
+REFERENCE_SANITIZERS[escaping.ESC_MODE_FILTER_CSS_VALUE] = filter_css_value
+REFERENCE_SANITIZERS[escaping.ESC_MODE_ESCAPE_URL] = escape_url
+REFERENCE_SANITIZERS[escaping.ESC_MODE_NORMALIZE_URL] = normalize_url
+REFERENCE_SANITIZERS[escaping.ESC_MODE_FILTER_URL] = filter_url
+REFERENCE_SANITIZERS[escaping.ESC_MODE_ELIDE] = elide
+REFERENCE_SANITIZERS[escaping.ESC_MODE_OPEN_QUOTE] = open_quote
+REFERENCE_SANITIZERS = tuple(REFERENCE_SANITIZERS)
+
+
+def _process_raw_text_lex(text, ctx):
+    """Lexes text with the sequential, uncached process_raw_text."""
+    cache = context_update.PROCESS_RAW_TEXT_CACHE
+    settings = cache.max_size, context_update.PARALLEL_THRESHOLD
+    try:
+        cache.resize(0)
+        context_update.PARALLEL_THRESHOLD = None
+        end_ctx, normalized, _, _ = context_update.process_raw_text(
+            text, ctx)
+        return end_ctx, normalized
+    except context_update.ContextUpdateFailure:
+        return context.STATE_ERROR, None
+    finally:
+        max_size, context_update.PARALLEL_THRESHOLD = settings
+        cache.resize(max_size)
+
+
+def _tracker_lex(text, ctx, normalize=True):
+    """Lexes text with a ContextTracker fed in pieces of varying size."""
+    rng = random.Random(len(text))
+    tracker = context_update.ContextTracker(ctx, normalize)
+    normalized = []
+    try:
+        pos = 0
+        while pos < len(text):
+            size = rng.choice((1, 2, 3, 7, 40, 1000))
+            normalized.append(tracker.feed(text[pos:pos + size]))
+            pos += size
+        normalized.append(tracker.close())
+    except context_update.ContextUpdateFailure:
+        return context.STATE_ERROR, None
+    if not normalize:
+        return tracker.context, None
+    if context.is_error_context(tracker.context):
+        return tracker.context, None
+    return tracker.context, ''.join(normalized)
+
+
+# The TransferSummary for the text last lexed by _summary_lex.
+_SUMMARY = [None]
+
+def _summary_lex(text, ctx):
+    """
+    Lexes text with a TransferSummary shared by the start contexts that the
+    same text is lexed in, as escape does for text nodes.
+    """
+    summary = _SUMMARY[0]
+    if summary is None or summary.raw_text is not text:
+        summary = _SUMMARY[0] = context_update.TransferSummary(text)
+    try:
+        end_ctx, normalized, _, _ = summary.process(ctx)
+    except context_update.ContextUpdateFailure:
+        return context.STATE_ERROR, None
+    return end_ctx, normalized
+
+
+def _end_context_lex(text, ctx):
+    """Computes only the context after text."""
+    try:
+        return context_update.end_context(text, ctx)[0], None
+    except context_update.ContextUpdateFailure:
+        return context.STATE_ERROR, None
+
+
+class _InlinePool(object):
+    """
+    Stands in for multiprocessing.Pool by running jobs in this process, so
+    that the parallel lexer can be compared on every input without
+    starting processes for each.
+    """
+
+    def __init__(self, processes):
+        pass
+
+    def map(self, func, jobs):
+        """Runs func on each job in turn."""
+        return map(func, jobs)
+
+    def terminate(self):
+        """Nothing to stop."""
+
+    def join(self):
+        """Nothing to wait for."""
+
+
+def _parallel_lex(text, ctx):
+    """Lexes text in pieces as process_raw_text does for long texts."""
+    cache = context_update.PROCESS_RAW_TEXT_CACHE
+    settings = (cache.max_size, context_update.PARALLEL_THRESHOLD,
+                context_update.PARALLEL_PROCESSES,
+                context_update._PARALLEL_LOOKAHEAD, multiprocessing.Pool)
+    try:
+        cache.resize(0)
+        context_update.PARALLEL_THRESHOLD = 0
+        context_update.PARALLEL_PROCESSES = 3
+        # Short enough that runs through long tokens stop at the limit.
+        context_update._PARALLEL_LOOKAHEAD = 64
+        context_update.close_parallel_pool()
+        multiprocessing.Pool = _InlinePool
+        end_ctx, normalized, _, _ = context_update.process_raw_text(
+            text, ctx)
+        return end_ctx, normalized
+    except context_update.ContextUpdateFailure:
+        return context.STATE_ERROR, None
+    finally:
+        (max_size, context_update.PARALLEL_THRESHOLD,
+         context_update.PARALLEL_PROCESSES,
+         context_update._PARALLEL_LOOKAHEAD, multiprocessing.Pool) = settings
+        cache.resize(max_size)
+        context_update.close_parallel_pool()
+
+
+# Maps names of alternate lexers to (a function like reference_lex,
+# True iff it computes normalized text).  Engines that do not normalize
+# are compared by end context only.
+LEXER_ENGINES = {
+    'process_raw_text': (_process_raw_text_lex, True),
+    'ContextTracker': (_tracker_lex, True),
+    'ContextTracker(normalize=False)': (
+        lambda text, ctx: _tracker_lex(text, ctx, False), False),
+    'TransferSummary': (_summary_lex, True),
+    'end_context': (_end_context_lex, False),
+    'parallel': (_parallel_lex, True),
+    }
+
+def _esc_mode_chains():
+    """The tuples of ESC_MODE_* that esc_mode_for_hole produces."""
+    chains = set()
+    for ctx in xrange(context.CONTEXT_BOUND):
+        if context.state_of(ctx) < context.COUNT_OF_STATES:
+            _, esc_modes, _ = escaping.esc_mode_for_hole(ctx)
+            if None not in esc_modes:
+                chains.add(esc_modes)
+    return sorted(chains)
+
+
+def _sanitizer_name(esc_modes):
+    """A name for a chain of sanitizers."""
+    return ' | '.join([REFERENCE_SANITIZERS[esc_mode].__name__
+                       for esc_mode in esc_modes])
+
+
+# Maps names of alternate sanitizers to (a tuple of ESC_MODE_*, a function
+# that should give the same output as applying REFERENCE_SANITIZERS for each
+# in order).
+SANITIZER_ENGINES = {}
+for _esc_mode, _sanitizer in enumerate(escaping.SANITIZER_FOR_ESC_MODE):
+    if _sanitizer is not None and REFERENCE_SANITIZERS[_esc_mode] is not None:
+        SANITIZER_ENGINES['escaping.' + _sanitizer.__name__] = (
+            (_esc_mode,), _sanitizer)
+for _esc_modes in _esc_mode_chains():
+    if len(_esc_modes) > 1:
+        SANITIZER_ENGINES['fused ' + _sanitizer_name(_esc_modes)] = (
+            _esc_modes, escaping.sanitizer_for_esc_modes(_esc_modes))
+
+
+def literal_corpus():
+    """The text literals in the test files of this directory."""
+    strings = set()
+    for name in sorted(os.listdir(_TESTS_DIR)):
+        if not name.endswith('.py'):
+            continue
+        with open(os.path.join(_TESTS_DIR, name)) as inp:
+            tree = ast.parse(inp.read(), name)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Str):
+                try:
+                    strings.add(unicode(node.s))
+                except UnicodeDecodeError:
+                    # Not text.
+                    pass
+    return sorted(strings)
+
+
+# Fragments of HTML, CSS and JS that generated inputs are made of.
+_FRAGMENTS = (
+    u'<', u'>', u'</', u'<a', u'<b>', u'</b>', u'<script>', u'</script>',
+    u'<style>', u'</style>', u'<title>', u'</title>', u'<textarea>',
+    u'<!--', u'-->', u' ', u'\n', u'=', u'"', u"'", u'`', u' href=',
+    u' title=', u' onclick=', u' style=', u' src=', u'&amp;', u'&quot;',
+    u'&#39;', u'&#x22;', u'&lt;', u'&', u'/', u'//', u'/*', u'*/', u'\\',
+    u'\\"', u'x', u'42', u'.', u'++', u'return ', u'(', u')', u'[', u']',
+    u'{', u'}', u';', u'?', u'#', u':', u'url(', u'http://a/b?c=d#e',
+    u'javascript:', u'color: red', u'\u2028', u'\u00e9', u'\x00',
+    )
+
+
+def generated_corpus(seed, count):
+    """count inputs made of random _FRAGMENTS."""
+    rng = random.Random(seed)
+    inputs = []
+    for _ in xrange(count):
+        inputs.append(u''.join([
+            rng.choice(_FRAGMENTS) for _ in xrange(rng.randint(1, 40))]))
+    return inputs
+
+
+def sanitizer_inputs(strings):
+    """Untrusted values for the sanitizers made from strings."""
+    values = [None, 0, -1, 42, 1.5, True, False]
+    kinds = (content.SafeHTML, content.SafeCSS, content.SafeJS,
+             content.SafeJSStr, content.SafeURL, content.SafeHTMLAttr)
+    for index, string in enumerate(strings):
+        values.append(string)
+        if index % 10 == 0:
+            values.append(kinds[index // 10 % len(kinds)](string))
+    return values
+
+
+# Parts of URLs like those in search links and tracking parameters.
+_URL_PARTS = (
+    u'https://www.example.com/search', u'?q=', u'&q=', u'&hl=en',
+    u'&utm_source=newsletter', u'&utm_medium=e-mail', u'&utm_campaign=',
+    u'spring sale', u'caf\u00e9+au+lait', u'%20', u'%2F', u'%zz', u'%',
+    u'&ref=a|b', u'#top', u'/a/b/c.html', u'"quoted"', u"O'Reilly (1)",
+    u'<b>', u'\u4e2d\u6587', u'\U0001d11e', u'\x00', u'[]', u'~user',
+    )
+
+
+def url_corpus(seed, count):
+    """count query-heavy URLs made of random _URL_PARTS."""
+    rng = random.Random(seed)
+    urls = []
+    for _ in xrange(count):
+        urls.append(u''.join([
+            rng.choice(_URL_PARTS) for _ in xrange(rng.randint(1, 30))]))
+    return urls + [url.encode('UTF-8') for url in urls[::4]]
+
+
+def _reference_pct_encode(pattern):
+    """
+    A URL sanitizer that percent-encodes each run of characters that
+    pattern matches as it is found, for comparison with the table driven
+    escaping.escape_url and escaping.normalize_url.
+    """
+    matcher = re.compile(pattern)
+    def encode_run(match):
+        """Percent-encodes the UTF-8 bytes of a run."""
+        run = match.group(0)
+        if type(run) is unicode:
+            run = run.encode('UTF-8')
+        return ''.join(['%%%02x' % ord(byte) for byte in run])
+    def sanitizer(value):
+        """Percent-encodes value."""
+        if value is None:
+            return ''
+        if type(value) not in (str, unicode):
+            value = str(value)
+        return matcher.sub(encode_run, value)
+    return sanitizer
+
+
+# Maps the URL sanitizers to equivalent regular expression based ones.
+URL_SANITIZERS = (
+    (escaping.escape_url,
+     _reference_pct_encode(r'[^0-9A-Za-z\._~\-]+')),
+    (escaping.normalize_url,
+     _reference_pct_encode(
+         r'(?:[^0-9A-Za-z\._~:/?#\[\]@!$&*+,;=%\-]|%(?![0-9A-Fa-f]{2}))+')),
+    )
+
+
+def _time(fn, inputs):
+    """
+    Runs fn on each input.  Returns (outputs, seconds taken) where an input
+    that raised has the type of the exception as its output, so engines must
+    fail the same way as the reference.
+    """
+    outputs = []
+    start = time.time()
+    for args in inputs:
+        try:
+            outputs.append(fn(*args))
+        except Exception, err:
+            outputs.append(type(err))
+    return outputs, time.time() - start
+
+
+def _rate(chars, seconds):
+    """Throughput in a human readable form."""
+    return '%8.2f kchars/s' % (chars / max(seconds, 1e-6) / 1000)
+
+
+def _comparable(outcome, normalizes):
+    """
+    Drops the parts of an output of a lexer engine that need not agree:
+    the normalized text for engines that do not compute it, and the
+    details of error contexts.
+    """
+    if isinstance(outcome, tuple):
+        end_ctx, normalized = outcome
+        if context.is_error_context(end_ctx):
+            return context.STATE_ERROR, None
+        if not normalizes:
+            return end_ctx, None
+    return outcome
+
+
+def _describe_lexed(outcome):
+    """A human readable form of an output of a lexer engine."""
+    if isinstance(outcome, tuple):
+        end_ctx, normalized = outcome
+        return '%s %r' % (debug.context_to_string(end_ctx), normalized)
+    return 'raised %s' % outcome.__name__
+
+
+def _length(value):
+    """The length of the string form of an untrusted value."""
+    try:
+        return len(unicode(value))
+    except UnicodeDecodeError:
+        return len(value)
+
+
+class DifferentialTest(unittest.TestCase):
+    """Compares alternate engines to the reference implementations."""
+
+    def setUp(self):
+        self.texts = literal_corpus() + generated_corpus(SEED, GENERATED)
+
+    def test_lexers(self):
+        """Compares LEXER_ENGINES to reference_lex."""
+        inputs = [(text, ctx) for text in self.texts
+                  for ctx in START_CONTEXTS]
+        chars = sum([len(text) for text, _ in inputs])
+        want, ref_seconds = _time(reference_lex, inputs)
+        report = ['%-32s %s' % ('reference', _rate(chars, ref_seconds))]
+        failures = []
+        for name, (engine, normalizes) in sorted(LEXER_ENGINES.items()):
+            got, seconds = _time(engine, inputs)
+            mismatches = 0
+            for (text, ctx), want_out, got_out in zip(inputs, want, got):
+                want_out = _comparable(want_out, normalizes)
+                got_out = _comparable(got_out, normalizes)
+                if want_out == got_out:
+                    continue
+                mismatches += 1
+                if mismatches <= 3:
+                    failures.append(
+                        '%s from %s on %r:\n  reference: %s\n  %-9s: %s' % (
+                            name, debug.context_to_string(ctx), text,
+                            _describe_lexed(want_out), name[:9],
+                            _describe_lexed(got_out)))
+            report.append('%-32s %s  %5.2fx  %d mismatches' % (
+                name, _rate(chars, seconds),
+                ref_seconds / max(seconds, 1e-6), mismatches))
+        print >> sys.stderr, '\n'.join(report)
+        self.assertFalse(failures, '\n'.join(failures))
+
+    def test_sanitizers(self):
+        """Compares SANITIZER_ENGINES to REFERENCE_SANITIZERS."""
+        values = sanitizer_inputs(self.texts)
+        inputs = [(value,) for value in values]
+        chars = sum([_length(value) for value in values])
+        chains = set([(esc_mode,) for esc_mode, reference
+                      in enumerate(REFERENCE_SANITIZERS)
+                      if reference is not None])
+        chains.update([esc_modes for esc_modes, _
+                       in SANITIZER_ENGINES.values()])
+        report = []
+        failures = []
+        for esc_modes in sorted(chains):
+            def reference(value):
+                """Applies the reference sanitizers in order."""
+                for esc_mode in esc_modes:
+                    value = REFERENCE_SANITIZERS[esc_mode](value)
+                return value
+            # Patterns and tables are built on first use, so the first pass
+            # is not timed.
+            _time(reference, inputs)
+            want, ref_seconds = _time(reference, inputs)
+            report.append('%-32s %s' % (
+                _sanitizer_name(esc_modes), _rate(chars, ref_seconds)))
+            for name, (engine_modes, engine) in sorted(
+                SANITIZER_ENGINES.items()):
+                if engine_modes != esc_modes:
+                    continue
+                _time(engine, inputs)
+                got, seconds = _time(engine, inputs)
+                mismatches = 0
+                for value, want_out, got_out in zip(values, want, got):
+                    if (want_out == got_out
+                        and type(want_out) == type(got_out)):
+                        continue
+                    mismatches += 1
+                    if mismatches <= 3:
+                        failures.append(
+                            '%s on %r:\n  reference: %r\n  %-9s: %r' % (
+                                name, value, want_out, name[:9], got_out))
+                report.append('  %-30s %s  %5.2fx  %d mismatches' % (
+                    name[:30], _rate(chars, seconds),
+                    ref_seconds / max(seconds, 1e-6), mismatches))
+        print >> sys.stderr, '\n'.join(report)
+        self.assertFalse(failures, '\n'.join(failures))
+
+    def test_url_sanitizers(self):
+        """
+        Compares the URL sanitizers to URL_SANITIZERS on query-heavy URLs.
+        """
+        urls = url_corpus(SEED, GENERATED * 10)
+        inputs = [(url,) for url in urls]
+        chars = sum([len(url) for url in urls])
+        report = []
+        failures = []
+        for sanitizer, reference in URL_SANITIZERS:
+            _time(sanitizer, inputs)
+            _time(reference, inputs)
+            want, ref_seconds = _time(reference, inputs)
+            got, seconds = _time(sanitizer, inputs)
+            report.append('%-32s %s' % (
+                'regex ' + sanitizer.__name__, _rate(chars, ref_seconds)))
+            mismatches = 0
+            for url, want_out, got_out in zip(urls, want, got):
+                if want_out == got_out and type(want_out) == type(got_out):
+                    continue
+                mismatches += 1
+                if mismatches <= 3:
+                    failures.append('%s on %r:\n  regex: %r\n  got  : %r' % (
+                        sanitizer.__name__, url, want_out, got_out))
+            report.append('  %-30s %s  %5.2fx  %d mismatches' % (
+                sanitizer.__name__, _rate(chars, seconds),
+                ref_seconds / max(seconds, 1e-6), mismatches))
+        print >> sys.stderr, '\n'.join(report)
+        self.assertFalse(failures, '\n'.join(failures))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,9 @@
 
 """Unit tests for module escape"""
 
-from autoesc import content, escape, template
+from autoesc import content, context, escape, escaping, file, template
+import StringIO
+import cStringIO
 import sys
 import unittest
 
@@ -1100,6 +1102,458 @@ class EscapeTest(unittest.TestCase):
                     % (test_input, got, want))
 
 
+    def test_escape_minify(self):
+        """
+        Tests that minified templates collapse whitespace that does not
+        affect their output.
+        """
+        data = {'X': 'a  b', 'Y': '</b>'}
+        tests = (
+            (
+                '<p  class="{{.X}}"  >\n  <b>{{.Y}}</b>\n  </p>',
+                '<p class="a  b">\n<b>&lt;/b&gt;</b>\n</p>',
+            ),
+            (
+                '<script>\n  var x = {{.X}} ;  /* y */\n  f(  x  )\n</script>',
+                '<script>\nvar x = "a  b" ;\nf( x )\n</script>',
+            ),
+            (
+                '<style>\n  p  { color:  red }\n</style>',
+                '<style> p { color: red } </style>',
+            ),
+            # Whitespace in HTML text matters when it is preformatted.
+            (
+                '<pre>  {{.X}}\n  x  </pre>  <i  >y</i  >',
+                '<pre>  a  b\n  x  </pre>  <i>y</i>',
+            ),
+            (
+                '<listing>  a\n    b  {{.X}}</listing>',
+                '<listing>  a\n    b  a  b</listing>',
+            ),
+            )
+        for test_input, want in tests:
+            env = template.parse_templates('test', test_input, 'main')
+            escape.escape(env.templates, ('main',), minify=True)
+            self.assertEquals(want, env.with_data(data).sexecute('main'))
+
+    def test_esc_mode_for_hole(self):
+        """
+        Test that memoized escaping modes match computing them directly.
+        """
+        for state in xrange(context.COUNT_OF_STATES):
+            for attr in (context.ATTR_NONE, context.ATTR_URL):
+                for delim in (context.DELIM_NONE,
+                              context.DELIM_DOUBLE_QUOTE,
+                              context.DELIM_SPACE_OR_TAG_END):
+                    for url_part in (context.URL_PART_NONE,
+                                     context.URL_PART_QUERY_OR_FRAG,
+                                     context.URL_PART_UNKNOWN):
+                        ctx = state | attr | delim | url_part
+                        want = escaping._compute_esc_mode_for_hole(ctx)
+                        self.assertEquals(
+                            want, escaping.esc_mode_for_hole(ctx))
+                        self.assertTrue(
+                            escaping.esc_mode_for_hole(ctx)
+                            is escaping.esc_mode_for_hole(ctx))
+        self.assertEquals(
+            (context.STATE_URL | context.URL_PART_PRE_QUERY,
+             (escaping.ESC_MODE_FILTER_URL, escaping.ESC_MODE_NORMALIZE_URL),
+             None),
+            escaping.esc_mode_for_hole(context.STATE_URL))
+
+    def test_escape_tables(self):
+        """
+        Test that the escape tables cover every character that their
+        matchers match and are not changed by escaping.
+        """
+        tests = (
+            (escaping._MATCHER_FOR_ESCAPE_HTML,
+             escaping._ESCAPE_TABLES_FOR_HTML),
+            (escaping._MATCHER_FOR_ESCAPE_HTML_SQ_ONLY,
+             escaping._ESCAPE_TABLES_FOR_HTML),
+            (escaping._MATCHER_FOR_ESCAPE_HTML_DQ_ONLY,
+             escaping._ESCAPE_TABLES_FOR_HTML),
+            (escaping._MATCHER_FOR_NORMALIZE_HTML,
+             escaping._ESCAPE_TABLES_FOR_HTML),
+            (escaping._MATCHER_FOR_ESCAPE_JS_STRING,
+             escaping._ESCAPE_TABLES_FOR_JS),
+            (escaping._MATCHER_FOR_ESCAPE_JS_REGEX,
+             escaping._ESCAPE_TABLES_FOR_JS),
+            (escaping._MATCHER_FOR_ESCAPE_CSS_STRING,
+             escaping._ESCAPE_TABLES_FOR_CSS),
+            )
+        all_chars = u''.join([unichr(i) for i in xrange(0x10000)])
+        for matcher, tables in tests:
+            matched = matcher.findall(all_chars)
+            self.assertTrue(matched, matcher.pattern)
+            for char in matched:
+                self.assertTrue(char in tables[unicode], repr(char))
+                if ord(char) < 0x100:
+                    self.assertTrue(
+                        chr(ord(char)) in tables[str], repr(char))
+        sizes = [len(tables[unicode]) for _, tables in tests]
+        for sanitizer in (escaping.escape_html, escaping.escape_js_string,
+                          escaping.escape_js_regex, escaping.escape_css_string):
+            sanitizer(all_chars)
+            sanitizer(all_chars.encode('UTF-8'))
+            # Values with nothing to escape are returned as is.
+            plain = u'Hello, World'
+            self.assertTrue(sanitizer(plain) is plain)
+        self.assertEquals(
+            sizes, [len(tables[unicode]) for _, tables in tests])
+        # Escaped characters need not be in the tables.
+        self.assertEquals(
+            r'\u2028\xe9\x22\\',
+            escaping.escape_js_string(
+                content.SafeJSStr(u'\u2028\\\xe9"\\\\')))
+
+    def test_pct_encode(self):
+        """
+        Test that the URL sanitizers encode UTF-8 bytes and keep the type
+        of their input.
+        """
+        tests = (
+            (escaping.escape_url, u'a b/\xe9?q=%zz',
+             u'a%20b%2f%c3%a9%3fq%3d%25zz'),
+            (escaping.escape_url, 'a b/\xc3\xa9\xff',
+             'a%20b%2f%c3%a9%ff'),
+            (escaping.escape_url, u'\U0001d11e', u'%f0%9d%84%9e'),
+            (escaping.normalize_url, u'/a b?q=%2F&r=%zz\xe9%',
+             u'/a%20b?q=%2F&r=%25zz%c3%a9%25'),
+            (escaping.normalize_url, '"O\'Reilly" (1)',
+             '%22O%27Reilly%22%20%281%29'),
+            )
+        for sanitizer, value, want in tests:
+            got = sanitizer(value)
+            self.assertEquals(want, got)
+            self.assertEquals(type(value), type(got), repr(value))
+        for sanitizer in (escaping.escape_url, escaping.normalize_url):
+            for plain in (u'Hello-World_1.0~', 'Hello-World_1.0~'):
+                self.assertTrue(sanitizer(plain) is plain)
+        all_bytes = ''.join([chr(i) for i in xrange(0x100)])
+        self.assertEquals(
+            ''.join([char if char.isalnum() or char in '-._~'
+                     else '%%%02x' % ord(char) for char in all_bytes]),
+            escaping.escape_url(all_bytes))
+
+    def test_escape_many(self):
+        """
+        Test that escaping values in a batch matches escaping them one by one.
+        """
+        values = [
+            None, True, False, 0, 1, 42, 1.5, 0.0, -0.0, 2 ** 70,
+            '', u'', 'a', u'a',
+            '<b>', u'<b>', 'x\x1fy', u'\x1f', u'\u2028"\'', '\xc3\xa9\\',
+            u'http://example.com/?a=b&c=<d>', 'javascript:alert(1)',
+            content.SafeHTML('<b>1 &lt; 2</b>'), content.SafeURL('/?a=b'),
+            content.SafeJSStr(u'\\"'), ['<a>', 1], GoodMarshaler(),
+            ]
+        values += values[::-1]
+        chains = [(), (escaping.ESC_MODE_ESCAPE_HTML,)]
+        for state in xrange(context.COUNT_OF_STATES):
+            for delim in (context.DELIM_NONE, context.DELIM_DOUBLE_QUOTE):
+                _, esc_modes, _ = escaping.esc_mode_for_hole(state | delim)
+                if None not in esc_modes:
+                    chains.append(esc_modes)
+        for esc_modes in chains:
+            sanitizer = escaping.sanitizer_for_esc_modes(esc_modes)
+            want = [sanitizer(value) for value in values]
+            got = escaping.escape_many(esc_modes, values)
+            self.assertEquals(want, got, esc_modes)
+            self.assertEquals(
+                [type(value) for value in want],
+                [type(value) for value in got], esc_modes)
+            self.assertEquals(
+                want[4:6], escaping.escape_many(esc_modes, tuple(values[4:6])))
+        self.assertEquals([], escaping.escape_many((), []))
+
+        failed = []
+        def picky(value):
+            """Fails on values that contain "bad"."""
+            if 'bad' in value:
+                failed.append(value)
+                raise ValueError(value)
+            return value
+        self.assertRaises(
+            ValueError, escaping._escape_joined, picky, ['a', 'bad', 'b'])
+        # The failure is reported for the value at fault, not the batch.
+        self.assertEquals('bad', failed[-1])
+        try:
+            import numpy
+        except ImportError:
+            return
+        self.assertEquals(
+            ['&lt;a&gt;', '1', '&lt;b&gt;', '2'],
+            escaping.escape_many(
+                (escaping.ESC_MODE_ESCAPE_HTML,),
+                numpy.array([['<a>', '1'], ['<b>', '2']])))
+        self.assertEquals(
+            ['1', '&lt;b&gt;', 'None'],
+            escaping.escape_many(
+                (escaping.ESC_MODE_ESCAPE_HTML,),
+                numpy.array([1, '<b>', None], dtype=object)))
+
+    def test_sanitizer_cache(self):
+        """
+        Test that memoized sanitizers agree with the sanitizers they wrap.
+        """
+        esc_modes = (escaping.ESC_MODE_ESCAPE_HTML,)
+        sanitizer = escaping.sanitizer_for_esc_modes(esc_modes)
+        values = [
+            '<b>', u'<b>', content.SafeHTML('<b>'), content.SafeHTML(u'<b>'),
+            content.SafeCSS('<b>'), 0, 0L, False, None, 0.0, -0.0, ['<b>'],
+            '<b>' * escaping.SANITIZER_CACHE_MAX_LENGTH,
+            ]
+        want = [escaping.escape_html(value) for value in values]
+        with escaping.SanitizerCacheScope(64) as scope:
+            for _ in xrange(2):
+                got = [sanitizer(value) for value in values]
+                self.assertEquals(want, got)
+                self.assertEquals(
+                    [type(value) for value in want],
+                    [type(value) for value in got])
+            # Floats, lists and long values are not cached.
+            self.assertEquals(9, scope.cache.hits)
+            self.assertEquals(9, scope.cache.misses)
+            with escaping.SanitizerCacheScope(0) as inner:
+                sanitizer('<b>')
+                self.assertEquals(0, inner.cache.misses)
+            sanitizer('<i>')
+            self.assertEquals(10, scope.cache.misses)
+        self.assertEquals(0, len(escaping.SANITIZER_CACHE))
+        escaping.SANITIZER_CACHE.resize(2)
+        try:
+            for value in ('a', 'b', 'a', 'c', 'b'):
+                sanitizer(value)
+            self.assertEquals(1, escaping.SANITIZER_CACHE.hits)
+            self.assertEquals(2, escaping.SANITIZER_CACHE.evictions)
+        finally:
+            escaping.SANITIZER_CACHE.resize(0)
+            escaping.SANITIZER_CACHE.clear()
+
+    def test_escape_js_value(self):
+        """
+        Test that escape_js_value encodes values as json.dumps does.
+        """
+        import json
+
+        def dumps(value):
+            """JSON with '<' and '>' escaped, delimited as a JS value."""
+            escaped = json.dumps(
+                value, allow_nan=True, separators=(',', ':'),
+                default=escaping._marshal_json_obj)
+            if escaped[0] == '{':
+                escaped = '(%s)' % escaped
+            elif escaped[0] not in '["':
+                escaped = ' %s ' % escaped
+            return escaped.replace('<', r'\x3c').replace('>', r'\x3e')
+
+        inf = float('inf')
+        for value in (
+            None, True, False, 0, -1, 2 ** 70, -2 ** 70, 0.0, -0.0, 1.5,
+            1e300, 1e-7, 0.1, inf, -inf, '', u'', 'a"b\\', '<>',
+            u'</script>\u2028', '\xc3\xa9', u'\U0001f600', '\x00\x1f\x7f',
+            [1, '<', None], {'a': '<b>'}, GoodMarshaler()):
+            self.assertEquals(dumps(value), escaping.escape_js_value(value))
+            self.assertEquals(
+                str, type(escaping.escape_js_value(value)), repr(value))
+        self.assertEquals(' NaN ', escaping.escape_js_value(float('nan')))
+        self.assertEquals(
+            None, escaping.escape_js_value(content.SafeJS('</SCRIPT>')))
+        self.assertEquals(
+            'f(1)', escaping.escape_js_value(content.SafeJS('f(1)')))
+        self.assertRaises(
+            UnicodeDecodeError, escaping.escape_js_value, '\xe9')
+
+    def test_escape_js_value_chunks(self):
+        """
+        Test that JS values encoded in chunks match escape_js_value.
+        """
+        big = {
+            'a': [u'</script>\u2028', 1.5, None, {'d': [1]}] * 1000,
+            'b': {'c': '<!--'},
+            'e': [[[['x'] * 100]]],
+            }
+        for value in (
+            big, [big, 'x'], (), {}, [], 'str', 42, None,
+            content.SafeJS('f()'), GoodMarshaler()):
+            chunks = list(escaping.escape_js_value_chunks(value, 64))
+            self.assertEquals(
+                escaping.escape_js_value(value), ''.join(chunks))
+        # No chunk holds much of a large value.
+        chunks = list(escaping.escape_js_value_chunks(big, 64))
+        self.assertTrue(
+            max([len(chunk) for chunk in chunks]) * 10
+            < len(''.join(chunks)))
+        cyclic = [0] * 100
+        cyclic.append([cyclic])
+        self.assertRaises(
+            ValueError, lambda: list(escaping.escape_js_value_chunks(cyclic)))
+
+        def render(write_value):
+            """Writes big in a script element and an attribute."""
+            out = cStringIO.StringIO()
+            stream = file.File(out)
+            stream.write_safe('<script>var x = ')
+            write_value(stream, big)
+            stream.write_safe(';</script><a onclick="f(')
+            write_value(stream, big)
+            stream.write_safe(')" title=')
+            write_value(stream, big)
+            stream.write_safe('>')
+            return out.getvalue()
+
+        self.assertEquals(
+            render(file.File.write), render(file.File.write_js_value))
+
+    def test_utf8_output(self):
+        """
+        Test that UTF-8 output matches encoding the output for unicode
+        values.
+        """
+        def to_utf8(value):
+            """value with its text encoded to UTF-8."""
+            if type(value) is unicode:
+                return value.encode('UTF-8')
+            if isinstance(value, content.TypedContent):
+                return type(value)(value.content.encode('UTF-8'))
+            return value
+
+        values = (
+            u'caf\xe9 <b>"1"</b> \u2028 %zz %2F \x85\xa0', u'\U0001d11e/?a=b',
+            u'plain', u'', u'javascript:alert(1)', u'\u0145',
+            content.SafeHTML(u'<b>\xe9</b>'), content.SafeURL(u'/\xe9?a'),
+            content.SafeJS(u'f("\xe9")'), content.SafeJSStr(u'\xe9\u2028'),
+            content.SafeCSS(u'\xe9'), 42, None)
+        chains = set()
+        for ctx in xrange(context.CONTEXT_BOUND):
+            if context.state_of(ctx) < context.COUNT_OF_STATES:
+                esc_modes = escaping.esc_mode_for_hole(ctx)[1]
+                if None not in esc_modes:
+                    chains.add(esc_modes)
+        for esc_modes in sorted(chains):
+            sanitizer = escaping.utf8_sanitizer_for_esc_modes(esc_modes)
+            for value in values:
+                try:
+                    want = escaping.sanitizer_for_esc_modes(esc_modes)(value)
+                except UnicodeEncodeError:
+                    # Typed content of a kind that the sanitizer ignores is
+                    # coerced with str.
+                    continue
+                if isinstance(want, content.TypedContent):
+                    want = want.content
+                if type(want) is unicode:
+                    want = want.encode('UTF-8')
+                for got in (sanitizer(value), sanitizer(to_utf8(value))):
+                    self.assertEquals(
+                        (str, want), (type(got), got),
+                        '%r on %r' % (esc_modes, value))
+        # Typed content of other kinds is read as text.
+        # ASCII text since the sanitizers coerce typed content with str.
+        texts = ('<a href="x">\\', "'</script>", '%zz%20 expression(')
+        for esc_mode, sanitizer in enumerate(
+            escaping.SANITIZER_FOR_ESC_MODE):
+            kinds = escaping._CONTENT_KINDS_FOR_ESC_MODE.get(esc_mode, ())
+            for kind in xrange(content.CONTENT_KIND_URL + 1):
+                if sanitizer is None or kind in kinds:
+                    continue
+                for text in texts:
+                    self.assertEquals(
+                        sanitizer(text),
+                        sanitizer(content.TypedContent(text, kind)),
+                        '%s %d %r' % (sanitizer.__name__, kind, text))
+            utf8_sanitizer = escaping.utf8_sanitizer_for_esc_modes(
+                (esc_mode,))
+            if (sanitizer is not None
+                and content.CONTENT_KIND_CSS not in kinds):
+                self.assertEquals(
+                    utf8_sanitizer(u'\xe9\u2028'),
+                    utf8_sanitizer(content.SafeCSS('\xc3\xa9\xe2\x80\xa8')))
+        # Malformed UTF-8 is read as U+FFFD, whether or not the chain
+        # decodes str values.
+        for esc_mode, sanitizer in (
+            (escaping.ESC_MODE_ESCAPE_JS_STRING, escaping.escape_js_string),
+            (escaping.ESC_MODE_ESCAPE_HTML, escaping.escape_html),
+            (escaping.ESC_MODE_ESCAPE_URL, escaping.escape_url),
+            ):
+            utf8_sanitizer = escaping.utf8_sanitizer_for_esc_modes(
+                (esc_mode,))
+            self.assertEquals(
+                to_utf8(sanitizer(u'\ufffd<\xe9')),
+                utf8_sanitizer('\xff<\xc3\xa9'))
+        self.assertEquals(
+            '\xef\xbf\xbd<b>',
+            escaping.utf8_sanitizer_for_esc_modes(
+                (escaping.ESC_MODE_ESCAPE_HTML,))(
+                    content.SafeHTML('\xff<b>')))
+
+        env = template.parse_templates(
+            'src',
+            u'<p title="\xe9{{.A}}">{{.B}}\u2028</p>'
+            u'<script>var x = {{.A}};//\u2028</script>'
+            u'<a href="/{{.B}}?q={{.A}}" onclick="f({{.C}})">\xe9</a>',
+            'main')
+        escape.escape(env.templates, ('main',))
+        data = {'A': u'<\xe9>\u2028', 'B': u'\U0001d11e"', 'C': 1.5}
+        want = StringIO.StringIO()
+        env.with_data(data).execute('main', want)
+        want = want.getvalue().encode('UTF-8')
+        self.assertEquals(want, env.with_data(data).sexecute_utf8('main'))
+        utf8_data = dict([(key, to_utf8(value))
+                          for key, value in data.items()])
+        self.assertEquals(
+            want, env.with_data(utf8_data).sexecute_utf8('main'))
+
+        def render(out, utf8, pieces):
+            """Writes safe strings and values alternately."""
+            stream = file.File(out, utf8=utf8)
+            for index, piece in enumerate(pieces):
+                if index % 2:
+                    stream.write(piece)
+                else:
+                    stream.write_safe(*piece)
+            return out.getvalue()
+
+        # U+2028 ends a line comment, even when split across chunks.
+        pieces = (
+            [u'<script>// \xe9', u'\u2028var x = '], u'\xe9"</script>',
+            [u';\n</script><a title='], u'\xe9 x',
+            [u'>'])
+        want = render(StringIO.StringIO(), False, pieces).encode('UTF-8')
+        self.assertEquals(want, render(cStringIO.StringIO(), True, pieces))
+        split = ('<script>// \xc3', '\xa9\xe2\x80', '\xa8var x = ')
+        utf8_pieces = [split] + [
+            index % 2 and to_utf8(piece)
+            or [to_utf8(chunk) for chunk in piece]
+            for index, piece in enumerate(pieces)][1:]
+        self.assertEquals(
+            want, render(cStringIO.StringIO(), True, utf8_pieces))
+
+    def test_file_errors(self):
+        """
+        Test that File reports safe chunks that do not lex as EscapeErrors.
+        """
+        for utf8 in (False, True):
+            # The error is found once the chunk is known to be complete.
+            for finish in (lambda stream: stream.write('x'),
+                           lambda stream: stream.close()):
+                stream = file.File(cStringIO.StringIO(), utf8=utf8)
+                stream.write_safe('<a title=x"y>')
+                self.assertRaises(escape.EscapeError, finish, stream)
+            # Or as soon as the lexer reaches it.
+            stream = file.File(cStringIO.StringIO(), utf8=utf8)
+            self.assertRaises(
+                escape.EscapeError, stream.write_safe,
+                '<a title=x"y>' + ' ' * 100)
+            self.assertRaises(escape.EscapeError, stream.write, 'x')
+        # A str that is not ASCII may be followed by unicode.
+        out = cStringIO.StringIO()
+        stream = file.File(out)
+        stream.write_safe('caf\xc3\xa9 ')
+        stream.write_safe(u'x')
+        stream.write(u'<')
+        self.assertEquals('caf\xc3\xa9 x&lt;', out.getvalue())
+
     def test_ensure_pipeline_contains(self):
         """
         Test the interaction between existing escaping directives and those
@@ -35,6 +35,18 @@ class HtmlTest(unittest.TestCase):
             html.unescape_html('&#x1d11e;&#xd834;&#xdd1e;'))
         self.assertEquals("&#;&#gt;&#xxa0;", "&#;&#gt;&#xxa0;")
 
+    def test_unescape_html_with_offsets(self):
+        """
+        Tests that unescape_html_with_offsets decodes like unescape_html and
+        reports where each entity's text came from.
+        """
+        raw = 'a&lt;b&#x4d;c&bogus;d'
+        text, entities = html.unescape_html_with_offsets(raw, 1, len(raw) - 1)
+        self.assertEquals(html.unescape_html(raw[1:-1]), text)
+        self.assertEquals('<bMc&bogus;', text)
+        self.assertEquals([(0, 1, 5), (2, 3, 12), (4, 11, 20)], entities)
+        self.assertEquals(('foo', []), html.unescape_html_with_offsets('foo'))
+
     def test_escape_html(self):
         """Test escape HTML on selected codepoints."""
         test_input = test_common.ASCII_AND_SELECTED_CODEPOINTS
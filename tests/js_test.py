@@ -102,6 +102,87 @@ class JsTest(unittest.TestCase):
             js.next_js_ctx("   ", context.STATE_JS | context.JS_CTX_DIV_OP),
             "Blank tokens")
 
+    def test_next_js_ctx_span(self):
+        """Test next_js_ctx on a span of a larger string"""
+        tests = (
+            (context.JS_CTX_REGEX, "x = return", 4, 10),
+            (context.JS_CTX_DIV_OP, "x = return", 0, 9),
+            (context.JS_CTX_DIV_OP, "x = return", 4, 7),
+            (context.JS_CTX_DIV_OP, "preturn", 0, 7),
+            (context.JS_CTX_REGEX, "preturn", 1, 7),
+            (context.JS_CTX_DIV_OP, "xinstanceof", 0, 11),
+            (context.JS_CTX_REGEX, "xinstanceof", 1, 11),
+            # Only signs within the span are counted.
+            (context.JS_CTX_DIV_OP, "x---", 2, 4),
+            (context.JS_CTX_REGEX, "x---", 1, 4),
+            (context.JS_CTX_REGEX, "0.", 1, 2),
+            (context.JS_CTX_DIV_OP, " 0. ", 0, 4),
+            (context.JS_CTX_REGEX, "x = .", 3, 5),
+            (context.JS_CTX_DIV_OP, u"\u00e9", 0, 1),
+            (context.JS_CTX_DIV_OP, u"x)\u2028 ;", 0, 3),
+            )
+
+        for want_ctx, js_code, start, end in tests:
+            got = js.next_js_ctx(
+                js_code, context.STATE_JS | context.JS_CTX_UNKNOWN,
+                start, end)
+            want = want_ctx | context.STATE_JS
+            self.assertEquals(
+                want, got,
+                "%r[%d:%d]: want %s got %s" % (
+                    js_code, start, end,
+                    debug.context_to_string(want),
+                    debug.context_to_string(got)))
+        self.assertEquals(
+            context.STATE_JS | context.JS_CTX_DIV_OP,
+            js.next_js_ctx(
+                "x   ", context.STATE_JS | context.JS_CTX_DIV_OP, 1, 4),
+            "Blank span")
+
+    def test_next_js_ctx_agrees_with_regex_heuristic(self):
+        """Compare next_js_ctx to a regular expression based version"""
+        def regex_next_js_ctx(js_tokens, ctx):
+            """The pattern based heuristic that next_js_ctx replaced."""
+            js_tokens = js_tokens.strip()
+            if not js_tokens:
+                return ctx
+            last_char = js_tokens[-1]
+            if last_char in '+-':
+                num_adjacent = len(js_tokens) - len(
+                    js_tokens.rstrip(last_char))
+                is_regex = (num_adjacent & 1) == 1
+            elif last_char == '.':
+                is_regex = len(js_tokens) == 1 or not (
+                    "0" <= js_tokens[-2] <= "9")
+            elif last_char == '/':
+                is_regex = len(js_tokens) <= 2
+            elif re.search(r'[!#%&(*,:;<=>?\[^{|}~]', last_char):
+                is_regex = True
+            else:
+                word = re.search(r'[\w$]+\Z', js_tokens)
+                is_regex = (word and word.group(0)) in (
+                    js._REGEX_PRECEDER_KEYWORDS)
+            return ((ctx & ~context.JS_CTX_ALL)
+                    | (context.JS_CTX_REGEX if is_regex
+                       else context.JS_CTX_DIV_OP))
+
+        pieces = (" ", "\n", "x", "0", "$", "return", "do", "typeof",
+                  "+", "-", ".", ")", "]", "}", "=", "/", u"\u2028",
+                  u"\u00e9", "throw")
+        start = context.STATE_JS | context.JS_CTX_UNKNOWN
+        for a in pieces:
+            for b in pieces:
+                for c in pieces:
+                    js_code = a + b + c
+                    self.assertEquals(
+                        regex_next_js_ctx(js_code, start),
+                        js.next_js_ctx(js_code, start),
+                        repr(js_code))
+                    self.assertEquals(
+                        regex_next_js_ctx(js_code[1:], start),
+                        js.next_js_ctx(js_code, start, 1, len(js_code)),
+                        repr(js_code))
+
 
     def test_js_val_escaper(self):
         """Tests escape_js_value"""
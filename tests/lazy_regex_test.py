@@ -0,0 +1,75 @@
+#!/usr/bin/env python -O
+
+"""Testcases for module lazy_regex"""
+
+from autoesc import lazy_regex
+import os
+import re
+import subprocess
+import sys
+import unittest
+
+
+# Imports the escaper in a fresh interpreter and reports the number of
+# patterns compiled and the time taken.
+_IMPORT_BENCHMARK = r'''
+import sre_compile, sys, time
+compiles = []
+compile = sre_compile.compile
+def counting_compile(pattern, flags=0):
+    compiles.append(pattern)
+    return compile(pattern, flags)
+sre_compile.compile = counting_compile
+# Import dependencies outside the package first.
+import cStringIO, collections, copy, functools, threading
+del compiles[:]
+start = time.time()
+import autoesc.file
+import autoesc.template
+elapsed = time.time() - start
+print len(compiles), elapsed
+'''
+
+
+class LazyRegexTest(unittest.TestCase):
+    """Testcases for module lazy_regex"""
+
+    def test_lazy_regex(self):
+        """
+        Tests that a LazyRegex behaves like the pattern it stands in for.
+        """
+        pattern = lazy_regex.compile(r'(?i)a(b+)|(c)', re.M)
+        self.assertEquals(r'(?i)a(b+)|(c)', pattern.pattern)
+        self.assertFalse('match' in pattern.__dict__)
+        compiled = re.compile(r'(?i)a(b+)|(c)', re.M)
+        self.assertEquals(compiled.flags, pattern.flags)
+        self.assertEquals(2, pattern.groups)
+        self.assertTrue('match' in pattern.__dict__)
+        self.assertEquals(
+            compiled.match('ABb').groups(), pattern.match('ABb').groups())
+        self.assertEquals('x-x', pattern.sub('x', 'ab-c'))
+        self.assertEquals(['Ab', 'c'], [
+            match.group() for match in pattern.finditer('xAbc')])
+        self.assertTrue(pattern.search('xyc', 1, 3) is not None)
+        self.assertTrue(pattern.compiled() is pattern.compiled())
+        self.assertRaises(AttributeError, getattr, pattern, 'no_such_attr')
+
+    def test_import_compiles_no_patterns(self):
+        """
+        Benchmarks importing the template and escaping modules, which
+        should not need to compile any patterns.
+        """
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+            + env.get('PYTHONPATH', '').split(os.pathsep))
+        output = subprocess.Popen(
+            [sys.executable, '-c', _IMPORT_BENCHMARK],
+            env=env, stdout=subprocess.PIPE).communicate()[0]
+        compiles, elapsed = output.split()
+        print >> sys.stderr, 'import took %.1fms' % (float(elapsed) * 1000)
+        self.assertEquals('0', compiles)
+
+
+if __name__ == '__main__':
+    unittest.main()
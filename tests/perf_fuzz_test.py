@@ -0,0 +1,252 @@
+#!/usr/bin/env python -O
+
+"""
+Fuzzes the lexer and sanitizers with inputs shaped to cause backtracking or
+quadratic behavior.  When timing is enabled, fails if any input takes longer
+per byte than a budget and reports the worst time per byte of each target.
+
+Wall-clock time depends on the machine and its load, so by default the
+inputs are only run, which catches errors and hangs but not slowness.
+
+Environment variables configure a run:
+  AUTOESC_FUZZ_TIMING - set to 1 to check inputs against the budget.
+  AUTOESC_FUZZ_SEED - seeds the generator.  Defaults to a fixed seed.
+  AUTOESC_FUZZ_ITERATIONS - number of random inputs per target.
+  AUTOESC_FUZZ_SIZE - approximate length of each generated input.
+  AUTOESC_FUZZ_BUDGET_US - budget in microseconds per input byte.
+  AUTOESC_FUZZ_CORPUS - directory that receives minimized slow inputs and
+      whose inputs are replayed first.
+"""
+
+from autoesc import context, context_update, escaping
+import hashlib
+import os
+import random
+import sys
+import time
+import unittest
+
+
+def _env_int(name, default):
+    """The integer value of the named environment variable or default."""
+    value = os.environ.get(name)
+    if value:
+        return int(value)
+    return default
+
+TIMING = bool(_env_int('AUTOESC_FUZZ_TIMING', 0))
+SEED = _env_int('AUTOESC_FUZZ_SEED', 0x5eed)
+ITERATIONS = _env_int('AUTOESC_FUZZ_ITERATIONS', 40)
+SIZE = _env_int('AUTOESC_FUZZ_SIZE', 20000)
+BUDGET_US = _env_int('AUTOESC_FUZZ_BUDGET_US', 20)
+CORPUS_DIR = os.environ.get('AUTOESC_FUZZ_CORPUS') or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'test_output', 'fuzz_corpus')
+
+# Inputs this short are dominated by per-call overhead, so they get this
+# much time regardless of the per-byte budget.
+_MIN_BUDGET_SECONDS = 0.01
+
+# Prefixes of HTML that put the lexer in each interesting context.
+_HTML_PREFIXES = (
+    u'', u'<', u'<a ', u'<a title=', u'<a title="', u"<a title='",
+    u'<a href="', u'<a href=', u'<a href="http://x/?', u'<a onclick="',
+    u"<a onclick='", u'<a onclick=', u'<a style="', u'<!--', u'<title>',
+    u'<textarea>', u'<script>', u'<script>"', u"<script>'", u'<script>/',
+    u'<script>x/', u'<script>//', u'<script>/*', u'<style>', u'<style>"',
+    u"<style>'", u'<style>url(', u'<style>/*', u'<style>//', u'<xmp>',
+    u'<listing>',
+    )
+
+# Runs that are repeated to make the lexer search far ahead or retry
+# matches, such as prefixes of end tags, entities, escapes and comment
+# delimiters.
+_HTML_MOTIFS = (
+    u'<', u'</', u'</scrip', u'</style', u'</title', u'<!-', u'--',
+    u'-->', u'&', u'&#', u'&#x', u'&amp', u'&quot;', u'\\', u'\\"',
+    u"\\'", u'\\<', u'"', u"'", u'/', u'//', u'/*', u'*/', u'[', u'[/',
+    u'\\/', u'a<b', u'a=', u' a', u'=', u' ', u'\n', u'\r\n', u'\u2028',
+    u'url(', u'x', u'ab', u'return', u'++', u'.', u'0.', u'>',
+    )
+
+# Runs that are repeated in untrusted values passed to the sanitizers.
+_VALUE_MOTIFS = (
+    u'a', u'0', u'-', u'_', u' ', u'&', u'<', u'>', u'"', u"'", u'\\',
+    u'/', u'%', u'%2', u'%zz', u'#', u'?', u'=', u'(', u')', u':',
+    u'javascript:', u'http://', u'url(', u'expression(', u'</script',
+    u'<!--', u'-->', u']]>', u'\u2028', u'\u00a0', u'\ufeff', u'\x00',
+    u'1.5', u'1e', u'px', u'#fff', u'!important', u'&amp;', u'\\u',
+    )
+
+
+def _generate(rng, motifs, size):
+    """
+    Picks a motif, sometimes made of two motifs like "<a" and "<b", and a
+    number of repetitions that add up to about size characters.
+    Returns (motif, count).
+    """
+    motif = rng.choice(motifs)
+    if rng.random() < 0.5:
+        motif += rng.choice(motifs)
+    return motif, max(1, size // len(motif))
+
+
+class _Target(object):
+    """A function under test and the name that its slow inputs are saved as."""
+
+    def __init__(self, name, fn):
+        self.name = name
+        self.fn = fn
+
+
+def _lex(text):
+    """Lexes text from the start of an HTML document."""
+    try:
+        context_update.process_raw_text(text, context.STATE_TEXT)
+    except context_update.ContextUpdateFailure:
+        pass
+
+
+def _targets():
+    """The functions under test."""
+    targets = [_Target('process_raw_text', _lex)]
+    for sanitizer in escaping.SANITIZER_FOR_ESC_MODE:
+        if sanitizer is not None:
+            targets.append(_Target(sanitizer.__name__, sanitizer))
+    return targets
+
+
+def _seconds_per_run(target, text):
+    """The least time of two calls of target on text."""
+    best = None
+    for _ in xrange(2):
+        start = time.time()
+        target.fn(text)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def _budget(text):
+    """The time in seconds that processing text may take."""
+    return max(_MIN_BUDGET_SECONDS, len(text) * BUDGET_US * 1e-6)
+
+
+def _is_slow(target, text):
+    """True iff target takes longer than the budget for text."""
+    return _seconds_per_run(target, text) > _budget(text)
+
+
+def _minimize(target, prefix, motif, count):
+    """
+    Given that prefix + motif * count is over budget, bisects for the fewest
+    repetitions of motif that are, assuming that time per byte grows with
+    the count, then drops prefix if the input is slow without it.
+    Returns the smallest slow input found.
+    """
+    # Over budget at high, and at or under budget at low.
+    low, high = 0, count
+    while high - low > 1:
+        middle = (low + high) // 2
+        if _is_slow(target, prefix + motif * middle):
+            high = middle
+        else:
+            low = middle
+    if prefix and _is_slow(target, motif * high):
+        prefix = u''
+    return prefix + motif * high
+
+
+def _save(target, text):
+    """Writes a slow input to the corpus and returns its path."""
+    if not os.path.isdir(CORPUS_DIR):
+        os.makedirs(CORPUS_DIR)
+    data = text.encode('UTF-8')
+    path = os.path.join(CORPUS_DIR, '%s-%s.txt' % (
+        target.name, hashlib.sha1(data).hexdigest()[:12]))
+    with open(path, 'wb') as out:
+        out.write(data)
+    return path
+
+
+def _corpus(target):
+    """The saved inputs for target."""
+    if not os.path.isdir(CORPUS_DIR):
+        return
+    for name in sorted(os.listdir(CORPUS_DIR)):
+        if name.startswith(target.name + '-'):
+            with open(os.path.join(CORPUS_DIR, name), 'rb') as inp:
+                yield name, inp.read().decode('UTF-8')
+
+
+class PerfFuzzTest(unittest.TestCase):
+    """
+    Checks the worst case time per byte of the lexer and sanitizers.
+    """
+
+    def setUp(self):
+        cache = context_update.PROCESS_RAW_TEXT_CACHE
+        self.old_cache_size = cache.max_size
+        cache.resize(0)
+
+    def tearDown(self):
+        context_update.PROCESS_RAW_TEXT_CACHE.resize(self.old_cache_size)
+
+    def check(self, target, prefix, motif, count):
+        """
+        Runs target on prefix + motif * count and returns a failure
+        message if timing is enabled and it is over budget, or None.
+        """
+        text = prefix + motif * count
+        if not TIMING:
+            target.fn(text)
+            return None
+        elapsed = _seconds_per_run(target, text)
+        self.worst = max(self.worst, elapsed * 1e6 / max(1, len(text)))
+        if elapsed <= _budget(text):
+            return None
+        path = _save(target, _minimize(target, prefix, motif, count))
+        return '%s took %.3fs for %d chars of %r + %r * %d, saved to %s' % (
+            target.name, elapsed, len(text), prefix, motif, count, path)
+
+    def test_corpus(self):
+        """Replays saved slow inputs."""
+        failures = []
+        for target in _targets():
+            for name, text in _corpus(target):
+                if not TIMING:
+                    target.fn(text)
+                    continue
+                elapsed = _seconds_per_run(target, text)
+                if elapsed > _budget(text):
+                    failures.append('%s took %.3fs' % (name, elapsed))
+        self.assertFalse(failures, '\n'.join(failures))
+
+    def test_fuzz(self):
+        """Runs generated inputs against every target."""
+        failures = []
+        report = []
+        for target in _targets():
+            rng = random.Random('%s/%s' % (SEED, target.name))
+            self.worst = 0.0
+            is_lexer = target.fn is _lex
+            for _ in xrange(ITERATIONS):
+                if is_lexer:
+                    prefix = rng.choice(_HTML_PREFIXES)
+                    motif, count = _generate(rng, _HTML_MOTIFS, SIZE)
+                else:
+                    prefix = u''
+                    motif, count = _generate(rng, _VALUE_MOTIFS, SIZE)
+                failure = self.check(target, prefix, motif, count)
+                if failure:
+                    failures.append(failure)
+            report.append('%-26s worst %.2fus/char' % (
+                target.name, self.worst))
+        if TIMING:
+            print >> sys.stderr, '\n'.join(report)
+        self.assertFalse(failures, '\n'.join(failures))
+
+
+if __name__ == '__main__':
+    unittest.main()